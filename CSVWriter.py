@@ -1,69 +1,239 @@
 import OFXWriter
+import PKIndexStore
+import RecordStore
+import csv
 import datetime
+import functools
+import gzip
 import re
 from os import path
 
-def FieldtoStr(field, colchar, quotechar, quoterule, ExcelStrings):
-    if field == None:
-        st = ""
-    else:
-        datatype = type(field).__name__
-        match datatype:
-            case 'Decimal' | 'bool':
-                st = "{0}".format(field)
-            case 'datetime':
-                st = ("{0:%Y-%m-%d}".format(field)
-                      + (" {0:%H:%M:%S}".format(field) if field.time() != datetime.time(0, 0, 0) else ""))
-            case 'str':
-                st = field
-                if ExcelStrings.upper() in ['YES', 'Y', 'TRUE', 'T', 'ENABLED']:
-                    if re.search(r'^\s*(.*{0}.*|[+-]?(\d*\.\d+|\d+.?)(E\d+)?)$'.format(colchar[0]), field, re.I):
-                        st = '="{0}"'.format(field.replace('"', '""'))
-                    elif re.search((
-                            r'^\s*(((0?[1-9]|1[0-2])([-\\\/])(0?[1-9]|[12][0-9]|3[01])(?:\4((?:19|2[0-9])?[0-9][0-9]))?)'
-                            r'|((Jan(?:uary)?|Feb(?:ruary)?|Mar(?:ch)?|Apr(?:il)?|May|June?|July?|Aug(?:ust)?|Sep(?:tember)?|Oct(?:ober)?|(?:Nov|Dec)(?:ember)?)'
-                            r'\s+(0?[1-9]|[12][0-9]|3[01])(?:[ ,]\s*((?:19|2[0-9])?[0-9][0-9]))?)'
-                            r'|(((?:19|2[0-9])[0-9]{2,2})([-\\\/])(0?[1-9]|1[0-2])\13(0?[1-9]|[12][0-9]|3[01])))\s*$'),
-                            field, re.I):
-                        st = '="{0}"'.format(field.replace('"', '""'))
-                    elif field in ['TRUE', 'FALSE']:
-                        st = '="{0}"'.format(field.replace('"', '""'))
-                    else:
-                        st = field
-                if (colchar in st) or (quoterule == 'AllStrings'):
-                    st = (
-                        "{1}{0}{1}".format(st.replace(quotechar, quotechar + quotechar), quotechar))
+YesValues = ['YES', 'Y', 'TRUE', 'T', 'ENABLED']
+WriteBuffer = 1 << 20   # Bytes buffered per open CSV file before it is written out
+
+# ExcelCompatibility keeps Excel from turning strings that look like numbers or dates into numbers or dates, by writing
+#   them as a ="..." formula.  The patterns are compiled once, and the answer for each distinct string is memoized: a
+#   statement repeats the same account numbers, CUSIPs, ticker symbols and memos over and over.
+NumberRE = re.compile(r'^\s*[+-]?(\d*\.\d+|\d+.?)(E\d+)?$', re.I)
+DateRE = re.compile((
+    r'^\s*(((0?[1-9]|1[0-2])([-\\\/])(0?[1-9]|[12][0-9]|3[01])(?:\4((?:19|2[0-9])?[0-9][0-9]))?)'
+    r'|((Jan(?:uary)?|Feb(?:ruary)?|Mar(?:ch)?|Apr(?:il)?|May|June?|July?|Aug(?:ust)?|Sep(?:tember)?|Oct(?:ober)?|(?:Nov|Dec)(?:ember)?)'
+    r'\s+(0?[1-9]|[12][0-9]|3[01])(?:[ ,]\s*((?:19|2[0-9])?[0-9][0-9]))?)'
+    r'|(((?:19|2[0-9])[0-9]{2,2})([-\\\/])(0?[1-9]|1[0-2])\13(0?[1-9]|[12][0-9]|3[01])))\s*$'), re.I)
+
+@functools.lru_cache(maxsize=8192)
+def ExcelText(field, colchar):
+    if field in ['TRUE', 'FALSE'] or colchar in field \
+            or NumberRE.search(field) or (field.lstrip()[:1].isalnum() and DateRE.search(field)):
+        return '="{0}"'.format(field.replace('"', '""'))
+    return field
+
+def DateText(field):
+    return ("{0:%Y-%m-%d}".format(field)
+            + (" {0:%H:%M:%S}".format(field) if field.time() != datetime.time(0, 0, 0) else ""))
+
+TextOf = {datetime.datetime: DateText}   # Anything else (Decimal, bool...) is written as str() gives it
+
+# The text of a field as it will sit in the file once the CSV quoting (if any) is taken off again - which is also what
+#   a CSV reader gives back for it, so the primary key index (PKIndex = Yes) keys on these.
+def FieldtoText(field, colchar, ExcelSafe):
+    if field is None:
+        return ""
+    if type(field) is str:
+        return ExcelText(field, colchar) if ExcelSafe else field
+    return TextOf.get(type(field), str)(field)
+
+def FieldtoStr(field, colchar, quotechar, AllStrings, ExcelSafe):
+    st = FieldtoText(field, colchar, ExcelSafe)
+    if type(field) is str and ((colchar in st) or AllStrings):
+        st = "{1}{0}{1}".format(st.replace(quotechar, quotechar + quotechar), quotechar)
     return st
 
+# Normally each run rewrites every <table>.csv from scratch.  With PKIndex = Yes in [CSV] the files are kept and added
+#   to instead: a PKIndexStore (OFXtoDB.pkindex in the same directory) remembers the primary key of every row already
+#   written, so a record whose key is already in the file is counted as Existing and not written again, and only new
+#   records are appended.  A CSV row cannot be updated in place, so for the CSV files the first version of a record wins.
+#   If a file was edited (or replaced) outside this program, its index is rebuilt by reading it once.
+#
+#   Other [CSV] options:
+#     Append = Yes      keeps the existing files and appends to them (without the duplicate check PKIndex gives).
+#     Stream = Yes      writes each record as soon as it is complete (OFXRecEnd) instead of holding the whole list in
+#                       memory until OFXListEnd.  A record already written cannot be taken back, so duplicates within
+#                       a list are always resolved as DuplicatePolicy = FirstWins.  With PKIndex = Yes the records go
+#                       out in batches (RecordStore.BatchSize), so the index is asked once per batch, not per record.
+#     Compress = gzip   writes <table>.csv.gz instead.  Appending adds a gzip member, which gzip readers take in stride.
 class CSVWriter(OFXWriter.Writer):
     def __init__(self, plist):
         self.savedir = plist['WriteToDirectory'] if 'WriteToDirectory' in plist else "."
         self.savedir = path.expandvars(self.savedir)
-        self.includeheader = plist['Headers'] if 'Headers' in plist else 'NO'
-        self.quoterule = plist['WhenToQuote']  # SeparatorOnly (only as necessary) or AllStrings (every string value)
-        self.ExcelStrings = plist['ExcelCompatibility']  # TRUE = write special formulas to keep strings as strings.
+        self.includeheader = (plist['Headers'] if 'Headers' in plist else 'NO').upper() in YesValues
+        self.AllStrings = plist['WhenToQuote'] == 'AllStrings'  # SeparatorOnly (only as necessary) or AllStrings (every string value)
+        self.ExcelSafe = plist['ExcelCompatibility'].upper() in YesValues  # write special formulas to keep strings as strings.
         self.quotechar = plist['QuoteChar'][0]
         self.colchar = plist['ColumnSeparator'][0]
+        self.append = plist.get('Append', 'No').upper() in YesValues
+        self.stream = plist.get('Stream', 'No').upper() in YesValues
+        self.gzip = plist.get('Compress', 'None').lower() == 'gzip'
         self.destination = 'CSV Files'
-        super().__init__(plist)
+        self.Cumulative = self.append or plist.get('PKIndex', 'No').upper() in YesValues   # Otherwise each run starts over
+        self.store = None
+        if plist.get('PKIndex', 'No').upper() in YesValues:
+            self.store = PKIndexStore.PKIndexStore(path.join(self.savedir, 'OFXtoDB.pkindex'))
+        self.__rows = {}  # Data rows in each indexed file
+        self.__open = {}  # Table -> [open file, PKs written to it] while a list is being written
+        self.__seen = {}  # Table -> PKs already streamed out in this list (Stream = Yes)
+        self.__batch = {}  # Table -> records streamed but not yet checked against the index (Stream & PKIndex = Yes)
+        self.__started = set()  # Tables already written this run.  Only the first write truncates, the rest append so
+        super().__init__(plist)  #  two OFX lists (or two files in a batch) feeding one table don't overwrite each other
+        if self.stream and self.DuplicatePolicy != 'FirstWins':
+            raise OFXWriter.ConfigurationError("Stream = Yes in [CSV] only works with DuplicatePolicy = FirstWins")
+
+    def __FileName(self, EachTable):
+        return "{0}/{1}.csv{2}".format(self.savedir, EachTable, '.gz' if self.gzip else '')
+
+    def __OpenFile(self, fn, mode):
+        if self.gzip:
+            return gzip.open(fn, mode + 't', compresslevel=6)
+        return open(fn, mode, buffering=WriteBuffer)
+
+    def __Key(self, rec, datatuple):
+        return tuple(FieldtoText(rec[pos], self.colchar, self.ExcelSafe) for pos in datatuple.PKCols.values())
+
+    def __Line(self, rec):
+        return self.colchar.join(
+            [FieldtoStr(field, self.colchar, self.quotechar, self.AllStrings, self.ExcelSafe) for field in rec]) + "\n"
+
+#   The number of data rows in an indexed table's file, reading the file to rebuild its index when the stored one does
+#     not fit.  None when there is no file yet.
+    def __IndexedRows(self, EachTable, fn, datatuple):
+        stamp = PKIndexStore.FileStamp(fn)
+        if stamp is None:
+            self.store.Replace(EachTable, {})   # Whatever the index says was in the file is gone with it
+            return None
+        rows = self.store.Rows(EachTable, datatuple.PKCols, stamp)
+        if rows is None:
+            index = {}
+            rows = 0
+            with (gzip.open(fn, 'rt', newline='') if self.gzip else open(fn, 'r', newline='')) as f:
+                lines = csv.reader(f, delimiter=self.colchar, quotechar=self.quotechar)
+                if self.includeheader:
+                    next(lines, None)
+                for line in lines:
+                    rows += 1
+                    index[tuple(line[pos] if pos < len(line) else '' for pos in datatuple.PKCols.values())] = rows
+            self.store.Replace(EachTable, index)
+            self.store.Mark(EachTable, datatuple.PKCols, rows, stamp)
+        return rows
+
+#   Open a table's file for this list: truncated on the first write of a run (unless appending), appended to after that.
+#     The heading goes in whenever the file starts out empty.
+    def __Open(self, EachTable, datatuple):
+        fn = self.__FileName(EachTable)
+        if self.store is not None:
+            if EachTable not in self.__started:
+                self.__rows[EachTable] = self.__IndexedRows(EachTable, fn, datatuple)
+            fresh = self.__rows[EachTable] is None
+        elif self.append:
+            fresh = PKIndexStore.FileStamp(fn) is None
+        else:
+            fresh = EachTable not in self.__started
+        f = self.__OpenFile(fn, 'w' if fresh else 'a')
+        self.__started.add(EachTable)
+        if fresh and self.includeheader:
+            f.write(self.__Line(datatuple.Cols))
+        self.__open[EachTable] = [f, []]
+        return self.__open[EachTable]
+
+    def __Close(self, EachTable, datatuple):
+        opened = self.__open.pop(EachTable, None)
+        if opened is None:
+            return
+        opened[0].close()
+        if self.store is not None:
+            fn = self.__FileName(EachTable)
+            rows = self.__rows[EachTable] or 0
+            self.store.Add(EachTable, {key: rows + n for n, key in enumerate(opened[1], 1)})
+            self.__rows[EachTable] = rows + len(opened[1])
+            self.store.Mark(EachTable, datatuple.PKCols, self.__rows[EachTable], PKIndexStore.FileStamp(fn))
+            self.store.Commit()
+
+#   Streaming: each record goes out as it is completed.  The PKs seen in this list are still remembered, so duplicates
+#     are dropped (and counted) just as the base class would under FirstWins, but the records themselves are not kept.
+    def __Stream(self, EachTable, datatuple, rec):
+        PKtuple = tuple(rec[PKs] for PKs in datatuple[0].PKCols.values())
+        self.TableStats(EachTable)
+        seen = self.__seen.setdefault(EachTable, set())
+        if PKtuple in seen:
+            self.Stats[EachTable][2] += 1
+        elif self.store is None:
+            seen.add(PKtuple)
+            opened = self.__open.get(EachTable) or self.__Open(EachTable, datatuple[0])
+            opened[0].write(self.__Line(rec))
+            self.Stats[EachTable][0] += 1
+        else:
+            seen.add(PKtuple)
+            batch = self.__batch.setdefault(EachTable, [])
+            batch.append(rec)
+            if len(batch) >= RecordStore.BatchSize:
+                self.__WriteBatch(EachTable, datatuple[0], batch)
+                self.__batch[EachTable] = []
+
+    def OFXListStart(self, ofxlist):
+        self.__seen = {}
+        self.__batch = {}
+        return super().OFXListStart(ofxlist)
+
+    def OFXRecEnd(self):
+        if not self.stream:
+            return super().OFXRecEnd()
+        if self.curOFXList is not None:
+            for EachTable in self.curOFXList:
+                datatuple = self.curOFXList[EachTable]
+                self.__Stream(EachTable, datatuple, tuple(datatuple[1]))
+
+    def OFXAddRecords(self, tables):
+        if not self.stream:
+            return super().OFXAddRecords(tables)
+        if self.curOFXList is not None:
+            for EachTable, records in tables.items():
+                if EachTable in self.curOFXList:
+                    for rec in records:
+                        self.__Stream(EachTable, self.curOFXList[EachTable], rec)
 
     def OFXListEnd(self):
         if self.curOFXList is not None:
             for EachTable in self.curOFXList:
-                f = open("{0}/{1}.csv".format(self.savedir, EachTable),'w+')
-                if EachTable not in self.Stats:
-                    self.Stats[EachTable]=[0,0]  # Update statistics
-                if self.includeheader in ['YES', 'Y', 'TRUE', 'T', 'ENABLED']:
-                    result = []
-                    for hdr in self.curOFXList[EachTable][0].Cols:
-                        st = FieldtoStr(hdr, self.colchar, self.quotechar, self.quoterule, self .ExcelStrings)
-                        result.append(st)
-                    f.write(self.colchar[0].join(result) + "\n")
-                for rec in self.curOFXList[EachTable][2]:
-                    result = []
-                    for field in rec:
-                        st = FieldtoStr(field, self.colchar, self.quotechar, self.quoterule, self .ExcelStrings)
-                        result.append(st)
-                    f.write(self.colchar[0].join(result) + "\n")
-                    self.Stats[EachTable][0] += 1
-                f.close()
\ No newline at end of file
+                datatuple = self.curOFXList[EachTable][0]
+                self.TableStats(EachTable)  # Update statistics
+                if not self.stream:
+                    self.__WriteRecords(EachTable, datatuple)
+                elif self.__batch.get(EachTable):
+                    self.__WriteBatch(EachTable, datatuple, self.__batch.pop(EachTable))
+                self.__Close(EachTable, datatuple)
+
+#   ChunkSize: a chunk is written to the table's file, which stays open (and its new keys unindexed) until OFXListEnd.
+    def OFXFlushBatch(self, EachTable):
+        self.TableStats(EachTable)
+        self.__WriteRecords(EachTable, self.curOFXList[EachTable][0])
+        return True
+
+    def __WriteRecords(self, EachTable, datatuple):
+        self.__open.get(EachTable) or self.__Open(EachTable, datatuple)
+        for records in self.Records(EachTable).Batches(RecordStore.BatchSize):
+            self.__WriteBatch(EachTable, datatuple, records)
+
+#   Write a batch of records, less those the index says are already in the file.
+    def __WriteBatch(self, EachTable, datatuple, records):
+        opened = self.__open.get(EachTable) or self.__Open(EachTable, datatuple)
+        if self.store is not None:
+            keys = [self.__Key(rec, datatuple) for rec in records]
+            found = self.store.Find(EachTable, keys)
+            self.Stats[EachTable][1] += len(found)
+            records = [rec for rec, key in zip(records, keys) if key not in found]
+            opened[1].extend(key for key in keys if key not in found)
+        opened[0].write(''.join([self.__Line(rec) for rec in records]))
+        self.Stats[EachTable][0] += len(records)
+
+    def OFXAllDone(self):
+        if self.store is not None:
+            self.store.Close()
@@ -1,15 +1,47 @@
-import PostgresWriter
-import ExcelWriter
-import DataDumper
-import CSVWriter
+#  Which Writer class goes with each Writer = mnemonic in [common].  A Writer's module (and whatever it needs: psycopg2,
+#  openpyxl, pyarrow...) is imported only when that Writer is chosen, so a run pays only for its own Writer's imports.
+#
+#  Writers from other packages plug in the same way, through the "ofxtodb.writers" entry point group.  The entry point
+#  name is the mnemonic, its value the class, e.g. in the plug-in's pyproject.toml:
+#      [project.entry-points."ofxtodb.writers"]
+#      DuckDB = "ofxtodb_duckdb:DuckDBWriter"
+#  The class is built like the ones here, from the parameters in the .ini section named after the mnemonic.  A plug-in
+#  cannot take over a mnemonic of the built-in Writers.  Plug-ins are only looked for when the mnemonic is not built in.
+#
+#  The registry names modules as strings, so a PyInstaller build has to be told about them (hiddenimports in the .spec).
+
+import importlib
+
+Registry = {'Postgres': ('PostgresWriter', 'PostgresDBWriter'),
+            'Excel': ('ExcelWriter', 'ExcelWBWriter'),
+            'CSV': ('CSVWriter', 'CSVWriter'),
+            'SQLite': ('SQLiteWriter', 'SQLiteDBWriter'),
+            'Parquet': ('ParquetWriter', 'ParquetWriter')}
+PluginGroup = 'ofxtodb.writers'
+
+
+def Plugins():   # mnemonic -> entry point of every installed plug-in Writer
+    from importlib import metadata
+    return {ep.name: ep for ep in metadata.entry_points(group=PluginGroup) if ep.name not in Registry}
+
+
+def IsWriter(choice):
+    return choice in Registry or choice in Plugins()
+
+
+def WriterClass(choice):
+    if choice in Registry:
+        module, cls = Registry[choice]
+        return getattr(importlib.import_module(module), cls)
+    plugins = Plugins()
+    if choice in plugins:
+        return plugins[choice].load()
+    return None
 
 
 def WhichWriter(choice="default", paramlist=None):
-    if choice == 'Postgres':
-        return PostgresWriter.PostgresDBWriter(paramlist)
-    elif choice == 'Excel':
-        return ExcelWriter.ExcelWBWriter(paramlist)
-    elif choice == 'CSV':
-        return CSVWriter.CSVWriter(paramlist)
-    else:
+    cls = WriterClass(choice) if choice else None   # No Writer configured: the DataDumper prints the records
+    if cls is None:
+        import DataDumper
         return DataDumper.TypeWriter()
+    return cls(paramlist)
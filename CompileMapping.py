@@ -0,0 +1,68 @@
+#  Compiles the .ini mapping ([Mapping] and the [Table:...] sections) once, ahead of time.  It checks the mapping over,
+#  reporting what would otherwise only show as quietly missing data, and writes the compiled mapping (see
+#  OFXWriter.CompileMapping) to the file given, or to CompiledMapping in [common].  With CompiledMapping set, OFXtoDB
+#  then loads that file instead of rebuilding the mapping on every run, for as long as the .ini mapping is unchanged.
+#
+#  python CompileMapping.py [compiled mapping file]
+
+import os
+import sys
+import time
+import OFXGlobals
+import OFXtoDataParams
+import OFXWriter
+
+
+# What is legal but most likely a mistake: a type with no converter (its values are always empty), a table with no
+#   primary key (duplicates are never caught), a list the program never looks for, and a tag mapped twice in one table
+#   (only the last column gets it).
+def Check(params, mapping):
+    warnings = []
+    seen = {}
+    for rec in OFXWriter.MappingFromIniFile():
+        if rec.typcategory not in OFXWriter.Converters:
+            warnings.append("{0} column {1}: type {2} is not one of {3}, so it is always left empty".format(
+                rec.DBTable, rec.DBColumn, rec.typcategory, ", ".join(OFXWriter.Converters)))
+        where = seen.setdefault((rec.OFXList, rec.DBTable, rec.OFXTag), rec.DBColumn)
+        if where != rec.DBColumn:
+            warnings.append("{0} in {1}: {2} is mapped to both {3} and {4}, only {4} gets it".format(
+                rec.DBTable, rec.OFXList, rec.OFXTag, where, rec.DBColumn))
+    universe = params.options('OFXListUniverse')
+    for OFXList, tables in mapping.Lists:
+        if OFXList.rsplit('/', 1)[-1] not in universe:
+            warnings.append("{0} is not an OFX list the program processes ([OFXListUniverse])".format(OFXList))
+        for EachTable, specs in tables:
+            if not specs.PKCols:
+                warnings.append("{0} in {1} has no PK column, so duplicates are never caught".format(EachTable, OFXList))
+    return sorted(set(warnings), key=warnings.index)
+
+
+def main(argv):
+    OFXGlobals.params = OFXtoDataParams.readconfig([argv[0]])
+    filename = os.path.expandvars(argv[1] if len(argv) > 1 else OFXGlobals.params['common'].get('CompiledMapping', ''))
+    if not filename:
+        sys.exit("Give the compiled mapping file, or set CompiledMapping in [common]")
+    try:
+        mapping = OFXWriter.CompileMapping(OFXWriter.MappingFromIniFile())
+        warnings = Check(OFXGlobals.params, mapping)
+    except OFXWriter.ConfigurationError as err:
+        sys.exit("Mapping error: {0}".format(err))
+    for warning in warnings:
+        print("Warning: {0}".format(warning))
+    try:
+        OFXWriter.WriteCompiledMapping(filename, OFXGlobals.params, mapping)
+    except OSError as err:
+        sys.exit("Cannot write {0}: {1}".format(filename, err))
+    start = time.perf_counter()
+    OFXWriter.ReadCompiledMapping(filename, OFXGlobals.params)
+    loaded = time.perf_counter() - start
+    print("Compiled {0} lists, {1} tables, {2} mapped tags from {3} into {4} ({5} warnings); it loads in {6:.0f} µs".format(
+        len(mapping.Lists), sum(len(tables) for OFXList, tables in mapping.Lists),
+        sum(len(specs.OFXDict) for OFXList, tables in mapping.Lists for EachTable, specs in tables),
+        OFXGlobals.params.IniFile, filename, len(warnings), loaded * 1e6))
+    if len(argv) > 1 and OFXGlobals.params['common'].get('CompiledMapping', '') != argv[1]:
+        print("Set CompiledMapping = {0} in [common] for OFXtoDB to use it".format(argv[1]))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,14 +1,22 @@
 import OFXWriter
 class TypeWriter(OFXWriter.Writer):
+    Parallelizable = False   # Prints as it goes, so there is nothing to collect in a worker process
+    Cumulative = False       # Nothing is kept
     def __init__(self):
         self.OFXListDict = {"SECLIST": 0, "INVPOSLIST": 0, "INVTRANLIST": 0, "BANKTRANLIST": 0, "BANKTRANLISTP": 0,
                             "LOANTRANLIST": 0, "AMRTTRANLIST": 0, "CLOSING": 0}
+        self.Stats = {}
+        self.listvars = []
     def OFXListStart(self, list):
         print("List "+list)
     def OFXListEnd(self):
         print()
         return (0, 0)
+    def OFXSetContext(self, listvars):
+        self.listvars = listvars
     def OFXRecStart(self):
+        for lv in self.listvars:
+            self.OFXPutData(lv.tag, lv.value, lv.alttag)
         return
     def OFXRecEnd(self):
         print()
@@ -3,84 +3,133 @@ from openpyxl import load_workbook
 from copy import copy
 import OFXWriter
 import re
+import os
 from os import path
-import threading
+import sqlite3
+import PKIndexStore
+import concurrent.futures
 
 
 class ConfigurationError(Exception):
     pass
 
-# This is a replacement function called by re.sub below to parse relative cell references out of an EXCEL formula and
-# replace with a cell reference to the same column and one row number greater.  This is like a Fill-Down function using
-# EXCEL.  Does not support R1C1-type references nor relative named ranges (does anyone REALLY use these?)
-def repl(match):
-    return match.group(1) + str(1 + int(match.group(2)))
+# Parse relative cell references out of an EXCEL formula and replace each with a cell reference to the same column and
+# rows row numbers greater.  This is like a Fill-Down function using EXCEL, so every new row's formula can come from one
+# template row.  Does not support R1C1-type references nor relative named ranges (does anyone REALLY use these?)
+def FillDown(formula, rows):
+    return re.sub(r"(?<!\w)([a-z]{1,3})(\d+)", lambda match: match.group(1) + str(rows + int(match.group(2))),
+                  formula, flags=re.IGNORECASE)
+
+
+# Building the primary key index means reading every row of every sheet, which for a workbook with years of history
+# costs far more than the handful of rows a statement adds.  So the index is kept next to the workbook (as
+# <workbook>.pkindex, see PKIndexStore) and brought up to date at the end of each run.  The next run uses it as long as
+# the workbook has not been touched since; saving it in Excel simply means one full re-index.
 
 
 # Searching for duplicate primary keys is slow.  This attempts to speed it up by putting all primary keys into a
 # dictionary structure, thus effectively making a hash index out of the primary key.  The dictionary key is the primary
 # key of the EXCEL record and the item is the row number of the entry in the sheet, making it a direct access to the
-# matching record.  The indexing is performed in a parallel thread, thus letting (in theory) the indexing take place at
-# the same time the main program is accumulating its data records before writing them out.  Note that multithreading
-# does not imply parallel processing in Python 3.11.  We'll need a future release of Python before two totally
-# compute-bound threads can execute in parallel and we can reap some time savings.
+# matching record.  IndexOneWorksheet checks the sheet's headings against the mapping and works out which columns are
+# stored into, which carry formulas and which hold the primary key.  Reading every row for the index itself is left to
+# IndexAllWorksheets, which can hand it to another process.
 def IndexOneWorksheet(tablename, ws, MapSpecs):
-    pvt = threading.local()
-    for pvt.colhdrs in ws.iter_rows(min_col=1, max_col=ws.max_column, min_row=1, max_row=1):
+    for colhdrs in ws.iter_rows(min_col=1, max_col=ws.max_column, min_row=1, max_row=1):
         break
     ws.FormulaCols = list(range(1,ws.max_column+1))    # Keep track of columns with Excel formulas in them
     ws.colnbrs = []
-    for pvt.OFXcol in MapSpecs.Cols:
-        for pvt.wscol in pvt.colhdrs:
-            if pvt.OFXcol == pvt.wscol.value:
-                ws.colnbrs.append(pvt.wscol.col_idx)
-                ws.FormulaCols.remove(pvt.wscol.col_idx)  # Remove every column that is stored into.  What's left is columns that might have calculations
+    for OFXcol in MapSpecs.Cols:
+        for wscol in colhdrs:
+            if OFXcol == wscol.value:
+                ws.colnbrs.append(wscol.col_idx)
+                ws.FormulaCols.remove(wscol.col_idx)  # Remove every column that is stored into.  What's left is columns that might have calculations
                 break
         else:
             raise ConfigurationError(
-                "Column {0} is not in spreadsheet for Table {1}".format(pvt.OFXcol, tablename))
-    for pvt.col in ws.FormulaCols:    # Check columns left (not stored into) for the existence of a formula
-        pvt.wscol = ws.cell(ws.max_row, pvt.col)
-        if pvt.wscol.value is None or pvt.wscol.value[0]!="=" or ws.max_row<=1:  # ws has data + last value starts with "="
-            ws.FormulaCols.remove(pvt.col)
-    pvt.pkcolnbrs = []
-    for pvt.PKItem in MapSpecs.PKCols:
-        for pvt.wscol in pvt.colhdrs:
-            if pvt.PKItem == pvt.wscol.value:
-                pvt.pkcolnbrs.append(pvt.wscol.col_idx - 1)
+                "Column {0} is not in spreadsheet for Table {1}".format(OFXcol, tablename))
+    for col in list(ws.FormulaCols):    # Check columns left (not stored into) for the existence of a formula
+        wscol = ws.cell(ws.max_row, col)
+        if wscol.value is None or str(wscol.value)[0:1]!="=" or ws.max_row<=1:  # ws has data + last value starts with "="
+            ws.FormulaCols.remove(col)
+    ws.pkcolnbrs = []
+    for PKItem in MapSpecs.PKCols:
+        for wscol in colhdrs:
+            if PKItem == wscol.value:
+                ws.pkcolnbrs.append(wscol.col_idx - 1)
                 break
         else:
             raise ConfigurationError(
-                "PK Column {0} is not in spreadsheet for Table {1}".format(pvt.PKItem, tablename))
-    ws.PKIndex = {}
-    pvt.rownum = 2
-    for pvt.row in ws.iter_rows(min_col=1, max_col=ws.max_column, min_row=pvt.rownum, max_row=ws.max_row):
-        pvt.PK = tuple(pvt.row[i].value for i in pvt.pkcolnbrs)
-        ws.PKIndex[pvt.PK] = pvt.rownum
-        pvt.rownum += 1
-    ws.PKIndexIsReady = True
-
-
-# Notice that IndexOneWorksheet can be called either as a subroutine/function or in a separate thread, making it
-# possible to add some tuning logic here to avoid thread setup/takedown overhead when processing small sheets.
-#  Something like: "if ws.max_row < 30: <call as a function> else: <call as a thread>".
-def IndexAllWorksheets(MapSpecs, wb):
+                "PK Column {0} is not in spreadsheet for Table {1}".format(PKItem, tablename))
+    ws.PKCols = tuple(MapSpecs.PKCols)
+
+
+# The row scan proper.  It reads the sheet values only, which is all the index needs, and returns the compact
+# {PK: row number} dictionary.  Run in a worker process it opens its own read-only copy of the workbook.
+def ScanRows(rows, pkcolnbrs):
+    return {tuple(row[i] if i < len(row) else None for i in pkcolnbrs): rownum for rownum, row in enumerate(rows, 2)}
+
+
+def ScanWorksheet(fn, tablename, pkcolnbrs):
+    wb = load_workbook(filename=fn, read_only=True)
+    try:
+        return ScanRows(wb[tablename].iter_rows(min_row=2, values_only=True), pkcolnbrs)
+    finally:
+        wb.close()
+
+
+# Threads don't make the row scans run side by side (they are compute bound and Python has the GIL), so the sheets
+# with more than IndexInProcesses rows are scanned in a pool of worker processes, one per sheet up to the CPU count.
+# They run while the main program parses the OFX file and accumulates its data records, and OFXListEnd only waits
+# (in WaitForIndex) for the sheet it is about to write.  Smaller sheets are not worth a process and are scanned here.
+# A sheet whose stored index still fits is not scanned at all.  ws.PKAdded collects the keys added this run when the
+# stored index only needs those added, and is None when the whole index has to be stored afresh.
+def IndexAllWorksheets(MapSpecs, wb, store=None, stamp=None, InProcesses=0):
+    toscan = []
     for OFX in MapSpecs:
         for tablename in MapSpecs[OFX]:
             if tablename in wb.sheetnames:
                 ws = wb[tablename]
                 if (not hasattr(ws,"PKIndexIsReady")) and ws.max_row>0:
                     ws.PKIndexIsReady = False
-                    spectuple = MapSpecs[OFX][tablename][0]
-#                    IndexOneWorksheet(tablename, ws, spectuple)  # Old invocation - called as a function, not as a thread
-                    ws.IndexThread = threading.Thread(target=IndexOneWorksheet, args=(tablename, ws, spectuple))
-                    ws.IndexThread.start()  # Start up each worksheet's index build in a separate thread
+                    IndexOneWorksheet(tablename, ws, MapSpecs[OFX][tablename][0])
+                    ws.PKAdded = None
+                    if store is not None and store.Rows(tablename, ws.PKCols, stamp) == ws.max_row:  # Stored index still fits
+                        ws.PKIndex = store.Load(tablename)
+                        ws.PKAdded = {}
+                        ws.PKIndexIsReady = True
+                    elif InProcesses > 0 and ws.max_row > InProcesses:
+                        toscan.append((tablename, ws))
+                    else:
+                        ws.PKIndex = ScanRows(ws.iter_rows(min_row=2, max_row=ws.max_row, values_only=True),
+                                              ws.pkcolnbrs)
+                        ws.PKIndexIsReady = True
+    if toscan:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=min(len(toscan), os.cpu_count() or 1))
+        for tablename, ws in toscan:
+            ws.IndexFuture = pool.submit(ScanWorksheet, wb.workbookname, tablename, ws.pkcolnbrs)
+        pool.shutdown(wait=False)   # The scans already submitted still run to the end
+
+
+def WaitForIndex(ws, tablename):
+    if hasattr(ws, "IndexFuture"):
+        try:
+            ws.PKIndex = ws.IndexFuture.result()
+            ws.PKIndexIsReady = True
+        except Exception as err:
+            raise ConfigurationError('Failed to Create Unique Index for worksheet {0}: {1}'.format(tablename, err))
+        finally:
+            del ws.IndexFuture
+    if not ws.PKIndexIsReady:
+        raise ConfigurationError('Failed to Create Unique Index for worksheet {0}'.format(tablename))
 
 
 class ExcelWBWriter(OFXWriter.Writer):
+    SavedAtFileEnd = False   # The workbook is only saved by OFXAllDone
+
     def __init__(self, plist):
         fn = plist['ExcelFile'] if 'ExcelFile' in plist else None
         fn = path.expandvars(fn)
+        stamp = PKIndexStore.FileStamp(fn)   # Before loading, in case it changes under us
         try:
             self.wb = load_workbook(filename=fn)
         except FileNotFoundError:
@@ -89,47 +138,113 @@ class ExcelWBWriter(OFXWriter.Writer):
         self.destination = re.search(r"[^\\/]+$",fn).group(0)
         super().__init__(plist)
 #  Now that all mapping specs are processed and the spreadsheet is in memory, Index each sheet's primary keys
-        IndexAllWorksheets(self.OFXListDict, self.wb)
+        self.store = PKIndexStore.PKIndexStore(fn + '.pkindex')
+        IndexAllWorksheets(self.OFXListDict, self.wb, self.store, stamp, int(plist.get('IndexInProcesses', '0')))
         self.__anychanges = False
 
     def OFXListEnd(self):
         if self.curOFXList is not None:
             for EachTable in self.curOFXList:
-                datatuple = self.curOFXList[EachTable][0]
-                if EachTable not in self.wb.sheetnames:
-                    ws = self.wb.create_sheet(title=EachTable)
-                    ws.append([i for i in datatuple.Cols ])
-                    for rec in self.curOFXList[EachTable][2]:
-                        ws.append(rec)
-                    self.__anychanges = True
-                    if EachTable not in self.Stats:
-                        self.Stats[EachTable] = [0, 0]  # Update statistics
-                    self.Stats[EachTable][0] += len(self.curOFXList[EachTable][2])
+                self.__WriteSheet(EachTable)
+
+#   ChunkSize: a chunk goes onto the sheet like a whole list.  The first chunk of a new table creates its sheet, and the
+#     chunks after it find the sheet and its index ready.  New sheets are added in the order of the list's tables, as
+#     OFXListEnd would add them, so the tables ahead of this one get their (still empty) sheets first.  The workbook
+#     itself stays in memory until it is saved.
+    def OFXFlushBatch(self, EachTable):
+        for table in self.curOFXList:
+            if table == EachTable:
+                break
+            if table not in self.wb.sheetnames:
+                self.__NewSheet(table, self.curOFXList[table][0], [], [])
+        self.__WriteSheet(EachTable)
+        return True
+
+# A brand new sheet is laid out exactly like the mapping, so its index needs no scan.  Later lists (or files) writing
+#   to the same table then find it ready like any other sheet.
+    def __NewSheet(self, EachTable, datatuple, records, keys):
+        ws = self.wb.create_sheet(title=EachTable)
+        ws.append([i for i in datatuple.Cols ])
+        for rec in records:
+            ws.append(rec)
+        self.__anychanges = True
+        self.TableStats(EachTable)[0] += len(records)  # Update statistics
+        ws.colnbrs = list(range(1, len(datatuple.Cols) + 1))
+        ws.FormulaCols = []
+        ws.PKCols = tuple(datatuple.PKCols)
+        ws.PKIndex = {thisPK: rownum for rownum, thisPK in enumerate(keys, 2)}
+        ws.PKAdded = None
+        ws.PKIndexIsReady = True
+
+    def __WriteSheet(self, EachTable):
+        datatuple = self.curOFXList[EachTable][0]
+        records = self.Records(EachTable)
+        if EachTable not in self.wb.sheetnames:
+            self.__NewSheet(EachTable, datatuple, records, records.Keys())
+        else:
+            ws = self.wb[EachTable]
+            self.TableStats(EachTable)  # Get ready to update statistics
+            origmaxrow = ws.max_row
+            WaitForIndex(ws, EachTable)   # synchronize here with the worker process indexing this worksheet.
+# New rows carry down the formatting (the whole cell style: number format, font, fill...) and the formulas of the last
+#   existing row.  Both are picked up once here rather than copied cell by cell from the row above each new row.
+            if origmaxrow > 1:
+                StyleRow = {destcol: ws.cell(row=origmaxrow, column=destcol)._style for destcol in ws.colnbrs}
+                FormulaRow = {destcol: ws.cell(row=origmaxrow, column=destcol).value for destcol in ws.FormulaCols}
+            else:
+                StyleRow = {}
+                FormulaRow = {}
+            for datarow, thisPK in zip(records, records.Keys()):
+                self.__anychanges = True
+                destrow = ws.PKIndex.get(thisPK)
+                if destrow is None:
+                    destrow = ws.max_row + 1
+                    for newvalue, destcol in zip(datarow, ws.colnbrs):
+                        newcell = ws.cell(row=destrow, column=destcol, value=newvalue)
+                        if destcol in StyleRow:
+                            newcell._style = copy(StyleRow[destcol])
+                    for destcol, formula in FormulaRow.items():  # Fill the formula down for each new col with a formula
+                        ws.cell(row=destrow, column=destcol).value = FillDown(formula, destrow - origmaxrow)
+                    ws.PKIndex[thisPK] = destrow
+                    if ws.PKAdded is not None:
+                        ws.PKAdded[thisPK] = destrow
+                    self.Stats[EachTable][0] += 1
                 else:
-                    ws = self.wb[EachTable]
-                    if EachTable not in self.Stats:
-                        self.Stats[EachTable] = [0, 0]  # Get ready to update statistics
-                    origmaxrow = ws.max_row
-                    if hasattr(ws,"IndexThread"): ws.IndexThread.join()   # synchronize here to the parallel thread indexing this worksheet.
-                    if not ws.PKIndexIsReady:   # Thread ended, but successfully or failure?
-                        raise ConfigurationError('Failed to Create Unique Index for worksheet {0}'.format(EachTable))
-                    for datarow, thisPK in zip(self.curOFXList[EachTable][2], self.curOFXList[EachTable][3]):
-                        self.__anychanges = True
-                        destrow = ws.PKIndex[thisPK] if thisPK in ws.PKIndex else ws.max_row+1
-                        for newvalue, destcol in zip(datarow,ws.colnbrs):
-                            ws.cell(row=destrow, column=destcol).value = newvalue
-                            if destrow > origmaxrow and destrow>1:  # Carry down formatting from above on newly-created rows
-                                ws.cell(row=destrow, column=destcol).number_format\
-                                    = ws.cell(row=destrow-1, column=destcol).number_format
-                                ws.cell(row=destrow, column=destcol).font\
-                                    = copy(ws.cell(row=destrow-1, column=destcol).font)
-                        if destrow > origmaxrow:
-                            for destcol in ws.FormulaCols:   # Copy-Paste the formula directly above for each new col with a formula
-                                ws.cell(row=destrow, column=destcol).value = re.sub(r"(?<!\w)([a-z]{1,3})(\d+)", repl
-                                            , ws.cell(row=destrow-1, column=destcol).value, flags=re.IGNORECASE)
-                            self.Stats[EachTable][0] += 1
-                        else:
-                            self.Stats[EachTable][1] += 1
+                    for newvalue, destcol in zip(datarow, ws.colnbrs):
+                        ws.cell(row=destrow, column=destcol).value = newvalue
+                    self.Stats[EachTable][1] += 1
+
+#   Incremental mode: the latest date per account on a sheet, read from the workbook already in memory.
+    def Watermarks(self, EachTable, datecol, acctcol):
+        if EachTable not in self.wb.sheetnames:
+            return {}
+        ws = self.wb[EachTable]
+        headings = [cell.value for cell in next(ws.iter_rows(min_row=1, max_row=1))]
+        if datecol not in headings or acctcol not in headings:
+            return None
+        d, a = headings.index(datecol), headings.index(acctcol)
+        found = {}
+        for row in ws.iter_rows(min_row=2, values_only=True):
+            latest = OFXWriter.AsDateTime(row[d])
+            if latest is not None and row[a] is not None and (row[a] not in found or latest > found[row[a]]):
+                found[row[a]] = latest
+        return found
 
     def OFXAllDone(self):
-        if self.__anychanges: self.wb.save(self.wb.workbookname)
+        for ws in self.wb.worksheets:   # Sheets not written to this run still get their index stored
+            if hasattr(ws, "IndexFuture"):
+                WaitForIndex(ws, ws.title)
+        if self.__anychanges:
+            self.wb.save(self.wb.workbookname)
+        stamp = PKIndexStore.FileStamp(self.wb.workbookname)
+        try:
+            for ws in self.wb.worksheets:
+                if getattr(ws, 'PKIndexIsReady', False):
+                    if ws.PKAdded is None:
+                        self.store.Replace(ws.title, ws.PKIndex)
+                    else:
+                        self.store.Add(ws.title, ws.PKAdded)
+                    self.store.Mark(ws.title, ws.PKCols, ws.max_row, stamp)
+            self.store.Close()
+        except sqlite3.Error:
+            pass    # The workbook is saved; without its index the next run just scans the sheets again
@@ -0,0 +1,298 @@
+#  The ingest ledger: what has already been loaded, so the same statement is not parsed and merged again only to report
+#  nothing new.  Turned on with Enabled = Yes in [Ledger].
+#
+#  Two things are remembered for each Writer (a file loaded into the CSV files has not been loaded into Postgres):
+#    - a SHA-256 of the content of every statement file processed.  A file whose content was already ingested is
+#      skipped before it is even parsed, whatever it is called now.  Two identical files in one batch count too.
+#    - with SkipOverlap = Yes, for every list context (each account's INVTRANLIST, BANKTRANLIST...) the DTSTART-DTEND
+#      window the statement said it covered, the same DTSTART & DTEND that AddData lifts out of the list into the
+#      context.  A later statement overlapping those dates only pushes the entries dated outside the windows already
+#      ingested for that account and list.  An entry's date is its DTTRADE (investment transactions) or DTPOSTED (bank
+#      and credit card transactions); entries with neither, and lists without DTSTART & DTEND (SECLIST, INVPOSLIST),
+#      are always pushed, and so is the first entry of each list context, so that the data every record carries along
+#      (the account, its balances) still arrives even when all the transactions are old.  This trusts that a statement
+#      holds every transaction in the dates it claims, which is why it is optional.  The Writers' primary key checks
+#      still catch anything that gets through twice.
+#
+#  The ledger is a small SQLite data base.  A file is entered only once the Writer has stored it for good: Record holds
+#  the entry until Commit, which the main program calls after OFXFileEnd for a Writer that saves each file as it ends
+#  (Writer.SavedAtFileEnd) and otherwise only after OFXAllDone (a workbook, CommitEvery = Run).  A run that fails part
+#  way through simply processes again next time every file it had not yet stored.  The ledger is refused for a Writer
+#  whose output does not keep what earlier runs wrote (Writer.Cumulative: a CSV Writer that rewrites its files), as a
+#  file it skips would be missing from the output.
+#
+#  [Ledger] parameters: Enabled, LedgerFile (the data base, created if need be), SkipOverlap.
+#
+#  Incremental = Yes in [common] skips old entries without a ledger: the Writer is asked for the latest entry date its
+#  output already holds for each account (its watermark, see OFXWriter.OFXWatermarks), and entries dated before it are
+#  dropped before they are walked and cast, so a long history file costs about as much as its new tail.  See
+#  WatermarkFilter.  Both can be on at once.
+
+import datetime
+import hashlib
+import re
+import sqlite3
+import time
+from os import path
+import OFXDates
+
+YesValues = ['YES', 'Y', 'TRUE', 'T', 'ENABLED']
+LedgerVersion = 1
+HashChunk = 1 << 20
+EntryDates = ('DTTRADE', 'DTPOSTED')   # Where a list entry's own date is: INVTRAN, STMTTRN
+
+
+def CheckWriter(DataWriter):   # An error message when the ledger cannot be used with this Writer, or None
+    if not DataWriter.Cumulative:
+        return ("The ingest ledger ([Ledger] Enabled = Yes) needs a Writer that keeps what earlier runs wrote; {0} starts"
+                " over each run (for CSV, set Append = Yes or PKIndex = Yes)".format(DataWriter.destination))
+    return None
+
+
+def FromConfig(parameters, writer):
+    plist = parameters['Ledger'] if parameters.has_section('Ledger') else {}
+    if plist.get('Enabled', 'No').upper() not in YesValues:
+        return None
+    return IngestLedger(path.expandvars(plist.get('LedgerFile', 'OFXtoDB.ledger')), writer or 'DataDumper',
+                        plist.get('SkipOverlap', 'No').upper() in YesValues)
+
+
+def WatermarksFromConfig(parameters):
+    if parameters['common'].get('Incremental', 'No').upper() not in YesValues:
+        return None
+    return WatermarkFilter()
+
+
+# Either filter below, both, or none (None), as the main program hands it to ProcessFile.
+def Combine(*filters):
+    filters = [f for f in filters if f is not None]
+    if len(filters) > 1:
+        return Filters(filters)
+    return filters[0] if filters else None
+
+
+def EntryDate(listentry):   # A list entry's own date, or None
+    for dttag in EntryDates:
+        dt = listentry.find('.//' + dttag)
+        if dt is not None:
+            return OFXDates.ToTimestamp(dt.text)
+    return None
+
+
+def ContentHash(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(HashChunk), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Add a window to a list of (start, end) windows, merging any it overlaps.  Kept sorted.
+def MergeWindow(windows, start, end):
+    merged = []
+    for old in sorted(windows + [(start, end)]):
+        if merged and old[0] <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], old[1]))
+        else:
+            merged.append(old)
+    return merged
+
+
+class IngestLedger:
+
+    def __init__(self, filename, writer, SkipOverlap):
+        self.writer = writer
+        self.SkipOverlap = SkipOverlap
+        self.db = sqlite3.connect(filename)
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != LedgerVersion:
+            self.db.executescript("DROP TABLE IF EXISTS Files; DROP TABLE IF EXISTS Windows;")
+            self.db.execute("PRAGMA user_version = {0}".format(LedgerVersion))
+        self.db.execute("CREATE TABLE IF NOT EXISTS Files (writer TEXT, hash TEXT, filename TEXT, bytes INTEGER,"
+                        " ingested TEXT, PRIMARY KEY (writer, hash))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS Windows (writer TEXT, acctid TEXT, ofxlist TEXT, dtstart TEXT,"
+                        " dtend TEXT, PRIMARY KEY (writer, acctid, ofxlist, dtstart))")
+        self.db.commit()
+        self.Hashes = {}   # Statement file -> content hash, for the files this run will process
+        self.Pending = []  # (file, windows) processed but not yet stored by the Writer
+
+#   The files not yet ingested, in order.  The others are reported and left out.
+    def NewFiles(self, OFXFiles):
+        fresh = []
+        thisrun = {}
+        for OFXfile in OFXFiles:
+            try:
+                filehash = ContentHash(OFXfile)
+            except OSError:
+                fresh.append(OFXfile)   # Left for the main program to report as unreadable
+                continue
+            done = self.db.execute("SELECT filename, ingested FROM Files WHERE writer = ? AND hash = ?",
+                                   (self.writer, filehash)).fetchone()
+            if done is not None:
+                print("Skipping {0}: already ingested as {1} on {2}".format(OFXfile, done[0], done[1]))
+            elif filehash in thisrun:
+                print("Skipping {0}: same content as {1}".format(OFXfile, thisrun[filehash]))
+            else:
+                thisrun[filehash] = OFXfile
+                self.Hashes[OFXfile] = filehash
+                fresh.append(OFXfile)
+        return fresh
+
+    def Filter(self):   # The date filter for this run, or None without SkipOverlap
+        if not self.SkipOverlap:
+            return None
+        covered = {}
+        for acctid, OFXList, dtstart, dtend in self.db.execute(
+                "SELECT acctid, ofxlist, dtstart, dtend FROM Windows WHERE writer = ? ORDER BY dtstart", (self.writer,)):
+            covered.setdefault((acctid, OFXList), []).append(
+                (datetime.datetime.fromisoformat(dtstart), datetime.datetime.fromisoformat(dtend)))
+        return DateFilter(covered)
+
+#   Note a file that went through to its OFXFileEnd, with the windows it covered (DateFilter.Windows).  It is entered
+#     at the next Commit, once the Writer has stored it.
+    def Record(self, OFXfile, windows=()):
+        if OFXfile in self.Hashes:
+            self.Pending.append((OFXfile, windows))
+
+    def Commit(self):
+        for OFXfile, windows in self.Pending:
+            self.__Enter(OFXfile, windows)
+        self.Pending = []
+        self.db.commit()
+
+    def Discard(self):   # The Writer threw away what it had not stored yet (OFXFileAbort), so those files are not in
+        self.Pending = []
+
+    def __Enter(self, OFXfile, windows):
+        self.db.execute("INSERT OR REPLACE INTO Files (writer, hash, filename, bytes, ingested) VALUES (?, ?, ?, ?, ?)",
+                        (self.writer, self.Hashes[OFXfile], path.abspath(OFXfile), path.getsize(OFXfile),
+                         time.strftime('%Y-%m-%d %H:%M:%S')))
+        for acctid, OFXList, start, end in windows:
+            known = [(datetime.datetime.fromisoformat(s), datetime.datetime.fromisoformat(e))
+                     for s, e in self.db.execute("SELECT dtstart, dtend FROM Windows"
+                                                 " WHERE writer = ? AND acctid = ? AND ofxlist = ?",
+                                                 (self.writer, acctid, OFXList))]
+            self.db.execute("DELETE FROM Windows WHERE writer = ? AND acctid = ? AND ofxlist = ?",
+                            (self.writer, acctid, OFXList))
+            self.db.executemany("INSERT INTO Windows (writer, acctid, ofxlist, dtstart, dtend) VALUES (?, ?, ?, ?, ?)",
+                                [(self.writer, acctid, OFXList, s.isoformat(' '), e.isoformat(' '))
+                                 for s, e in MergeWindow(known, start, end)])
+
+    def Close(self):
+        self.db.close()
+
+
+# Decides, entry by entry, what is left to push.  It only holds plain data, so it can go to the worker processes of a
+#   parallel batch too (which then filter against what was ingested before the batch started).
+class DateFilter:
+
+    def __init__(self, covered):
+        self.covered = covered   # (ACCTID, OFXList) -> [(start, end)] already ingested
+        self.FileStart()
+
+    def FileStart(self):
+        self.Windows = []   # (ACCTID, OFXList, start, end) of each list context in this file
+        self.Skipped = 0
+        self.__windows = ()
+        self.__first = True
+
+#   A new list context: note its account and window, and which windows entries are checked against.
+    def Context(self, OFXList, listvars):
+        listtag = re.sub(r'^.*?(\w+)$', r'\1', OFXList)
+        found = {}
+        for lv in listvars:
+            if lv.tag == 'ACCTID' and 'ACCTID' not in found:
+                found['ACCTID'] = lv.value
+            elif lv.alttag in (listtag + '/DTSTART', listtag + '/DTEND'):
+                found[lv.tag] = OFXDates.ToTimestamp(lv.value)
+        self.__windows = self.covered.get((found.get('ACCTID'), OFXList), ())
+        self.__first = True
+        if found.get('ACCTID') is not None and found.get('DTSTART') is not None and found.get('DTEND') is not None:
+            self.Windows.append((found['ACCTID'], OFXList, found['DTSTART'], found['DTEND']))
+
+    def Wanted(self, listentry):
+        if self.__first:
+            self.__first = False
+        elif self.__windows:
+            when = EntryDate(listentry)
+            if when is not None and any(start <= when <= end for start, end in self.__windows):
+                self.Skipped += 1
+                return False
+        return True
+
+    def Add(self, windows):   # Later files of a sequential batch are checked against the earlier ones too
+        for acctid, OFXList, start, end in windows:
+            key = (acctid, OFXList)
+            self.covered[key] = MergeWindow(list(self.covered.get(key, ())), start, end)
+
+
+# Incremental mode.  An entry dated before the watermark of its account and list (the latest date already in every table
+#   the list feeds) is skipped; one dated on the watermark itself still goes, as a statement can add to its last day.  As
+#   with DateFilter, the first entry of each list context always goes through.  Refresh asks the Writer again, which the
+#   main program does before each file of a sequential batch; the worker processes of a parallel batch get the
+#   watermarks as they were when the batch started.
+class WatermarkFilter:
+
+    def __init__(self):
+        self.marks = {}   # OFXList -> (account converter, {account: watermark})
+        self.FileStart()
+
+    def Refresh(self, DataWriter):
+        self.marks = DataWriter.OFXWatermarks(EntryDates)
+
+    def FileStart(self):
+        self.Windows = []   # Only the ledger's DateFilter has windows to record
+        self.Skipped = 0
+        self.__mark = None
+        self.__first = True
+
+    def Context(self, OFXList, listvars):
+        self.__mark = None
+        self.__first = True
+        if OFXList in self.marks:
+            acctconv, marks = self.marks[OFXList]
+            for lv in listvars:
+                if lv.tag == 'ACCTID':
+                    self.__mark = marks.get(str(acctconv(lv.value)))
+                    break
+
+    def Wanted(self, listentry):
+        if self.__first:
+            self.__first = False
+        elif self.__mark is not None:
+            when = EntryDate(listentry)
+            if when is not None and when < self.__mark:
+                self.Skipped += 1
+                return False
+        return True
+
+    def Add(self, windows):
+        return
+
+
+class Filters:   # Several filters at once: an entry goes through only when each of them lets it
+
+    def __init__(self, filters):
+        self.filters = filters
+
+    @property
+    def Windows(self):
+        return [window for f in self.filters for window in f.Windows]
+
+    @property
+    def Skipped(self):
+        return sum(f.Skipped for f in self.filters)
+
+    def FileStart(self):
+        for f in self.filters:
+            f.FileStart()
+
+    def Context(self, OFXList, listvars):
+        for f in self.filters:
+            f.Context(OFXList, listvars)
+
+    def Wanted(self, listentry):
+        return all(f.Wanted(listentry) for f in self.filters)
+
+    def Add(self, windows):
+        for f in self.filters:
+            f.Add(windows)
@@ -0,0 +1,453 @@
+#  Benchmark harness.  It writes a synthetic statement file of whatever size and mix is asked for (investment
+#  transactions, positions, securities, bank and credit card transactions, closing statements), runs it through the
+#  same code path OFXtoDB.py uses, once per Writer and parser, and reports how long each stage took:
+#    parse          reading the file into a tree (OFXTree.parse), or just opening it for Parser = Stream
+#    writer_init    building the Writer, mapping included
+#    add_data       collecting the context data around each list (AddData)
+#    walk           walking each list entry (WalkElementTree.Walk, ProcessListEntry), i.e. ProcessEntry less the Writer calls
+#                   (with Parser = Stream, the lists after the first are flattened on the side, so their OFXPutData and
+#                   OFXRecStart/End are counted here)
+#    put_data       OFXPutData: matching each element to its table columns and converting its value
+#    rec_start_end  OFXRecStart and OFXRecEnd (record set-up, duplicate check)
+#    list_end       OFXListEnd, where most Writers do their writing
+#    file_end       OFXFileStart and OFXFileEnd
+#    all_done       OFXAllDone (commit, workbook save...)
+#    other          everything else; with Parser = Stream that is mostly the tokenizing of the survey and list passes
+#    total          the whole run, wall clock
+#  and, separately, what starting the program costs with that Writer and parser (see ColdStart):
+#    cold_start     a fresh interpreter, from nothing to OFXtoDB, the Writer's module and the parser imported
+#    imports        the imports alone, as timed inside that interpreter
+#  Each stage is timed by wrapping the functions and Writer methods involved, which adds a fraction of a microsecond per
+#  call.  That is the same for every run, so runs compare fairly with each other.
+#
+#  The results go to a JSON report (--report) so they can be kept and compared over time, and a summary is printed.
+#  The benchmark works in a scratch directory of its own, with an OFXtoData.ini made from the mapping of dist/OFXtoDB.ini
+#  (or --ini), so it neither reads nor touches your real configuration and data.  For the Postgres Writer it sets up a
+#  throwaway server there with initdb and pg_ctl (from --pg-bin or the PATH), creates the tables from the [Table:...]
+#  sections, and shuts it down afterwards.  Writers whose packages are not installed are reported as skipped.
+#
+#  python OFXBench.py --transactions 20000 --banktrans 20000 --writers CSV,SQLite,Postgres --report bench.json
+
+import argparse
+import configparser
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from xml.sax.saxutils import escape
+
+Here = os.path.dirname(os.path.abspath(__file__))
+
+SGMLHeader = ("OFXHEADER:100\nDATA:OFXSGML\nVERSION:102\nSECURITY:NONE\nENCODING:USASCII\nCHARSET:1252\n"
+              "COMPRESSION:NONE\nOLDFILEUID:NONE\nNEWFILEUID:NONE\n\n")
+XMLHeader = ('<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n'
+             '<?OFX OFXHEADER="200" VERSION="220" SECURITY="NONE" OLDFILEUID="NONE" NEWFILEUID="NONE"?>\n')
+PGTypes = {'S': 'text', 'E': 'text', 'N': 'numeric', 'D': 'timestamp', 'DATE': 'date', 'B': 'boolean'}
+
+
+# Build the statement as nested (tag, text-or-children) and print it in either dialect: OFX 1.x SGML leaves data
+#   elements unclosed, OFX 2.x XML closes everything (and, being XML, has its &s and <s escaped).
+def Render(node, sgml, out):
+    tag, content = node
+    if isinstance(content, list):
+        out.append('<{0}>'.format(tag))
+        for child in content:
+            Render(child, sgml, out)
+        out.append('</{0}>\n'.format(tag))
+    elif sgml:
+        out.append('<{0}>{1}'.format(tag, content))
+    else:
+        out.append('<{0}>{1}</{0}>'.format(tag, escape(str(content))))
+
+
+def OFXDate(day, rng, timed=True):
+    if not timed:
+        return day.strftime('%Y%m%d')
+    return day.strftime('%Y%m%d') + '{0:02d}{1:02d}00.000[-5:EST]'.format(rng.randrange(8, 18), rng.randrange(60))
+
+
+def Amount(rng, low, high):
+    return '{0:.2f}'.format(rng.uniform(low, high))
+
+
+def GenerateOFX(filename, transactions=1000, positions=50, securities=50, banktrans=1000, cctrans=500, closings=0,
+                accounts=1, sgml=True, seed=1):
+    rng = random.Random(seed)
+    start = datetime.date(2020, 1, 1)
+    days = [start + datetime.timedelta(days=n) for n in range(1500)]
+    cusips = ['{0:09d}'.format(100000000 + n * 7919) for n in range(max(securities, 1))]
+    names = ['Grocery', 'Fuel & Co', 'Coffee', 'Payroll', 'Rent', 'Utility, Inc.', 'Transfer', 'ATM', 'Pharmacy']
+    signon = ('SIGNONMSGSRSV1', [('SONRS', [('STATUS', [('CODE', '0'), ('SEVERITY', 'INFO')]),
+                                            ('DTSERVER', OFXDate(days[-1], rng)), ('LANGUAGE', 'ENG'),
+                                            ('FI', [('ORG', 'BenchBank'), ('FID', '9999')])])])
+    body = [signon]
+
+    def Split(n):   # n entries spread over the accounts
+        return [n // accounts + (1 if a < n % accounts else 0) for a in range(accounts)]
+
+    def BankTrans(n, prefix):
+        entries = []
+        for i in range(n):
+            amount = Amount(rng, -500, 500)
+            entry = [('TRNTYPE', 'DEBIT' if amount.startswith('-') else 'CREDIT'),
+                     ('DTPOSTED', OFXDate(rng.choice(days), rng)), ('TRNAMT', amount),
+                     ('FITID', '{0}{1:08d}'.format(prefix, i)), ('NAME', rng.choice(names))]
+            if rng.random() < 0.3:
+                entry.append(('MEMO', 'Memo {0}'.format(rng.randrange(100))))
+            entries.append(('STMTTRN', entry))
+        return entries
+
+    def Balances():
+        return [('LEDGERBAL', [('BALAMT', Amount(rng, 0, 9000)), ('DTASOF', OFXDate(days[-1], rng))]),
+                ('AVAILBAL', [('BALAMT', Amount(rng, 0, 9000)), ('DTASOF', OFXDate(days[-1], rng))])]
+
+    def TranList(entries):
+        return [('DTSTART', OFXDate(days[0], rng, False)), ('DTEND', OFXDate(days[-1], rng, False))] + entries
+
+    if banktrans or closings:
+        bank = []
+        for a, n in enumerate(Split(banktrans)):
+            acct = [('BANKID', '011000015'), ('ACCTID', '1000{0:04d}'.format(a)), ('ACCTTYPE', 'CHECKING')]
+            if banktrans:
+                bank.append(('STMTTRNRS', [('TRNUID', str(a)), ('STATUS', [('CODE', '0'), ('SEVERITY', 'INFO')]),
+                                           ('STMTRS', [('CURDEF', 'USD'), ('BANKACCTFROM', acct),
+                                                       ('BANKTRANLIST', TranList(BankTrans(n, 'B{0}-'.format(a))))]
+                                            + Balances())]))
+            if closings:
+                bank.append(('STMTENDTRNRS', [('TRNUID', 'C{0}'.format(a)),
+                                              ('STATUS', [('CODE', '0'), ('SEVERITY', 'INFO')]),
+                                              ('STMTENDRS', [('CURDEF', 'USD'), ('BANKACCTFROM', acct)] + [
+                                                  ('CLOSING', [('FITID', 'CL{0}-{1}'.format(a, c)),
+                                                               ('DTOPEN', OFXDate(days[c * 30 % len(days)], rng, False)),
+                                                               ('DTCLOSE', OFXDate(days[(c * 30 + 29) % len(days)], rng, False)),
+                                                               ('BALOPEN', Amount(rng, 0, 9000)),
+                                                               ('BALCLOSE', Amount(rng, 0, 9000)),
+                                                               ('DTPOSTSTART', OFXDate(days[c * 30 % len(days)], rng, False)),
+                                                               ('DTPOSTEND', OFXDate(days[(c * 30 + 29) % len(days)], rng, False))])
+                                                  for c in range(closings)])]))
+        body.append(('BANKMSGSRSV1', bank))
+    if cctrans:
+        body.append(('CREDITCARDMSGSRSV1', [
+            ('CCSTMTTRNRS', [('TRNUID', str(a)), ('STATUS', [('CODE', '0'), ('SEVERITY', 'INFO')]),
+                             ('CCSTMTRS', [('CURDEF', 'USD'), ('CCACCTFROM', [('ACCTID', '4000{0:04d}'.format(a))]),
+                                           ('BANKTRANLIST', TranList(BankTrans(n, 'C{0}-'.format(a))))] + Balances())])
+            for a, n in enumerate(Split(cctrans))]))
+    if transactions or positions:
+        inv = []
+        for a, (ntran, npos) in enumerate(zip(Split(transactions), Split(positions))):
+            trans = []
+            for i in range(ntran):
+                fitid = 'I{0}-{1:08d}'.format(a, i)
+                day = rng.choice(days)
+                invtran = ('INVTRAN', [('FITID', fitid), ('DTTRADE', OFXDate(day, rng)),
+                                       ('DTSETTLE', OFXDate(day + datetime.timedelta(days=2), rng))])
+                secid = ('SECID', [('UNIQUEID', rng.choice(cusips)), ('UNIQUEIDTYPE', 'CUSIP')])
+                units = '{0:.3f}'.format(rng.uniform(1, 500))
+                price = '{0:.4f}'.format(rng.uniform(5, 400))
+                total = '{0:.2f}'.format(float(units) * float(price))
+                kind = rng.random()
+                if kind < 0.3:
+                    trans.append(('BUYSTOCK', [('INVBUY', [invtran, secid, ('UNITS', units), ('UNITPRICE', price),
+                                                           ('COMMISSION', '4.95'), ('TOTAL', '-' + total),
+                                                           ('SUBACCTSEC', 'CASH'), ('SUBACCTFUND', 'CASH')]),
+                                               ('BUYTYPE', 'BUY')]))
+                elif kind < 0.5:
+                    trans.append(('SELLSTOCK', [('INVSELL', [invtran, secid, ('UNITS', '-' + units),
+                                                             ('UNITPRICE', price), ('FEES', '0.05'), ('TOTAL', total),
+                                                             ('SUBACCTSEC', 'CASH'), ('SUBACCTFUND', 'CASH')]),
+                                                ('SELLTYPE', 'SELL')]))
+                elif kind < 0.65:
+                    trans.append(('BUYMF', [('INVBUY', [invtran, secid, ('UNITS', units), ('UNITPRICE', price),
+                                                        ('TOTAL', '-' + total), ('SUBACCTSEC', 'CASH'),
+                                                        ('SUBACCTFUND', 'CASH')]), ('BUYTYPE', 'BUY')]))
+                elif kind < 0.8:
+                    trans.append(('INCOME', [invtran, secid, ('INCOMETYPE', 'DIV'), ('TOTAL', Amount(rng, 1, 300)),
+                                             ('SUBACCTSEC', 'CASH'), ('SUBACCTFUND', 'CASH')]))
+                elif kind < 0.9:
+                    trans.append(('REINVEST', [invtran, secid, ('INCOMETYPE', 'DIV'), ('TOTAL', '-' + total),
+                                               ('SUBACCTSEC', 'CASH'), ('UNITS', units), ('UNITPRICE', price)]))
+                else:
+                    amount = Amount(rng, -2000, 2000)
+                    trans.append(('INVBANKTRAN', [('STMTTRN', [('TRNTYPE', 'DEP' if amount[0] != '-' else 'DEBIT'),
+                                                               ('DTPOSTED', OFXDate(day, rng)), ('TRNAMT', amount),
+                                                               ('FITID', fitid), ('NAME', rng.choice(names))]),
+                                                  ('SUBACCTFUND', 'CASH')]))
+            poslist = []
+            for i in range(npos):
+                kind = 'POSSTOCK' if i % 2 else 'POSMF'
+                units = '{0:.3f}'.format(rng.uniform(1, 5000))
+                price = '{0:.4f}'.format(rng.uniform(5, 400))
+                invpos = ('INVPOS', [('SECID', [('UNIQUEID', cusips[i % len(cusips)]), ('UNIQUEIDTYPE', 'CUSIP')]),
+                                     ('HELDINACCT', 'CASH'), ('POSTYPE', 'LONG'), ('UNITS', units),
+                                     ('UNITPRICE', price), ('MKTVAL', '{0:.2f}'.format(float(units) * float(price))),
+                                     ('DTPRICEASOF', OFXDate(days[-1], rng))])
+                poslist.append((kind, [invpos, ('REINVDIV', 'Y')] if kind == 'POSMF' else [invpos]))
+            stmt = [('DTASOF', OFXDate(days[-1], rng)), ('CURDEF', 'USD'),
+                    ('INVACCTFROM', [('BROKERID', 'bench.example.com'), ('ACCTID', 'INV{0:04d}'.format(a))])]
+            if ntran:
+                stmt.append(('INVTRANLIST', TranList(trans)))
+            if npos:
+                stmt.append(('INVPOSLIST', poslist))
+            stmt.append(('INVBAL', [('AVAILCASH', Amount(rng, 0, 9000)), ('MARGINBALANCE', '0'), ('SHORTBALANCE', '0')]))
+            inv.append(('INVSTMTTRNRS', [('TRNUID', str(a)), ('STATUS', [('CODE', '0'), ('SEVERITY', 'INFO')]),
+                                         ('INVSTMTRS', stmt)]))
+        body.append(('INVSTMTMSGSRSV1', inv))
+    if securities:
+        seclist = []
+        for i, cusip in enumerate(cusips[:securities]):
+            secinfo = ('SECINFO', [('SECID', [('UNIQUEID', cusip), ('UNIQUEIDTYPE', 'CUSIP')]),
+                                   ('SECNAME', 'Bench Security {0}'.format(i)), ('TICKER', 'B{0:04d}'.format(i))])
+            if i % 2:
+                seclist.append(('STOCKINFO', [secinfo, ('STOCKTYPE', 'COMMON')]))
+            else:
+                seclist.append(('MFINFO', [secinfo, ('MFTYPE', 'OPENEND')]))
+        body.append(('SECLISTMSGSRSV1', [('SECLIST', seclist)]))
+    out = [SGMLHeader if sgml else XMLHeader]
+    Render(('OFX', body), sgml, out)
+    with open(filename, 'w', encoding='ascii', newline='\r\n' if sgml else '\n') as f:
+        f.write(''.join(out))
+    return os.path.getsize(filename)
+
+
+# A scratch OFXtoData.ini: the mapping and table sections of the template, plus the given Writer sections.
+def WriteIni(workdir, template, writer, parser, sections):
+    cf = configparser.ConfigParser(allow_no_value=True, interpolation=None)
+    cf.optionxform = lambda option: option
+    cf.read(template)
+    for section in list(cf.sections()):
+        if section not in ('Mapping', 'OFXListUniverse') and not section.startswith('Table:'):
+            cf.remove_section(section)
+    cf['common'] = {'TimeZone': 'America/New_York', 'Writer': writer, 'Parser': parser}
+    for section, values in sections.items():
+        cf[section] = values
+    with open(os.path.join(workdir, 'OFXtoData.ini'), 'w') as f:
+        cf.write(f)
+    return cf
+
+
+# A throwaway Postgres server in the scratch directory, listening only on a Unix socket there.
+class ScratchPostgres:
+    def __init__(self, workdir, bindir, port=54329):
+        self.bindir = bindir
+        self.datadir = os.path.join(workdir, 'pgdata')
+        self.port = port
+        self.socketdir = workdir
+        self.started = False
+
+    def Tool(self, name):
+        found = shutil.which(name, path=self.bindir) if self.bindir else shutil.which(name)
+        if found is None:
+            raise RuntimeError("{0} not found; give the Postgres bin directory with --pg-bin".format(name))
+        return found
+
+    def Start(self):
+        subprocess.run([self.Tool('initdb'), '-D', self.datadir, '-U', 'postgres', '-A', 'trust', '--no-sync'],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+        subprocess.run([self.Tool('pg_ctl'), '-D', self.datadir, '-w', '-l', os.path.join(self.socketdir, 'pg.log'),
+                        '-o', "-p {0} -k {1} -c listen_addresses='' -c fsync=off".format(self.port, self.socketdir),
+                        'start'], check=True, stdout=subprocess.DEVNULL)
+        self.started = True
+
+    def Stop(self):
+        if self.started:
+            subprocess.run([self.Tool('pg_ctl'), '-D', self.datadir, '-m', 'fast', 'stop'],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self.started = False
+
+    def CreateTables(self, cf):
+        import psycopg2
+        session = psycopg2.connect(host=self.socketdir, port=self.port, dbname='postgres', user='postgres')
+        curs = session.cursor()
+        for section in cf.sections():
+            if section.startswith('Table:'):
+                table = section[len('Table:'):]
+                cols = []
+                pks = []
+                for col, coldefs in cf.items(section):
+                    cd = [c.strip() for c in (coldefs or 'S').split(',')]
+                    cols.append('"{0}" {1}'.format(col, PGTypes.get(cd[0], 'text')))
+                    if len(cd) > 1 and cd[1] == 'PK':
+                        pks.append('"{0}"'.format(col))
+                curs.execute('Drop Table If Exists public."{0}"'.format(table))
+                curs.execute('Create Table public."{0}" ({1}{2})'.format(
+                    table, ', '.join(cols), ', Primary Key ({0})'.format(', '.join(pks)) if pks else ''))
+        session.commit()
+        session.close()
+
+    def Section(self):
+        return {'host': self.socketdir, 'port': str(self.port), 'dbname': 'postgres', 'user': 'postgres',
+                'schema': 'public', 'mapping': 'UseIniFile', 'MappingCache': 'Off'}
+
+
+# Wrap a callable so the time spent in it is added to timings[stage].
+def Timed(function, stage, timings):
+    clock = time.perf_counter
+    def timed(*args, **kwargs):
+        started = clock()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            timings[stage] += clock() - started
+    return timed
+
+
+Stages = ['parse', 'writer_init', 'add_data', 'walk', 'put_data', 'rec_start_end', 'list_end', 'file_end', 'all_done',
+          'other', 'total']
+
+
+# Cold start, as a scheduler running OFXtoDB once per file pays it before the first byte of a statement is read: a new
+#   interpreter imports OFXtoDB, the chosen Writer's module and (for OFXTree) ofxtools.  The fastest of repeat tries.
+ColdStartCode = ("import time; started = time.perf_counter(); import OFXtoDB, ChooseWriter; ChooseWriter.WriterClass({0!r}); "
+                 "{1}print(time.perf_counter() - started)")
+
+
+def ColdStart(writer, parser, repeat):
+    code = ColdStartCode.format(writer, 'import ofxtools; ' if parser == 'OFXTree' else '')
+    best = None
+    for n in range(repeat):
+        started = time.perf_counter()
+        done = subprocess.run([sys.executable, '-c', code], cwd=Here, capture_output=True, text=True, check=True)
+        tried = (time.perf_counter() - started, float(done.stdout.split()[-1]))
+        if best is None or tried[0] < best[0]:
+            best = tried
+    return {'cold_start': round(best[0], 6), 'imports': round(best[1], 6)}
+
+
+# One run of one file through one Writer, the way OFXtoDB.main does it for a single file.  Returns stage timings and
+#   the Writer's Stats.
+def RunOnce(OFXfile, workdir):
+    import OFXGlobals
+    import OFXtoDB
+    timings = dict.fromkeys(Stages, 0.0)
+    saved = (OFXtoDB.AddData, OFXtoDB.ProcessEntry)
+    here = os.getcwd()
+    os.chdir(workdir)
+    try:
+        started = time.perf_counter()
+        parameters = OFXtoDB.Configure(['OFXBench', OFXfile])
+        FIStmt = Timed(OFXtoDB.ReadOFXFile, 'parse', timings)(OFXfile)
+        OFXGlobals.InThisFile = OFXtoDB.ListsInFile(FIStmt, OFXGlobals.KnownLists)
+        DataWriter = Timed(OFXtoDB.MakeWriter, 'writer_init', timings)(parameters)
+        OFXtoDB.AddData = Timed(saved[0], 'add_data', timings)
+        OFXtoDB.ProcessEntry = Timed(saved[1], 'walk', timings)
+        for method, stage in (('OFXPutData', 'put_data'), ('OFXRecStart', 'rec_start_end'),
+                              ('OFXRecEnd', 'rec_start_end'), ('OFXListEnd', 'list_end'),
+                              ('OFXFileStart', 'file_end'), ('OFXFileEnd', 'file_end'), ('OFXAllDone', 'all_done')):
+            setattr(DataWriter, method, Timed(getattr(DataWriter, method), stage, timings))
+        DataWriter.OFXFileStart(OFXfile)
+        OFXtoDB.ProcessFile(FIStmt, DataWriter)
+        DataWriter.OFXFileEnd()
+        DataWriter.OFXAllDone()
+        timings['total'] = time.perf_counter() - started
+    finally:
+        OFXtoDB.AddData, OFXtoDB.ProcessEntry = saved
+        os.chdir(here)
+    timings['walk'] -= timings['put_data'] + timings['rec_start_end']   # ProcessEntry less the Writer calls in it
+    timings['other'] = timings['total'] - sum(timings[stage] for stage in Stages if stage not in ('other', 'total'))
+    return timings, {table: list(t) for table, t in DataWriter.Stats.items()}
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(description="Benchmark OFXtoDB on a synthetic statement file")
+    ap.add_argument('--transactions', type=int, default=5000, help="INVTRANLIST entries")
+    ap.add_argument('--positions', type=int, default=200, help="INVPOSLIST entries")
+    ap.add_argument('--securities', type=int, default=200, help="SECLIST entries")
+    ap.add_argument('--banktrans', type=int, default=5000, help="BANKTRANLIST entries (bank accounts)")
+    ap.add_argument('--cctrans', type=int, default=2000, help="BANKTRANLIST entries (credit card accounts)")
+    ap.add_argument('--closings', type=int, default=0, help="CLOSING entries per bank account")
+    ap.add_argument('--accounts', type=int, default=1, help="accounts of each kind the entries are spread over")
+    ap.add_argument('--format', choices=('sgml', 'xml'), default='sgml', help="OFX 1.x SGML or OFX 2.x XML")
+    ap.add_argument('--seed', type=int, default=1)
+    ap.add_argument('--writers', default='CSV,SQLite', help="comma separated: CSV, SQLite, Parquet, Excel, Postgres")
+    ap.add_argument('--parsers', default='OFXTree', help="comma separated: OFXTree, Stream")
+    ap.add_argument('--repeat', type=int, default=3, help="runs per Writer and parser; the fastest is reported")
+    ap.add_argument('--ini', default=os.path.join(Here, 'dist', 'OFXtoDB.ini'), help="where the mapping comes from")
+    ap.add_argument('--pg-bin', default=None, help="directory of initdb and pg_ctl")
+    ap.add_argument('--workdir', default=None, help="scratch directory to use (and keep) instead of a temporary one")
+    ap.add_argument('--report', default=None, help="write the results to this JSON file")
+    args = ap.parse_args(argv[1:])
+
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='OFXBench')
+    os.makedirs(workdir, exist_ok=True)
+    sys.path.insert(0, Here)
+    import OFXWriter   # For ConfigurationError, which a Writer raises when its package is missing
+    OFXfile = os.path.join(workdir, 'bench.qfx')
+    started = time.perf_counter()
+    size = GenerateOFX(OFXfile, args.transactions, args.positions, args.securities, args.banktrans, args.cctrans,
+                       args.closings, args.accounts, args.format == 'sgml', args.seed)
+    report = {'when': datetime.datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(), 'platform': platform.platform(),
+              'input': {'format': args.format, 'bytes': size, 'transactions': args.transactions,
+                        'positions': args.positions, 'securities': args.securities, 'banktrans': args.banktrans,
+                        'cctrans': args.cctrans, 'closings': args.closings, 'accounts': args.accounts,
+                        'seed': args.seed, 'generate_seconds': round(time.perf_counter() - started, 4)},
+              'runs': []}
+    postgres = None
+    try:
+        for writer in [w.strip() for w in args.writers.split(',') if w.strip()]:
+            for parser in [p.strip() for p in args.parsers.split(',') if p.strip()]:
+                run = {'writer': writer, 'parser': parser}
+                report['runs'].append(run)
+                outdir = os.path.join(workdir, 'out-{0}-{1}'.format(writer, parser))
+                sections = {'CSV': {'WriteToDirectory': outdir, 'Headers': 'YES', 'WhenToQuote': 'SeparatorOnly',
+                                    'ExcelCompatibility': 'Yes', 'QuoteChar': '"', 'ColumnSeparator': ','},
+                            'SQLite': {'Database': os.path.join(outdir, 'bench.sqlite')},
+                            'Parquet': {'WriteToDirectory': outdir},
+                            'Excel': {'ExcelFile': os.path.join(outdir, 'bench.xlsx')}}
+                try:
+                    run['startup'] = ColdStart(writer, parser, args.repeat)
+                    if writer == 'Postgres':
+                        if postgres is None:
+                            postgres = ScratchPostgres(workdir, args.pg_bin)
+                            postgres.Start()
+                        sections['Postgres'] = postgres.Section()
+                    cf = WriteIni(workdir, args.ini, writer, parser, sections)
+                    best = None
+                    for n in range(args.repeat):
+                        shutil.rmtree(outdir, ignore_errors=True)
+                        os.makedirs(outdir)
+                        if writer == 'Postgres':
+                            postgres.CreateTables(cf)
+                        timings, stats = RunOnce(OFXfile, workdir)
+                        if best is None or timings['total'] < best['total']:
+                            best = timings
+                    run['seconds'] = {stage: round(best[stage], 6) for stage in Stages}
+                    run['stats'] = stats
+                    records = sum(t[0] + t[1] for t in stats.values())
+                    run['records'] = records
+                    run['records_per_second'] = round(records / best['total']) if best['total'] > 0 else None
+                except (ImportError, RuntimeError, subprocess.CalledProcessError, SystemExit,
+                        OFXWriter.ConfigurationError) as err:
+                    run['skipped'] = str(err) or type(err).__name__
+    finally:
+        if postgres is not None:
+            postgres.Stop()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print("{0} ({1:,} bytes, {2})".format(os.path.basename(OFXfile), size, args.format))
+    print("{0:18}".format('seconds') + ''.join('{0:>14}'.format(r['writer'] + '/' + r['parser'][:4])
+                                              for r in report['runs']))
+    for stage in Stages:
+        print("{0:18}".format(stage) + ''.join('{0:>14.4f}'.format(r['seconds'][stage]) if 'seconds' in r
+                                               else '{0:>14}'.format('skipped') for r in report['runs']))
+    for stage in ('cold_start', 'imports'):
+        print("{0:18}".format(stage) + ''.join('{0:>14.4f}'.format(r['startup'][stage]) if 'startup' in r
+                                               else '{0:>14}'.format('skipped') for r in report['runs']))
+    for r in report['runs']:
+        if 'skipped' in r:
+            print("{0}/{1} skipped: {2}".format(r['writer'], r['parser'], r['skipped']))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    main(sys.argv)
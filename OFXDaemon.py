@@ -0,0 +1,189 @@
+#  Long-running ingest service.  Where OFXtoDB.py pays for interpreter start-up, the .ini, a data base connection and
+#  the mapping load on every run, this keeps one Writer (with its compiled mapping, and for Postgres a small connection
+#  pool) alive and feeds it statement files as they turn up, so each file costs only its own parse and write.
+#
+#  Files arrive two ways:
+#    - dropped into the watch directory (the command line argument, or WatchDirectory in [Daemon]).  A file is picked
+#      up once its size and time stamp have been still for SettleSeconds, so half-downloaded files are left alone.
+#      Afterwards it is moved into the Done or Failed subdirectory.
+#    - sent over a local TCP socket (SocketPort in [Daemon], 0 for none).  Anyone on the machine can reach the port, so
+#      the first line of each connection must be the SocketToken from [Daemon], or the connection is refused.  Then one
+#      file path per line, answered with "queued <path>".  Paths are taken relative to the watch directory and must
+#      lie inside it (in a subdirectory, say, which is not polled), so the service cannot be made to read anything
+#      else its account can.  Those files are left where they are.
+#  Each file is committed on its own (the Postgres Writer runs with CommitEvery = File) and its Add/Update counts are
+#  printed as it finishes.  Stop the service with Ctrl-C; the Writer is then closed out normally.
+#  With the ingest ledger on ([Ledger] in the .ini, see IngestLedger.py) a file already ingested goes straight to Done.
+#
+#  Only Writers whose output is complete at the end of each file make sense here, so the Excel Writer (which saves the
+#  workbook only when everything is done) is refused.
+
+import sys
+import os
+import time
+import queue
+import shutil
+import socketserver
+import threading
+import hmac
+import OFXGlobals
+import OFXtoDB
+import OFXMetrics
+import IngestLedger
+
+DaemonWriters = ('Postgres', 'SQLite', 'CSV', 'Parquet')
+
+
+class QueueHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        token = self.rfile.readline().strip()
+        if not hmac.compare_digest(token, self.server.token):
+            self.wfile.write(b"refused: wrong token\n")
+            return
+        for line in self.rfile:
+            OFXfile = line.decode('utf-8', errors='replace').strip()
+            if OFXfile:
+                inside = InWatchDirectory(OFXfile, self.server.watchdir)
+                if inside is None:
+                    self.wfile.write("refused {0}: not in the watch directory\n".format(OFXfile).encode('utf-8'))
+                    continue
+                self.server.arrivals.put(inside)
+                self.wfile.write("queued {0}\n".format(inside).encode('utf-8'))
+
+
+# A path sent over the socket, taken relative to the watch directory and with any links followed, or None when it ends
+#   up outside the watch directory.
+def InWatchDirectory(OFXfile, watchdir):
+    root = os.path.realpath(watchdir)
+    OFXfile = os.path.realpath(os.path.join(root, OFXfile))
+    try:
+        return OFXfile if os.path.commonpath([root, OFXfile]) == root else None
+    except ValueError:   # Another drive
+        return None
+
+
+def StartSocket(port, arrivals, token, watchdir):
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', port), QueueHandler)
+    server.daemon_threads = True
+    server.arrivals = arrivals
+    server.token = token.encode('utf-8')
+    server.watchdir = watchdir
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Files in the watch directory that have been still long enough, oldest first.  seen remembers each file's last
+#   (size, mtime) between polls.
+def SettledFiles(watchdir, seen, settle):
+    now = time.time()
+    ready = []
+    for fn in os.listdir(watchdir):
+        OFXfile = os.path.join(watchdir, fn)
+        if not fn.lower().endswith(OFXtoDB.OFXFileTypes) or not os.path.isfile(OFXfile):
+            continue
+        st = os.stat(OFXfile)
+        if seen.get(OFXfile) == (st.st_size, st.st_mtime) and now - st.st_mtime >= settle:
+            ready.append((st.st_mtime, OFXfile))
+        seen[OFXfile] = (st.st_size, st.st_mtime)
+    return [OFXfile for mtime, OFXfile in sorted(ready)]
+
+
+def MoveTo(OFXfile, subdir):
+    os.makedirs(subdir, exist_ok=True)
+    shutil.move(OFXfile, os.path.join(subdir, os.path.basename(OFXfile)))
+
+
+def Ingest(OFXfile, DataWriter, metrics, ledger, watermarks):
+    before = {table: list(t) for table, t in DataWriter.Stats.items()}
+    Filter = None
+    try:
+        if ledger is not None and not ledger.NewFiles([OFXfile]):   # Already ingested: done, as far as anyone cares
+            return True
+        with metrics.Stage('parse'):
+            FIStmt = OFXtoDB.ReadOFXFile(OFXfile)
+        metrics.FileRead(OFXfile)
+        DataWriter.OFXFileStart(OFXfile)
+        if watermarks is not None:
+            watermarks.Refresh(DataWriter)
+        Filter = IngestLedger.Combine(ledger.Filter() if ledger is not None else None, watermarks)
+        if Filter is not None:
+            Filter.FileStart()
+        with metrics.Stage('process'):
+            OFXtoDB.ProcessFile(FIStmt, DataWriter, Filter)
+        DataWriter.OFXFileEnd()
+        if ledger is not None:
+            ledger.Record(OFXfile, Filter.Windows if Filter is not None else ())
+            if DataWriter.SavedAtFileEnd:
+                ledger.Commit()
+    except Exception as err:
+        DataWriter.OFXFileAbort()
+        if ledger is not None:
+            ledger.Discard()   # Only files not yet stored are waiting, and the abort took them too
+        metrics.Report(DataWriter)
+        print("{0}  {1}: failed - {2}".format(time.strftime('%Y-%m-%d %H:%M:%S'), os.path.basename(OFXfile), err))
+        return False
+    print("{0}  {1}{2}".format(time.strftime('%Y-%m-%d %H:%M:%S'), os.path.basename(OFXfile),
+                               "  ({0} entries already loaded skipped)".format(Filter.Skipped) if Filter else ""))
+    for table, t in OFXtoDB.StatsDelta(before, DataWriter.Stats).items():
+        if any(t):
+            print("  {0:23}{1:>10d}{2:>10d}{3:>10d}".format(table, t[0], t[1], t[2]))
+    sys.stdout.flush()
+    metrics.Report(DataWriter)   # The figures since the service started, refreshed after every file
+    return True
+
+
+def main(argv):
+    parameters = OFXtoDB.Configure(argv)
+    daemon = parameters['Daemon']
+    watchdir = os.path.expandvars(parameters['common']['OFXFile'] if parameters.has_option('common', 'OFXFile')
+                                  else daemon.get('WatchDirectory', ''))
+    if not os.path.isdir(watchdir):
+        sys.exit("No directory to watch.  Give one on the command line or as WatchDirectory in [Daemon]")
+    wr = parameters['common'].get('Writer')
+    if wr not in DaemonWriters:
+        sys.exit("The ingest service can only feed the {0} Writers, not {1}".format(', '.join(DaemonWriters), wr))
+    OFXGlobals.InThisFile = list(OFXGlobals.KnownLists)  # Like a batch: the Writer must be ready for any list
+    overrides = {'CommitEvery': 'File', 'PoolSize': daemon.get('PoolSize', '2')} if wr == 'Postgres' else None
+    metrics = OFXMetrics.FromConfig(parameters)
+    ledger = IngestLedger.FromConfig(parameters, wr)
+    watermarks = IngestLedger.WatermarksFromConfig(parameters)
+    with metrics.Stage('writer_init'):
+        DataWriter = OFXtoDB.MakeWriter(parameters, overrides)
+    if ledger is not None and IngestLedger.CheckWriter(DataWriter):
+        sys.exit(IngestLedger.CheckWriter(DataWriter))
+    metrics.Instrument(DataWriter)
+    poll = float(daemon.get('PollSeconds', '5'))
+    settle = float(daemon.get('SettleSeconds', '2'))
+    donedir = os.path.join(watchdir, daemon.get('DoneDirectory', 'Done'))
+    faileddir = os.path.join(watchdir, daemon.get('FailedDirectory', 'Failed'))
+    arrivals = queue.Queue()
+    port = int(daemon.get('SocketPort', '0'))
+    token = daemon.get('SocketToken', '')
+    if port > 0 and not token:
+        sys.exit("SocketPort in [Daemon] needs a SocketToken as well: clients send it as their first line")
+    server = StartSocket(port, arrivals, token, watchdir) if port > 0 else None
+    print("Watching {0}{1}.  Ctrl-C to stop".format(watchdir, " and 127.0.0.1:{0}".format(port) if server else ""))
+    seen = {}
+    try:
+        while True:
+            for OFXfile in SettledFiles(watchdir, seen, settle):
+                seen.pop(OFXfile, None)
+                MoveTo(OFXfile, donedir if Ingest(OFXfile, DataWriter, metrics, ledger, watermarks) else faileddir)
+            try:
+                Ingest(arrivals.get(timeout=poll), DataWriter, metrics, ledger, watermarks)
+            except queue.Empty:
+                pass
+    except KeyboardInterrupt:
+        print("Stopping")
+    finally:
+        if server:
+            server.shutdown()
+        DataWriter.OFXAllDone()
+        metrics.Report(DataWriter)
+        if ledger is not None:
+            ledger.Commit()
+            ledger.Close()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
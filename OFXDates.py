@@ -0,0 +1,104 @@
+#  OFX date/time values, e.g. 20240102, 20240102160000, or 20240102160000.123[-5:EST], turned into naive datetimes in the
+#  target time zone (OFXGlobals.TargetTZ).  A statement repeats the same few dates over and over (DTPOSTED, DTTRADE,
+#  DTSETTLE, DTASOF, DTPRICEASOF...), so the conversion is memoized in a bounded LRU cache, and it slices the string
+#  by position instead of running a regular expression and datetime.strptime on a re-formatted copy of it.
+#
+#  The rules, per the OFX spec:
+#    - No time at all (YYYYMMDD) means midnight local time, so the date is taken as is in the target zone.  (The old
+#      code tried to get the zone's offset with utcoffset(None), which has no answer for a zone with daylight saving.)
+#    - A time with no [offset] is GMT.  The offset is in hours and may be fractional, e.g. [-3.5:NST].
+#    - The fraction after the seconds is a fraction of a second, not a count of microseconds.
+#  Anything that is not a date gives None, as the old regular expression did.
+#
+#  Run this module by itself (python OFXDates.py) for a micro-benchmark against the old regex + strptime conversion.
+
+import datetime
+import functools
+import OFXGlobals
+
+MemoSize = 4096      # Distinct date strings remembered.  A large statement has a few hundred; the rest is headroom.
+OffsetZones = {}     # Hours offset from GMT -> datetime.timezone, so each offset is only built once
+
+
+def OffsetZone(hours):
+    zone = OffsetZones.get(hours)
+    if zone is None:
+        zone = OffsetZones[hours] = datetime.timezone(datetime.timedelta(hours=hours))
+    return zone
+
+
+@functools.lru_cache(maxsize=MemoSize)
+def ConvertOFXDate(value, TargetTZ):
+    bracket = value.find('[')
+    if bracket >= 0:
+        digits = value[:bracket]
+        offset = value[bracket + 1:].rstrip(']').split(':')[0].strip()
+    else:
+        digits = value
+        offset = None
+    dot = digits.find('.')
+    fraction = digits[dot + 1:] if dot >= 0 else ''
+    if dot >= 0:
+        digits = digits[:dot]
+    if len(digits) not in (8, 12, 14) or not (digits.isascii() and digits.isdigit()):
+        return None
+    if fraction and not (fraction.isascii() and fraction.isdigit()):
+        return None
+    try:
+        if len(digits) == 8 and offset is None:
+            return datetime.datetime(int(digits[0:4]), int(digits[4:6]), int(digits[6:8]))
+        hours = float(offset) if offset else 0.0
+        aware = datetime.datetime(int(digits[0:4]), int(digits[4:6]), int(digits[6:8]),
+                                  int(digits[8:10] or 0), int(digits[10:12] or 0), int(digits[12:14] or 0),
+                                  int(fraction[:6].ljust(6, '0')) if fraction else 0,
+                                  tzinfo=OffsetZone(int(hours) if hours.is_integer() else hours))
+    except ValueError:
+        return None
+    return aware.astimezone(TargetTZ).replace(tzinfo=None)  # after converting to desired time zone, make it naive
+
+
+# The converters OFXWriter binds for the D (timestamp) and DATE typcategories.
+def ToTimestamp(value):
+    return ConvertOFXDate(value, OFXGlobals.TargetTZ)
+
+
+def ToDate(value):   # To make comparisons with EXCEL dates work right store DATE formats as date-times at midnight.
+    dttimeval = ConvertOFXDate(value, OFXGlobals.TargetTZ)
+    return None if dttimeval is None else datetime.datetime(dttimeval.year, dttimeval.month, dttimeval.day)
+
+
+def CacheInfo():
+    return ConvertOFXDate.cache_info()
+
+
+if __name__ == '__main__':
+    import re
+    import sys
+    import timeit
+    from zoneinfo import ZoneInfo
+
+    def LegacyTimestamp(str):   # The regex + strptime conversion this module replaced, for comparison only
+        rgmatch = re.search(r"^(\d{8})(\d{6})(\.(\d+))?(\[([+-]?\d{1,2})(:(\w+))?])?$", str)
+        if rgmatch:
+            fractsec = int(rgmatch.group(4) if rgmatch.group(4) else '0')
+            tznum = int(rgmatch.group(6)) if rgmatch.group(6) else 0
+            groomedvalue = '{0}{1}.{2:06d}[{3:+05d}]'.format(rgmatch.group(1), rgmatch.group(2), fractsec, tznum*100)
+            return datetime.datetime.strptime(groomedvalue, '%Y%m%d%H%M%S.%f[%z]').astimezone(
+                tz=OFXGlobals.TargetTZ).replace(tzinfo=None)
+        return None
+
+    OFXGlobals.TargetTZ = ZoneInfo(sys.argv[1] if len(sys.argv) > 1 else 'America/New_York')
+    repeated = ['20240{0}{1:02d}120000.000[-5:EST]'.format(m, d) for m in range(1, 4) for d in range(1, 29)]
+    distinct = ['2{0:03d}0{1}{2:02d}{3:02d}0000[-4:EDT]'.format(y, m, d, h)
+                for y in range(10, 40) for m in range(1, 10) for d in range(1, 29) for h in (9, 17)][:MemoSize * 2]
+    for value in repeated:
+        if LegacyTimestamp(value) != ToTimestamp(value):
+            sys.exit("Mismatch on {0}: {1} vs {2}".format(value, LegacyTimestamp(value), ToTimestamp(value)))
+    print("{0:40}{1:>12}{2:>12}".format('microseconds per conversion', 'legacy', 'OFXDates'))
+    for name, values in (('statement-like (84 distinct, repeated)', repeated * 50),
+                         ('all distinct (cache misses)', distinct)):
+        ConvertOFXDate.cache_clear()
+        legacy = timeit.timeit(lambda: [LegacyTimestamp(v) for v in values], number=3) / (3 * len(values))
+        ConvertOFXDate.cache_clear()
+        fast = timeit.timeit(lambda: [ToTimestamp(v) for v in values], number=3) / (3 * len(values))
+        print("{0:40}{1:>12.2f}{2:>12.2f}".format(name, legacy * 1e6, fast * 1e6))
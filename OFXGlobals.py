@@ -1,3 +1,6 @@
 global TargetTZ
 global params
-global InThisFile
\ No newline at end of file
+global InThisFile
+global KnownLists
+
+global Parser
\ No newline at end of file
@@ -0,0 +1,265 @@
+#  Run instrumentation: where the time of a run went, and how many records each list and table saw.
+#
+#  Turned on with Enabled = Yes in [Metrics].  The main program then times its own stages (reading the statement file,
+#  building the Writer, processing each file) and the Writer's event calls are wrapped, on that one Writer object, with
+#  timers that also keep count.  When Metrics are off none of this happens: the main program gets a stand-in whose
+#  Stage() is a do-nothing context manager and the Writer is left exactly as it is, so the cost is a handful of calls
+#  per file.
+#
+#  What is reported:
+#    stages   wall time (and CPU time where measured) rolled up the way a slow run is usually asked about -
+#               parse        reading and parsing the statement files (with Parser = Stream the file is read lazily,
+#                            during flatten, instead)
+#               writer_init  the Writer's start-up: mapping, data base session, workbook load, index build
+#               flatten      walking each list entry and feeding it to the Writer, less the Writer's own time
+#               cast         OFXPutData & OFXSetContext: casting OFX text to Decimals, timestamps... into the record
+#               accumulate   OFXRecStart, OFXRecEnd, OFXAddRecords & OFXListStart: keeping the finished records
+#               write        OFXListEnd, OFXFlushBatch, OFXFileStart/End/Abort & OFXAllDone: the data base, workbook
+#                            or file I/O
+#               total        the whole run
+#    events   calls and wall time of each Writer event, and CPU time for all but the per element ones (OFXPutData,
+#               OFXRecStart and OFXRecEnd are called so often that two CPU clock reads each would skew the picture)
+#    lists    per OFX list: times started, entries, wall & CPU time, and per table the New/Existing/Dups counts
+#    tables   per table: the same counts over the whole run
+#    files, bytes_read
+#
+#  With ParallelWorkers, parsing and flattening happen in the worker processes and are not timed; only the merge of
+#  their records into the Writer is.  The same goes for Pipeline = Async, where they happen in the producer thread.
+#
+#  [Metrics] parameters:
+#    Enabled         Yes/No
+#    JSONFile        where the JSON report goes (empty for none)
+#    PrometheusFile  a node_exporter textfile collector file (e.g. /var/lib/node_exporter/textfile/ofxtodb.prom).  It is
+#                    written to a temporary file and renamed, as the collector expects.  Empty for none.
+
+import contextlib
+import json
+import os
+import time
+
+YesValues = ['YES', 'Y', 'TRUE', 'T', 'ENABLED']
+HotEvents = ('OFXPutData', 'OFXRecStart', 'OFXRecEnd')   # Wall clock only
+NestedEvents = ('OFXFlushBatch',)   # Called by the base Writer from inside OFXRecEnd or OFXAddRecords, and timed apart
+EventStage = {'OFXSetContext': 'cast', 'OFXPutData': 'cast',
+              'OFXListStart': 'accumulate', 'OFXRecStart': 'accumulate', 'OFXRecEnd': 'accumulate',
+              'OFXAddRecords': 'accumulate',
+              'OFXListEnd': 'write', 'OFXFlushBatch': 'write', 'OFXFileStart': 'write', 'OFXFileEnd': 'write', 'OFXFileAbort': 'write',
+              'OFXAllDone': 'write'}
+Outcomes = ('new', 'existing', 'dups')   # The three Stats columns
+
+
+def FromConfig(parameters):
+    plist = parameters['Metrics'] if parameters.has_section('Metrics') else {}
+    if plist.get('Enabled', 'No').upper() in YesValues:
+        return Metrics(plist)
+    return NoMetrics()
+
+
+class NoMetrics:
+    NoStage = contextlib.nullcontext()
+
+    def Stage(self, name):
+        return self.NoStage
+
+    def Instrument(self, DataWriter):
+        return DataWriter
+
+    def FileRead(self, OFXfile):
+        return
+
+    def Report(self, DataWriter):
+        return
+
+
+class Metrics:
+    def __init__(self, plist):
+        self.JSONFile = os.path.expandvars(plist.get('JSONFile', '') or '')
+        self.PrometheusFile = os.path.expandvars(plist.get('PrometheusFile', '') or '')
+        self.started = (time.time(), time.perf_counter(), time.process_time())
+        self.stages = {}   # name -> [calls, wall, cpu, wall spent in Writer events meanwhile]
+        self.events = {event: [0, 0.0, 0.0] for event in EventStage}   # event -> [calls, wall, cpu]
+        self.lists = {}
+        self.tables = {}
+        self.files = 0
+        self.bytes = 0
+        self.__eventwall = 0.0   # Running total of the wall time spent in (outermost) Writer events
+        self.__depth = 0         # An event calling another (a Writer's OFXAllDone calling its own OFXFileEnd) counts once
+        self.__nested = [0.0, 0.0]   # Running wall & CPU totals of the NestedEvents, taken out of the events around them
+        self.__list = None
+
+    @contextlib.contextmanager
+    def Stage(self, name):
+        stage = self.stages.setdefault(name, [0, 0.0, 0.0, 0.0])
+        wall, cpu, eventwall = time.perf_counter(), time.process_time(), self.__eventwall
+        try:
+            yield
+        finally:
+            stage[0] += 1
+            stage[1] += time.perf_counter() - wall
+            stage[2] += time.process_time() - cpu
+            stage[3] += self.__eventwall - eventwall
+
+    def FileRead(self, OFXfile):
+        self.files += 1
+        try:
+            self.bytes += os.path.getsize(OFXfile)
+        except OSError:
+            pass
+
+#   Wrap each event of this one Writer object.  Methods looked up on the object find the wrapper first, so the main
+#     program, the Writer itself and its base class all go through it; the class is untouched.
+    def Instrument(self, DataWriter):
+        self.__writer = DataWriter
+        for event in EventStage:
+            setattr(DataWriter, event, self.__Timed(getattr(DataWriter, event), event))
+        return DataWriter
+
+    def __Timed(self, function, event):
+        timing = self.events[event]
+        if event in NestedEvents:
+            def timed(*args):
+                outer = self.__depth
+                self.__depth += 1
+                wall, cpu = time.perf_counter(), time.process_time()
+                try:
+                    return function(*args)
+                finally:
+                    wall = time.perf_counter() - wall
+                    cpu = time.process_time() - cpu
+                    self.__depth -= 1
+                    timing[0] += 1
+                    timing[1] += wall
+                    timing[2] += cpu
+                    self.__nested[0] += wall
+                    self.__nested[1] += cpu
+                    if not outer:
+                        self.__eventwall += wall
+        elif event in HotEvents:
+            def timed(*args):
+                if self.__depth:
+                    return function(*args)
+                self.__depth += 1
+                wall, nested = time.perf_counter(), self.__nested[0]
+                try:
+                    return function(*args)
+                finally:
+                    wall = time.perf_counter() - wall
+                    self.__depth -= 1
+                    timing[0] += 1
+                    timing[1] += wall - (self.__nested[0] - nested)
+                    self.__eventwall += wall
+                    if event == 'OFXRecEnd' and self.__list is not None:
+                        self.__list['entries'] += 1
+        else:
+            def timed(*args):
+                if self.__depth:
+                    return function(*args)
+                self.__depth += 1
+                wall, cpu, nested = time.perf_counter(), time.process_time(), list(self.__nested)
+                if event == 'OFXListStart':
+                    self.__StartList(args[0])
+                elif event == 'OFXAddRecords' and self.__list is not None:
+                    self.__list['entries'] += max([len(records) for records in args[0].values()], default=0)
+                try:
+                    return function(*args)
+                finally:
+                    wall = time.perf_counter() - wall
+                    self.__depth -= 1
+                    timing[0] += 1
+                    timing[1] += wall - (self.__nested[0] - nested[0])
+                    timing[2] += time.process_time() - cpu - (self.__nested[1] - nested[1])
+                    self.__eventwall += wall
+                    if event == 'OFXListEnd':
+                        self.__EndList()
+        return timed
+
+#   A list runs from OFXListStart to OFXListEnd.  Its counts are what it added to the Writer's Stats in between.
+    def __StartList(self, OFXList):
+        self.__list = self.lists.setdefault(OFXList, {'started': 0, 'entries': 0, 'wall': 0.0, 'cpu': 0.0,
+                                                      'tables': {}})
+        self.__list['started'] += 1
+        self.__listclock = (time.perf_counter(), time.process_time())
+        self.__before = {table: list(t) for table, t in self.__writer.Stats.items()}
+
+    def __EndList(self):
+        if self.__list is None:
+            return
+        self.__list['wall'] += time.perf_counter() - self.__listclock[0]
+        self.__list['cpu'] += time.process_time() - self.__listclock[1]
+        for table, t in self.__writer.Stats.items():
+            delta = [n - m for n, m in zip(t, self.__before.get(table, [0] * len(t)))]
+            if any(delta):
+                for counts in (self.__list['tables'].setdefault(table, dict.fromkeys(Outcomes, 0)),
+                               self.tables.setdefault(table, dict.fromkeys(Outcomes, 0))):
+                    for outcome, n in zip(Outcomes, delta):
+                        counts[outcome] += n
+        self.__list = None
+
+#   The figures so far.  Safe to call more than once (the ingest service reports after every file).
+    def Summary(self):
+        stages = {}
+        for name in ('parse', 'writer_init'):
+            if name in self.stages:
+                stages[name] = {'wall': self.stages[name][1], 'cpu': self.stages[name][2]}
+        if 'process' in self.stages:
+            stages['flatten'] = {'wall': self.stages['process'][1] - self.stages['process'][3], 'cpu': None}
+        for event, (calls, wall, cpu) in self.events.items():
+            rollup = stages.setdefault(EventStage[event], {'wall': 0.0, 'cpu': 0.0})
+            rollup['wall'] += wall
+            if event in HotEvents or rollup['cpu'] is None:
+                rollup['cpu'] = None   # Only the stage made up entirely of timed events (write) has a CPU figure
+            else:
+                rollup['cpu'] += cpu
+        stages['total'] = {'wall': time.perf_counter() - self.started[1], 'cpu': time.process_time() - self.started[2]}
+        return {'started': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(self.started[0])),
+                'files': self.files,
+                'bytes_read': self.bytes,
+                'stages': stages,
+                'events': {event: {'calls': calls, 'wall': wall, 'cpu': None if event in HotEvents else cpu}
+                           for event, (calls, wall, cpu) in self.events.items() if calls},
+                'lists': self.lists,
+                'tables': self.tables}
+
+    def Report(self, DataWriter):
+        summary = self.Summary()
+        summary['destination'] = DataWriter.destination
+        if self.JSONFile:
+            self.__Replace(self.JSONFile, json.dumps(summary, indent=2) + '\n')
+        if self.PrometheusFile:
+            self.__Replace(self.PrometheusFile, self.Prometheus(summary))
+
+    def __Replace(self, filename, text):   # Readers never see a half written file
+        with open(filename + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(filename + '.tmp', filename)
+
+    def Prometheus(self, summary):
+        lines = []
+
+        def Metric(name, kind, helptext, samples):
+            lines.append('# HELP ofxtodb_{0} {1}'.format(name, helptext))
+            lines.append('# TYPE ofxtodb_{0} {1}'.format(name, kind))
+            for labels, value in samples:
+                lines.append('ofxtodb_{0}{1} {2}'.format(name, '{' + ','.join(
+                    '{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in labels.items()) + '}' if labels else '', value))
+
+        Metric('last_run_timestamp_seconds', 'gauge', 'When the run started.', [({}, round(self.started[0], 3))])
+        Metric('files', 'gauge', 'Statement files processed.', [({}, summary['files'])])
+        Metric('bytes_read', 'gauge', 'Bytes of statement files processed.', [({}, summary['bytes_read'])])
+        Metric('stage_seconds', 'gauge', 'Time spent per stage of the run.',
+               [({'stage': stage, 'clock': clock}, round(t[clock], 6))
+                for stage, t in summary['stages'].items() for clock in ('wall', 'cpu') if t[clock] is not None])
+        Metric('event_calls', 'gauge', 'Writer event calls.',
+               [({'event': event}, t['calls']) for event, t in summary['events'].items()])
+        Metric('event_seconds', 'gauge', 'Wall time spent in Writer events.',
+               [({'event': event}, round(t['wall'], 6)) for event, t in summary['events'].items()])
+        Metric('list_entries', 'gauge', 'Entries processed per OFX list.',
+               [({'list': OFXList}, t['entries']) for OFXList, t in summary['lists'].items()])
+        Metric('list_seconds', 'gauge', 'Time spent per OFX list.',
+               [({'list': OFXList, 'clock': clock}, round(t[clock], 6))
+                for OFXList, t in summary['lists'].items() for clock in ('wall', 'cpu')])
+        Metric('table_records', 'gauge', 'Records per table: new, existing or discarded as duplicates.',
+               [({'table': table, 'outcome': outcome}, n)
+                for table, counts in summary['tables'].items() for outcome, n in counts.items()])
+        return '\n'.join(lines) + '\n'
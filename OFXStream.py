@@ -0,0 +1,292 @@
+#  A streaming front end for OFX/QFX files that never builds the whole document tree.  It is an alternative to
+#  ofxtools' OFXTree for big statements (years of INVTRANLIST history, say) and is chosen with Parser = Stream in the
+#  [common] section of the .ini file.
+#
+#  The file is read in chunks and cut into tags with a regular expression.  SGML (OFX 1.x) leaves the data elements
+#  unclosed, so any tag followed by text is treated as a complete element and a matching close tag, if there is one
+#  (as in OFX 2.x XML), is skipped.  On top of those events the file is read twice:
+#    1. A survey pass, which keeps only the small things: which tags occur, and the events outside the known OFX lists
+#       (plus each list's own DTSTART & DTEND).  Which lists occur, FID & ORG, and for every "nearby" context (e.g. each
+#       <INVSTMTRS>) the data elements outside its lists, exactly as OFXtoDB.AddData would find them, are then worked out
+#       from those kept events, so the Writer's lists need not be known before the file is first read.
+#    2. One pass for all the OFX lists the Writer processes.  Each list entry is built as a small
+#       xml.etree.ElementTree.Element, handed to the caller together with its list and context data, and dropped.
+#       Memory stays at one list entry plus the context data, however long the lists are.
+#  Only simple paths are understood (tags separated by / or //, plus *), and a known list inside another known list is
+#  not looked for (AddData does not look inside them either).  Anything fancier in the mapping needs OFXTree.
+
+import codecs
+import re
+import xml.etree.ElementTree
+import OFXGlobals
+
+ChunkSize = 1 << 16
+TagRE = re.compile(r'<([^<>]*)>([^<]*)')
+OFXStartRE = re.compile(r'<OFX>', re.I)
+UTF8RE = re.compile(rb'ENCODING:\s*UTF-8|encoding\s*=\s*["\']utf-8', re.I)
+
+
+# Turn a (simple) ElementTree path into a regular expression that matches the end of a '/'-joined stack of tag names,
+#   so './/INVSTMTRS/INVTRANLIST' matches '/OFX/INVSTMTMSGSRSV1/INVSTMTTRNRS/INVSTMTRS/INVTRANLIST'.  Returns None for
+#   paths it cannot follow.
+def PathPattern(path):
+    steps = re.split(r'(//?)', re.sub(r'^\.?//?', '', path))
+    pattern = '/'
+    for step in steps:
+        if step == '/':
+            pattern += '/'
+        elif step == '//':
+            pattern += '(?:[^/]+/)*'
+        elif step == '*':
+            pattern += '[^/]+'
+        elif re.fullmatch(r'\w+', step):
+            pattern += re.escape(step)
+        else:
+            return None
+    return re.compile(pattern + '$')
+
+
+# The same split OFXtoDB uses: the list tag is the last step and the 'nearby' context is everything above it (or the
+#   list itself when there is nothing above it).
+def SplitOFXList(OFXList):
+    uppercontext = re.sub(r'(//?)?\w+$', '', OFXList)
+    listtag = re.sub(r'^.*?(\w+)$', r'\1', OFXList)
+    return (uppercontext if uppercontext else listtag), listtag
+
+
+def Supported(OFXList):
+    uppercontext, listtag = SplitOFXList(OFXList)
+    return PathPattern(uppercontext) is not None and PathPattern(OFXList) is not None
+
+
+class OFXStream:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.__tags = None
+        self.__kept = None
+        self.__surveyed = None
+
+    # Raw tags: (name, text) for each <name>text, with the text stripped and None when there is none.  Everything before
+    #   <OFX> (the SGML header, or the <?xml?> and <?OFX?> processing instructions) is skipped, as are comments.
+    def __Tokens(self):
+        with open(self.filename, 'rb') as f:
+            head = f.read(ChunkSize)
+            decoder = codecs.getincrementaldecoder('utf-8' if UTF8RE.search(head) else 'cp1252')(errors='replace')
+            buf = decoder.decode(head, final=len(head) < ChunkSize)
+            eof = len(head) < ChunkSize
+            m = OFXStartRE.search(buf)
+            while m is None and not eof:
+                chunk = f.read(ChunkSize)
+                eof = not chunk
+                buf += decoder.decode(chunk, final=eof)
+                m = OFXStartRE.search(buf)
+            if m is None:
+                return
+            buf = buf[m.start():]
+            while True:
+                cut = len(buf) if eof else buf.rfind('<')
+                if cut > 0:
+                    for tag in TagRE.finditer(buf, 0, cut):
+                        name = tag.group(1).strip()
+                        if name and name[0] not in '?!':
+                            text = tag.group(2).strip()
+                            yield name, text if text else None
+                    buf = buf[cut:]
+                if eof:
+                    return
+                chunk = f.read(ChunkSize)
+                eof = not chunk
+                buf += decoder.decode(chunk, final=eof)
+
+    # Balanced element events: ('start', tag, text) and ('end', tag, None).  An element with text is a leaf and is closed
+    #   straight away; its own close tag, when the file has one, is ignored.
+    def __Events(self):
+        stack = []
+        lastleaf = None
+        for name, text in self.__Tokens():
+            if name[0] == '/':
+                name = name[1:].strip()
+                if name == lastleaf and (not stack or stack[-1] != name):
+                    lastleaf = None
+                    continue
+                lastleaf = None
+                if name in stack:
+                    while stack:
+                        top = stack.pop()
+                        yield 'end', top, None
+                        if top == name:
+                            break
+            else:
+                yield 'start', name, text
+                if text is None:
+                    stack.append(name)
+                    lastleaf = None
+                else:
+                    yield 'end', name, None
+                    lastleaf = name
+        while stack:
+            yield 'end', stack.pop(), None
+
+    # The survey pass itself: every tag that occurs, and the events the rest of the survey needs.  Inside a known list
+    #   only the list's own DTSTART & DTEND are kept, which leaves a handful of events per statement.
+    def __Read(self):
+        if self.__kept is None:
+            tags = set()
+            kept = []
+            listdepth = None
+            depth = 0
+            for kind, tag, text in self.__Events():
+                if kind == 'start':
+                    depth += 1
+                    tags.add(tag)
+                    if listdepth is None:
+                        kept.append((kind, tag, text))
+                        if tag in OFXGlobals.KnownLists:
+                            listdepth = depth
+                    elif depth == listdepth + 1 and tag in ('DTSTART', 'DTEND'):
+                        kept.append((kind, tag, text))
+                else:
+                    if listdepth is None or depth == listdepth or (depth == listdepth + 1 and tag in ('DTSTART', 'DTEND')):
+                        kept.append((kind, tag, text))
+                    if depth == listdepth:
+                        listdepth = None
+                    depth -= 1
+            self.__tags = tags
+            self.__kept = kept
+        return self.__kept
+
+    def Tags(self):
+        self.__Read()
+        return self.__tags
+
+    def HasTag(self, tag):
+        return tag in self.Tags()
+
+    # Survey.  For each distinct 'nearby' context path of the given OFX lists, collect a list of context variables
+    #   per occurrence, in document order.  Each variable is (tag, value, alttag, listtag) where listtag is None for
+    #   ordinary context data and names the list for the DTSTART & DTEND elevated out of that list.
+    def Survey(self, OFXLists):
+        uppers = {}
+        present = {}
+        for OFXList in OFXLists:
+            uppercontext, listtag = SplitOFXList(OFXList)
+            uppers[uppercontext] = PathPattern(uppercontext)
+            present[OFXList] = PathPattern(OFXList)
+        contexts = {uppercontext: [] for uppercontext in uppers}
+        active = {}       # uppercontext -> [depth of context element, variables, depth of skipped list or None, DT tags seen]
+        found = set()
+        FIData = []
+        FIdepth = None
+        stack = []
+        for kind, tag, text in self.__Read():
+            if kind == 'end':
+                for uppercontext in list(active):
+                    ctx = active[uppercontext]
+                    if ctx[2] == len(stack):
+                        ctx[2] = None
+                    if ctx[0] == len(stack):
+                        del active[uppercontext]
+                if FIdepth == len(stack):
+                    FIdepth = None
+                stack.pop()
+                continue
+            stack.append(tag)
+            path = None
+            if len(found) < len(present):
+                path = '/' + '/'.join(stack)
+                for OFXList, pattern in present.items():
+                    if OFXList not in found and pattern.search(path):
+                        found.add(OFXList)
+            if tag == 'FI' and FIdepth is None and not FIData and 'SONRS' in stack[:-1]:
+                FIdepth = len(stack)
+            elif FIdepth is not None and len(stack) == FIdepth + 1 and tag in ('FID', 'ORG') and text is not None:
+                FIData.append((tag, text, "FI/" + tag))
+            for uppercontext, pattern in uppers.items():
+                if uppercontext not in active:
+                    if path is None:
+                        path = '/' + '/'.join(stack)
+                    if pattern.search(path):
+                        active[uppercontext] = [len(stack), [], None, set()]
+                        contexts[uppercontext].append(active[uppercontext][1])
+            for ctx in active.values():
+                if ctx[2] is not None:   # Inside a known list: only its own DTSTART & DTEND get out
+                    if len(stack) == ctx[2] + 1 and tag in ('DTSTART', 'DTEND') and tag not in ctx[3]:
+                        ctx[3].add(tag)
+                        ctx[1].append((tag, text, "{0}/{1}".format(stack[-2], tag), stack[-2]))
+                elif tag in OFXGlobals.KnownLists:
+                    ctx[2] = len(stack)
+                    ctx[3] = set()
+                elif text:
+                    parent = stack[-2] if len(stack) > ctx[0] else ""
+                    ctx[1].append((tag, text, "{0}/{1}".format(parent, tag), None))
+        self.__surveyed = (contexts, found, FIData)
+        return self
+
+    def FIData(self):
+        return self.__surveyed[2]
+
+    def HasList(self, OFXList):
+        return OFXList in self.__surveyed[1]
+
+    # List pass.  Yields (OFXList, contextvars, listentry) for every entry of every occurrence of the given lists, in
+    #   document order.  contextvars is the same list object for all entries of one context of one list, so callers can
+    #   tell when a new context starts.
+    def Entries(self, OFXLists):
+        # Per list: [OFXList, list tag, context pattern, contexts to come, contextvars, depth of its context element or
+        #   None, depths of its open list elements]
+        wanted = []
+        for OFXList in OFXLists:
+            uppercontext, listtag = SplitOFXList(OFXList)
+            wanted.append([OFXList, listtag, PathPattern(uppercontext), iter(self.__surveyed[0][uppercontext]), None,
+                           None, []])
+        builder = None
+        owners = []   # The lists the entry being built belongs to
+        entrydepth = None
+        depth = 0
+        stack = []
+        for kind, tag, text in self.__Events():
+            if kind == 'start':
+                stack.append(tag)
+                depth = len(stack)
+                if builder is not None:
+                    builder.start(tag, {})
+                    if text is not None:
+                        builder.data(text)
+                    continue
+                path = None
+                for w in wanted:
+                    if w[5] is None:
+                        if path is None:
+                            path = '/' + '/'.join(stack)
+                        if w[2].search(path):
+                            w[5] = depth
+                            ctxvars = next(w[3])
+                            w[4] = [(v[0], v[1], v[2]) for v in ctxvars if v[3] is None or v[3] == w[1]]
+                    if w[5] is not None:
+                        if tag == w[1]:
+                            w[6].append(depth)
+                        elif w[6] and depth == w[6][-1] + 1 and tag not in ('DTSTART', 'DTEND'):
+                            owners.append(w)
+                if owners:
+                    builder = xml.etree.ElementTree.TreeBuilder()
+                    builder.start(tag, {})
+                    if text is not None:
+                        builder.data(text)
+                    entrydepth = depth
+            else:
+                if builder is not None:
+                    builder.end(tag)
+                    if depth == entrydepth:
+                        listentry = builder.close()
+                        builder = None
+                        for w in owners:
+                            yield w[0], w[4], listentry
+                        owners = []
+                for w in wanted:
+                    if w[6] and depth == w[6][-1]:
+                        w[6].pop()
+                    if w[5] == depth:
+                        w[5] = None
+                stack.pop()
+                depth = len(stack)
@@ -1,13 +1,15 @@
 #  To build a new outputter (Writer) create a new class that inherits from this class (Writer).  In it, you can override
 #   as many of the below event calls as you wish, including __init__.  The easiest way to do this is to let the base
 #   class take the mapping specs from OFXtoDB.ini (in its __init__() procedure) and then accumulate an entire list of
-#   records in memory before writing.  That way you only need to override the OFXListEnd procedure, but you will need to
-#   know how to traverse the curOFXList data structure (which is a little arcane).  If you do not use the OFXListDict
+#   records in memory before writing.  That way you only need to override the OFXListEnd procedure, reading each table's
+#   records with self.Records(EachTable) (a RecordStore: iterate it, or take it in Batches, with Keys for the PKs) while
+#   walking the curOFXList data structure (which is a little arcane).  If you do not use the OFXListDict
 #   specification format then you must provide a custom iterator to help the main program establish an order for
 #   processing the lists that does not interfere with things like referential integrity in data bases.  Then in
-#   ChooseWriter, add an easily understood string mnemonic in an elif statement and call the initiator of your new
-#   class, returning that object to the caller.  Finally, in OFXtoDataParams, add your new mnemonic to the NoOverride
-#   overlay in the [WRITERS] section.
+#   ChooseWriter, add an easily understood string mnemonic to the Registry with the module and class name of your new
+#   Writer (the module is only imported when that Writer is chosen).  Finally, in OFXtoDataParams, add your new mnemonic
+#   to the NoOverride overlay in the [WRITERS] section.  A Writer shipped in a package of its own does not touch either:
+#   it declares an "ofxtodb.writers" entry point instead (see ChooseWriter).
 #
 #   If you need to pass in parameters to your class initiator, add a section named as your string mnemonic in your .ini
 #   file and list your parameters below it.  The parameters will be in a list of 2-tuples - name + value.  For example,
@@ -18,105 +20,243 @@
 #   user=postgres in the Postgres Writer because that's a pretty common usage in single-user Postgres.
 
 import collections
+import datetime
 from decimal import Decimal
 from operator import itemgetter
 import copy
+import hashlib
+import os
+import pickle
 import re
-import datetime
 import html
+import sys
 import OFXGlobals
+import OFXDates
+import RecordStore
+
+#   A couple of named tuples defined here (because names are much more readable than indexes).  They live at module
+#   level, rather than inside Writer.__init__, so the mapping built from them can be pickled and shipped to the worker
+#   processes that parse files in parallel.
+TableSpecs = collections.namedtuple('TableSpecs',
+                                    ['Cols','PKCols','OFXDict','BlankRec'])  # The static mapping data (per table)
+OFXEntry = collections.namedtuple('OFXEntry',['pos','fmt']) # The value part of the OFX element map. Integer position and one-char desired format
+
+#   The OFX data elements are character strings that sometimes must be cast into the right format to be output to the DB
+#   The format is adapted from the Postgres typcategory from the pg_catalog.pg_types table (see query in Postgres mapping
+#   iterator).  There is one converter function per format, looked up once when the mapping is compiled (see
+#   Writer.CompileDispatch) rather than once per data element.
+def ToStr(str):
+    return html.unescape(str)  # Data bases are not the internet - we hate &amp; &quot; and their ilk.
+
+def ToBool(str):
+    if str.upper() in ['Y','YES','T','TRUE']:
+        return True
+    elif str.upper() in ['N', 'NO', 'F', 'FALSE']:
+        return False
+    else:
+        return None
+
+def ToNone(str):
+    return None
+
+Converters = {'E': ToStr, 'S': ToStr, 'N': Decimal, 'B': ToBool, 'D': OFXDates.ToTimestamp, 'DATE': OFXDates.ToDate}
+
+# A date as a Writer reads it back from its output (a datetime, a date, or ISO text) made comparable with the naive
+#   datetimes the converters produce.
+def AsDateTime(value):
+    if isinstance(value, str):
+        try:
+            value = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if isinstance(value, datetime.datetime):
+        return value.replace(tzinfo=None)
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day)
+    return None
 
 class Writer:
+    Parallelizable = True   # Set False in a subclass whose data cannot be accumulated by a RecordCollector (below)
+    ChunkSize = 0           # Records per table handed to OFXFlushBatch during a list (ChunkSize in [common]); 0 = never
+    SavedAtFileEnd = True   # A file's records are safely stored once OFXFileEnd returns.  False: only after OFXAllDone
+    Cumulative = True       # What earlier runs wrote is still there after this one (the ingest ledger relies on it)
+    UndoesFile = False      # OFXFileAbort really takes back everything the failed file wrote since OFXFileStart
+
     #  List of events called by the driver.  ListStart & ListEnd delimit an <INVTRANLIST>,
     #       <INVPOSLIST>, or a <SECLIST>
     def OFXListStart(self, ofxlist):
         if ofxlist in self.OFXListDict:
             self.curOFXList = self.OFXListDict[ofxlist]
+            self.curTagDispatch, self.curParentDispatch = self.OFXDispatch[ofxlist]
             for EachTable in self.curOFXList:
-                self.curOFXList[EachTable][2].clear()   # Clear out the previous accumulated record for this table, if any
-                self.curOFXList[EachTable][3].clear()   # That goes for the accumulated list of PKs as well
+                self.curOFXList[EachTable][1] = list(self.curOFXList[EachTable][0].BlankRec)  # This list's working record
+                self.curOFXList[EachTable][2].Clear()   # Clear out the records accumulated for this table, if any
+                self.curOFXList[EachTable][3] = list(self.curOFXList[EachTable][0].BlankRec)  # No context yet
         else:
             self.curOFXList = None
         return self.curOFXList
 
+#   The 'nearby' data around a list (account number, statement dates, FID...) is the same for every record in that list
+#     context.  Instead of putting it into each record, it is converted once here into a per-table starting record
+#     (datatuple[3]) that OFXRecStart copies.  Call after OFXListStart and again whenever the context changes.
+    def OFXSetContext(self, listvars):
+        if self.curOFXList is not None:
+            for EachTable in self.curOFXList:
+                self.curOFXList[EachTable][3] = list(self.curOFXList[EachTable][0].BlankRec)
+            for lv in listvars:
+                for datatuple, pos, conv in self.curTagDispatch.get(lv.tag, ()):
+                    datatuple[3][pos] = conv(lv.value)
+                for datatuple, pos, conv in self.curParentDispatch.get(lv.alttag, ()):
+                    datatuple[3][pos] = conv(lv.value)
+        return
+
     def OFXListEnd(self):   # This should mostly be overridden by the sub-class to perform the actual writes.
         return
 
 #  RecStart and RecEnd  delimit each transaction, position, or security in the list
 
-    #   Initialize a new data record
+    #   Initialize a new data record.  The working record of each table is reused from one record to the next (the
+    #     RecordStore copies its values out at OFXRecEnd), so this only resets it to the context, without a new list.
     def OFXRecStart(self):
         if self.curOFXList is not None:
-            for EachTable in self.curOFXList:
-                self.curOFXList[EachTable][1] = copy.copy(
-                    self.curOFXList[EachTable][0].BlankRec)  # Put a new blank record ready for data reception
+            for datatuple in self.curOFXList.values():
+                datatuple[1][:] = datatuple[3]   # Blank except for the context, ready for data reception
         return
 
-#   The OFX data elements are character strings that sometimes must be cast into the right format to be output to the DB
-#   fmt is adapted from the Postgres typcategory from the pg_catalog.pg_types table (see query in Postgres mapping
-#   iterator).  This is only called by OFXPutData.
-    def __DestFmt(self,str,fmt):
-        match fmt:
-            case 'E' | 'S':
-                return html.unescape(str)  # Data bases are not the internet - we hate &amp; &quot; and their ilk.
-            case 'N':
-                return Decimal(str)
-            case 'B':
-                if str.upper() in ['Y','YES','T','TRUE']:
-                    return True
-                elif str.upper() in ['N', 'NO', 'F', 'FALSE']:
-                    return False
-                else:
-                    return None
-            case 'D' | 'DATE':
-                rgmatch = re.search(r"^(\d{8})(\d{6})(\.(\d+))?(\[([+-]?\d{1,2})(:(\w+))?])?$", str)
-                if rgmatch:
-                    if not rgmatch.group(2):
-                        groomedvalue = rgmatch.group(1)+'000000.000000[{0:+05d}]'.format(int(OFXGlobals.TargetTZ.utcoffset(None).seconds/60))
-                    else:
-                        fractsec = int(rgmatch.group(4) if rgmatch.group(4) else '0')
-                        tznum = int(rgmatch.group(6)) if rgmatch.group(6) else 0
-                        tztext = rgmatch.group(8) if rgmatch.group(6) else "GMT"
-                        groomedvalue = '{0}{1}.{2:06d}[{3:+05d}]'.format(rgmatch.group(1), rgmatch.group(2),
-                                        fractsec, tznum*100)
-                    dttimeval = datetime.datetime.strptime(groomedvalue,
-                                            '%Y%m%d%H%M%S.%f[%z]').astimezone(tz=OFXGlobals.TargetTZ)
-                    dttimeval = dttimeval.replace(tzinfo=None)  # after converting to desired time zone, make the timestamp naive
-#  To make comparisons with EXCEL dates work right store DATE formats as date-times at midnight.
-                    if fmt == 'DATE': dttimeval = datetime.datetime(dttimeval.year,dttimeval.month,dttimeval.day, 0,0,0 )
-                    return dttimeval
-                else:
-                    return None
-            case _:
-                return None
-
-
-    #   Put this tag into every table (zero or once) where the tag appears in the OFXElementDict
+    #   Put this tag into every table (zero or once) where the tag appears in the OFXElementDict.  Tags no table wants
+    #     cost two failed dictionary lookups.
     def OFXPutData(self, tag, value, parent):
         if self.curOFXList is not None:
-            for EachTable in self.curOFXList:
-                datatuple = self.curOFXList[EachTable]
-                if tag in datatuple[0].OFXDict:
-                    el = datatuple[0].OFXDict[
-                        tag]  # OFXDict dictionary values are a pair: pos = offsets into data, fmt = desired data format
-                    datatuple[1][el.pos] = self.__DestFmt(value, el.fmt)
-                elif parent in datatuple[0].OFXDict:
-                    el = datatuple[0].OFXDict[
-                        parent]  # tag not in dictionary, but try parent/tag to avoid ambiguity
-                    datatuple[1][el.pos] = self.__DestFmt(value, el.fmt)
+            for datatuple, pos, conv in self.curTagDispatch.get(tag, ()):
+                datatuple[1][pos] = conv(value)
+            for datatuple, pos, conv in self.curParentDispatch.get(parent, ()):
+                datatuple[1][pos] = conv(value)
         return
 
-    #   Append completed record(s) to an internal list of records (RecCollect).  Defer DB writes until the entire list
+#   Bind each list's two dispatch dictionaries (see ListDispatch; from the compiled mapping when there is one) to the
+#     datatuples of this Writer, so that OFXPutData finds the datatuple itself: (datatuple, position, converter).  The
+#     keys are interned, as are the paths WalkElementTree hands out.
+    def CompileDispatch(self, Dispatch=None):
+        self.OFXDispatch = {}
+        for OFXList, tables in self.OFXListDict.items():
+            if Dispatch is not None and OFXList in Dispatch:
+                named = Dispatch[OFXList]
+            else:
+                named = ListDispatch([(EachTable, datatuple[0]) for EachTable, datatuple in tables.items()])
+            self.OFXDispatch[OFXList] = tuple({sys.intern(key): [(tables[EachTable], pos, conv)
+                                                                for EachTable, pos, conv in entries]
+                                               for key, entries in d.items()} for d in named)
+
+    #   Append completed record(s) to the table's RecordStore (datatuple[2]).  Defer DB writes until the entire list
     #     is complete
     def OFXRecEnd(self):
         if self.curOFXList is not None:
             for EachTable in self.curOFXList:
-                datatuple = self.curOFXList[
-                    EachTable]  # Records are accumulated as a list (mutable), then saved as a tuple to be written later
-                PKtuple = tuple(datatuple[1][PKs] for PKs in datatuple[0].PKCols.values())
-                if PKtuple is None or PKtuple not in datatuple[3]:  # discard any duplicated records (you get these in SECLISTs sometimes)
-                    datatuple[2].append(tuple(datatuple[1]))  #
-                    datatuple[3].append(PKtuple)
+                datatuple = self.curOFXList[EachTable]
+                self.__Keep(EachTable, datatuple, datatuple[1])   # The store copies the record into its columns
+        return
+
+#   Duplicated primary keys within a list happen (you get these in SECLISTs sometimes).  The store keeps a dictionary
+#     from PK tuple to the record's position, so spotting one is a hash lookup rather than a search of every PK so far.
+#     What happens next is up to the DuplicatePolicy in [common]: FirstWins keeps the record already accumulated,
+#     LastWins replaces it, and Merge overlays the new record's non-null columns onto it.  Either way the duplicate is
+#     counted in the third Stats column.
+#     A duplicate of a record already flushed (ChunkSize) is simply dropped, which is why chunks need FirstWins.
+    def __Keep(self, EachTable, datatuple, rec):
+        PKtuple = tuple(rec[PKs] for PKs in datatuple[0].PKCols.values())
+        where = datatuple[2].Find(PKtuple)
+        if where is None:
+            datatuple[2].Append(rec, PKtuple)
+            if self.ChunkSize and len(datatuple[2]) >= self.ChunkSize and self.OFXFlushBatch(EachTable):
+                datatuple[2].Flush()
+        else:
+            if where == RecordStore.Flushed:
+                pass
+            elif self.DuplicatePolicy == 'LastWins':
+                datatuple[2].Replace(where, rec)
+            elif self.DuplicatePolicy == 'Merge':
+                datatuple[2].Replace(where, [old if new is None else new
+                                             for old, new in zip(datatuple[2].Get(where), rec)])
+            self.TableStats(EachTable)[2] += 1
+
+#   Chunked writing.  With ChunkSize = n in [common], whenever n records of a table have accumulated in the middle of a
+#     list they are offered to OFXFlushBatch, which writes self.Records(EachTable) out just as OFXListEnd would (and
+#     counts them in Stats) and returns True; the store then lets them go.  OFXListEnd gets what is left.  A Writer that
+#     does not override this keeps the whole list until OFXListEnd, as ever.
+    def OFXFlushBatch(self, EachTable):
+        return False
+
+#   The records accumulated for a table of the current list, for OFXListEnd to write: a RecordStore, read by iterating
+#     it (tuples in column order), in batches (Batches) and with the PK of each record (Keys).
+    def Records(self, EachTable):
+        return self.curOFXList[EachTable][2]
+
+#   Statistics are kept per table as [New, Existing, Duplicates discarded].  The first two are the Writer's business
+#     (usually counted in OFXListEnd); the third is counted here in the base class.
+    def TableStats(self, EachTable):
+        if EachTable not in self.Stats:
+            self.Stats[EachTable] = [0, 0, 0]
+        return self.Stats[EachTable]
+
+#   Hand the Writer a list's worth of finished records that were built elsewhere (by a RecordCollector in a worker
+#     process) instead of building them tag by tag.  Call between OFXListStart and OFXListEnd.  tables is a dictionary
+#     of table name -> list of record tuples, exactly as OFXRecEnd would have accumulated them.
+    def OFXAddRecords(self, tables):
+        if self.curOFXList is not None:
+            for EachTable, records in tables.items():
+                if EachTable in self.curOFXList:
+                    datatuple = self.curOFXList[EachTable]
+                    for rec in records:
+                        self.__Keep(EachTable, datatuple, rec)
+        return
+
+#   Incremental mode (Incremental = Yes in [common]) asks the Writer what its output already holds.  A Writer that can
+#     tell, for one table, the latest date in datecol for each value of acctcol overrides Watermarks to return them as
+#     {account: latest date}.  None (the default) means it cannot say, and nothing is skipped.
+    def Watermarks(self, EachTable, datecol, acctcol):
+        return None
+
+#   The watermarks of every OFX list, as {OFXList: (account converter, {account: latest date})}.  The tables asked are
+#     those mapping ACCTID and one of datetags (the tags that date a list entry); an account's watermark is the earliest
+#     of theirs, so that no table misses an entry it does not have yet.  Tables with no entry date (Accounts, balances)
+#     are left out of it.
+    def OFXWatermarks(self, datetags):
+        marks = {}
+        for OFXList, tables in self.OFXListDict.items():
+            listmarks = None
+            acctconv = None
+            for EachTable, datatuple in tables.items():
+                names = {pos: col for col, pos in datatuple[0].Cols.items()}
+                datecol = acctcol = None
+                for key, el in datatuple[0].OFXDict.items():
+                    tag = key.rsplit('/', 1)[-1]
+                    if tag in datetags and datecol is None:
+                        datecol = names[el.pos]
+                    elif tag == 'ACCTID' and acctcol is None:
+                        acctcol = names[el.pos]
+                        acctconv = Converters.get(el.fmt, ToStr)
+                if datecol is None or acctcol is None:
+                    continue
+                found = self.Watermarks(EachTable, datecol, acctcol)
+                if found is None:   # One table the Writer cannot answer for, and the list has no watermark
+                    listmarks = None
+                    break
+                found = {str(acct): AsDateTime(latest) for acct, latest in found.items() if AsDateTime(latest) is not None}
+                listmarks = found if listmarks is None else {acct: min(latest, listmarks[acct])
+                                                             for acct, latest in found.items() if acct in listmarks}
+            if listmarks:
+                marks[OFXList] = (acctconv, listmarks)
+        return marks
+
+#  FileStart and FileEnd delimit each statement file.  A single-file run sees exactly one pair; a batch run sees one pair
+#   per file, all delivered to the same Writer before OFXAllDone.
+    def OFXFileStart(self, ofxfile):
+        return
+
+    def OFXFileEnd(self):
+        return
+
+    def OFXFileAbort(self):   # Instead of OFXFileEnd, when something went wrong part way through a file
         return
 
     def OFXAllDone(self):
@@ -125,37 +265,38 @@ class Writer:
     def __init__(self, plist):
         if not hasattr(self, 'MapSrc'):
             self.MapSrc = MappingFromIniFile()
-        self.OFXListDict = {}  # A dictionary of OFX lists we want processed (e.g. INVTRANLIST, INVPOSLIST, SECLIST)
-                          #  each entry contains a list of table names to process by indexing into OFXTableDict.
-        DBTableDict = {}  # Each table dictionary has a list of database columns (in order), the table name it
-                          # goes to, and the OFX dictionary that defines its data elements.
-        OFXElementDict = {}  # Each Element dictionary describes positionally the OFX element that goes in each table.
-        TableCols = {}
-        TablePKs = {}    # Need to know this for the Merge statement join
-        BlankDataRecord = []
-#   A couple of named tuples defined here (because names are much more readable than indexes).
-        self.TableSpecs = collections.namedtuple('TableSpecs',
-                                            ['Cols','PKCols','OFXDict','BlankRec'])  # The static mapping data (per table)
-        self.OFXEntry = collections.namedtuple('OFXEntry',['pos','fmt']) # The value part of the OFX element map. Integer position and one-char desired format
+        self.TableSpecs = TableSpecs
+        self.OFXEntry = OFXEntry
         self.Stats = {}
-        for rec in self.MapSrc:
-            if re.sub(r'^.*?(\w+)$',r'\1',rec.OFXList) in OFXGlobals.InThisFile:    # Only read entries for lists known to exist in this file
-                if rec.DBColumn not in TableCols:
-                    BlankDataRecord.append(None)
-                    TableCols[rec.DBColumn] = len(BlankDataRecord) - 1
-                OFXElementDict[rec.OFXTag] = self.OFXEntry(TableCols[rec.DBColumn], rec.typcategory)  #This determines where the OFX value goes in the output tuple
-                if rec.IsPK:
-                    TablePKs[rec.DBColumn] = TableCols[rec.DBColumn]
-                if rec.newtable:    # Last element of a DB table - connect a tuple of TableCols & OFXElementDict to the TableDict
-                    DBTableDict[rec.DBTable] = [self.TableSpecs(TableCols, TablePKs, OFXElementDict, BlankDataRecord),
-                                                                 BlankDataRecord, [], []]
-                    TableCols = {}
-                    TablePKs = {}
-                    OFXElementDict = {}
-                    BlankDataRecord = []
-                    if rec.newlist:   #Last element of an OFX list, add the list name and the dictionary of datatables to OFXListDict
-                        self.OFXListDict[rec.OFXList] = copy.deepcopy(DBTableDict)
-                        DBTableDict = {}
+        self.DuplicatePolicy = OFXGlobals.params['common'].get('DuplicatePolicy', 'FirstWins')
+        if self.DuplicatePolicy not in ('FirstWins', 'LastWins', 'Merge'):
+            raise ConfigurationError("DuplicatePolicy must be FirstWins, LastWins or Merge, not {0}".format(
+                self.DuplicatePolicy))
+        try:
+            SpillRecords = int(OFXGlobals.params['common'].get('SpillRecords', '0') or 0)
+        except ValueError:
+            raise ConfigurationError("SpillRecords must be a number of records, not {0}".format(
+                OFXGlobals.params['common'].get('SpillRecords')))
+        SpillDirectory = os.path.expandvars(OFXGlobals.params['common'].get('SpillDirectory', '') or '')
+        try:
+            self.ChunkSize = int(OFXGlobals.params['common'].get('ChunkSize', '0') or 0)
+        except ValueError:
+            raise ConfigurationError("ChunkSize must be a number of records, not {0}".format(
+                OFXGlobals.params['common'].get('ChunkSize')))
+        if self.ChunkSize and self.DuplicatePolicy != 'FirstWins':
+            raise ConfigurationError("ChunkSize only works with DuplicatePolicy = FirstWins")
+        Mapping = LoadMapping(self.MapSrc)
+        self.OFXListDict = {}  # A dictionary of OFX lists we want processed (e.g. INVTRANLIST, INVPOSLIST, SECLIST), in
+                               #  processing order.  Each entry is a dictionary of the tables the list feeds, each table a
+                               #  datatuple: [TableSpecs, working record, RecordStore, context record]
+        for OFXList, tables in Mapping.Lists:
+            if re.sub(r'^.*?(\w+)$',r'\1',OFXList) in OFXGlobals.InThisFile:    # Only lists known to exist in this file
+                self.OFXListDict[OFXList] = {
+                    EachTable: [specs, list(specs.BlankRec),
+                                RecordStore.RecordStore(len(specs.BlankRec), SpillRecords, SpillDirectory),
+                                list(specs.BlankRec)]
+                    for EachTable, specs in tables}
+        self.CompileDispatch(Mapping.Dispatch)
         self.curOFXList = None
 # An iterator to return all the OFX lists the writer cares about in the order it wants it processed
 #   The initializer of the subclass must set up self.OFXListDict with the OFXLists as the keys.  The values can be
@@ -170,9 +311,54 @@ class Writer:
             return self.__list.pop(0)
         raise StopIteration
 
+# A Writer that writes nothing.  It is built from a copy of another Writer's OFXListDict (so it needs no mapping source,
+#   data base session or workbook of its own) and simply keeps each finished list's records in Collected, as a list of
+#   (OFXList, {table: [records]}) pairs in processing order.  Worker processes use it to flatten statement files in
+#   parallel; the real Writer then receives the pairs through OFXListStart, OFXAddRecords and OFXListEnd.  Duplicates
+#   are left in, so the real Writer applies its DuplicatePolicy and counts them.  Given Deliver, each pair is handed to
+#   Deliver(OFXList, tables) as soon as its list ends instead (the Pipeline = Async producer does this).
+class RecordCollector(Writer):
+    def __init__(self, OFXListDict, Deliver=None):
+        self.OFXListDict = copy.deepcopy(OFXListDict)
+        self.Deliver = Deliver
+        self.CompileDispatch()
+        self.curOFXList = None
+        self.Stats = {}
+        self.Collected = []
+
+    def OFXListStart(self, ofxlist):
+        self.__ofxlist = ofxlist
+        self.__records = {EachTable: [] for EachTable in self.OFXListDict.get(ofxlist, ())}
+        return super().OFXListStart(ofxlist)
+
+    def OFXListEnd(self):
+        if self.curOFXList is not None:
+            if self.Deliver is not None:
+                self.Deliver(self.__ofxlist, self.__records)
+            else:
+                self.Collected.append((self.__ofxlist, self.__records))
+
+    def OFXAddRecords(self, tables):   # Records flattened elsewhere already (a list ProcessStream collected on the side)
+        if self.curOFXList is not None:
+            for EachTable, records in tables.items():
+                if EachTable in self.__records:
+                    self.__records[EachTable].extend(records)
+
+    def OFXRecEnd(self):   # Plain lists of tuples, duplicates and all: they are pickled back to the main process as is
+        if self.curOFXList is not None:
+            for EachTable in self.curOFXList:
+                self.__records[EachTable].append(tuple(self.curOFXList[EachTable][1]))
+
+    def OFXFileStart(self, ofxfile):
+        self.Collected = []
+
 class ConfigurationError(Exception):
     pass
 
+# One record of the mapping, as every mapping source delivers it (in order) to Writer.__init__
+MappingRecord = collections.namedtuple('MappingRecord',["OFXList", "DBTable", "OFXTag", "DBColumn", "typcategory", "IsPK",
+                                                        "ordinal_position","newlist","newtable"])
+
 class MappingFromIniFile():
     def __iter__(self):
         m = OFXGlobals.params.options('Mapping')
@@ -198,20 +384,122 @@ class MappingFromIniFile():
             else:
                 raise ConfigurationError("For mapping item ({0}): No table named {1} in configuration".format(
                     ", ".join(mapitem), mapitem[1]))
-        self.__maplist = sorted(rawMapList,key=itemgetter(5,6,4,2,3))
-        self.MappingRecord = collections.namedtuple('MappingRecord',["OFXList", "DBTable", "OFXTag", "DBColumn", "typcategory", "IsPK", "ordinal_position","newlist","newtable"])
+        maplist = sorted(rawMapList,key=itemgetter(5,6,4,2,3))
+        self.MappingRecord = MappingRecord
+        records = []
+        for i, item in enumerate(maplist):
+            last = i == len(maplist) - 1
+            newtable = last or not (item[0]==maplist[i+1][0] and item[1]==maplist[i+1][1])
+            newlist  = last or not  item[0]==maplist[i+1][0]
+            coldefs = OFXGlobals.params.get("Table:{0}".format(item[1]),item[3])
+            if not coldefs:
+                raise ConfigurationError("Table definition missing for Table:{0} and Column:{1}".format(item[1],item[3]))
+            cd = re.findall(r'[^\s,]+',coldefs)
+            records.append(self.MappingRecord(item[0], item[1], item[2], item[3], cd[0], len(cd)>1 and cd[1]=='PK',
+                                              item[4], newlist, newtable))
+        self.__records = iter(records)
         return self
 
     def __next__(self):
-        if len(self.__maplist) <= 0:
-            raise StopIteration
-        newtable = len(self.__maplist) == 1 or not (self.__maplist[0][0]==self.__maplist[1][0] and self.__maplist[0][1]==self.__maplist[1][1])
-        newlist  = len(self.__maplist) == 1 or not  self.__maplist[0][0]==self.__maplist[1][0]
-        coldefs = OFXGlobals.params.get("Table:{0}".format(self.__maplist[0][1]),self.__maplist[0][3])
-        if not coldefs:
-            raise ConfigurationError("Table definition missing for Table:{0} and Column:{1}".format(self.__maplist[0][1],self.__maplist[0][3]))
-        cd = re.findall(r'[^\s,]+',coldefs)
-        rec = self.MappingRecord(self.__maplist[0][0], self.__maplist[0][1], self.__maplist[0][2], self.__maplist[0][3],
-                                 cd[0], len(cd)>1 and cd[1]=='PK', self.__maplist[0][4], newlist, newtable)
-        self.__maplist.pop(0)
-        return rec
\ No newline at end of file
+        return next(self.__records)
+
+# The compiled mapping.  Turning the mapping records into the Writer's structures (the TableSpecs of every table of every
+#   list, in processing order, and the tag dispatch of every list) is done by CompileMapping, whatever the mapping source.
+#   With CompiledMapping = <file> in [common] the result is also pickled to that file (python CompileMapping.py writes it
+#   ahead of time, after checking the mapping over), and later runs load it instead of reading and sorting the mapping
+#   again.  The file is used only while it is current: same version, and either the .ini it was compiled from has the
+#   same modification time and size or its [Mapping] and [Table:...] sections hash the same.  Otherwise the mapping is
+#   compiled afresh and the file rewritten.  Only the .ini mapping is compiled to a file; the Postgres mapping has its
+#   own cache (MappingCache in [Postgres]).
+#     Lists     [(OFXList, [(DBTable, TableSpecs)])] in processing order, every list of the mapping
+#     Dispatch  {OFXList: (TagDispatch, ParentDispatch)}, each {tag or parent/tag: [(DBTable, position, converter)]}
+CompiledMapping = collections.namedtuple('CompiledMapping', ['Lists', 'Dispatch'])
+CompiledMappingVersion = 1
+
+def CompileMapping(MapSrc):
+    Lists = []
+    tables = []
+    TableCols = {}
+    TablePKs = {}    # Need to know this for the Merge statement join
+    OFXElementDict = {}  # Each Element dictionary describes positionally the OFX element that goes in each table.
+    BlankDataRecord = []
+    for rec in MapSrc:
+        if rec.DBColumn not in TableCols:
+            BlankDataRecord.append(None)
+            TableCols[rec.DBColumn] = len(BlankDataRecord) - 1
+        OFXElementDict[rec.OFXTag] = OFXEntry(TableCols[rec.DBColumn], rec.typcategory)  #This determines where the OFX value goes in the output tuple
+        if rec.IsPK:
+            TablePKs[rec.DBColumn] = TableCols[rec.DBColumn]
+        if rec.newtable:    # Last element of a DB table
+            tables.append((rec.DBTable, TableSpecs(TableCols, TablePKs, OFXElementDict, BlankDataRecord)))
+            TableCols = {}
+            TablePKs = {}
+            OFXElementDict = {}
+            BlankDataRecord = []
+            if rec.newlist:   # Last element of an OFX list
+                Lists.append((rec.OFXList, tables))
+                tables = []
+    return CompiledMapping(Lists, {OFXList: ListDispatch(tables) for OFXList, tables in Lists})
+
+#   The two dispatch dictionaries of one list's tables, one keyed by tag and one by parent/tag, each giving a list of
+#     (DBTable, position, converter).  A table gets a parent/tag entry only when it does not map the bare tag, which is
+#     the same "tag first, then parent/tag to avoid ambiguity" rule that used to be applied table by table for every
+#     data element.
+def ListDispatch(tables):
+    TagDispatch = {}
+    ParentDispatch = {}
+    for EachTable, specs in tables:
+        for key, el in specs.OFXDict.items():
+            entry = (EachTable, el.pos, Converters.get(el.fmt, ToNone))
+            if '/' not in key:
+                TagDispatch.setdefault(key, []).append(entry)
+            elif key.rsplit('/', 1)[1] not in specs.OFXDict:
+                ParentDispatch.setdefault(key, []).append(entry)
+    return TagDispatch, ParentDispatch
+
+def MappingStamp(params):   # (.ini file, modification time, size), or None when it is not known
+    IniFile = getattr(params, 'IniFile', None)
+    try:
+        st = os.stat(IniFile)
+    except (OSError, TypeError):
+        return None
+    return (IniFile, st.st_mtime_ns, st.st_size)
+
+def MappingFingerprint(params):   # A hash of everything in the .ini the mapping is made of
+    digest = hashlib.sha256()
+    for section in ['Mapping'] + [s for s in params.sections() if s.startswith('Table:')]:
+        digest.update('[{0}]\n'.format(section).encode())
+        for name, value in params.items(section, raw=True):
+            digest.update('{0}={1}\n'.format(name, value).encode())
+    return digest.hexdigest()
+
+def ReadCompiledMapping(filename, params):
+    try:
+        with open(filename, 'rb') as f:
+            version, stamp, fingerprint, mapping = pickle.load(f)
+    except (OSError, pickle.PickleError, EOFError, ValueError, TypeError, AttributeError, ImportError):
+        return None
+    if version != CompiledMappingVersion:
+        return None
+    if stamp is not None and stamp == MappingStamp(params):
+        return mapping
+    return mapping if fingerprint == MappingFingerprint(params) else None
+
+def WriteCompiledMapping(filename, params, mapping):
+    with open(filename + '.tmp', 'wb') as f:
+        pickle.dump((CompiledMappingVersion, MappingStamp(params), MappingFingerprint(params), mapping), f,
+                    pickle.HIGHEST_PROTOCOL)
+    os.replace(filename + '.tmp', filename)
+
+def LoadMapping(MapSrc):
+    filename = os.path.expandvars(OFXGlobals.params['common'].get('CompiledMapping', '') or '')
+    if not filename or type(MapSrc) is not MappingFromIniFile:
+        return CompileMapping(MapSrc)
+    mapping = ReadCompiledMapping(filename, OFXGlobals.params)
+    if mapping is None:
+        mapping = CompileMapping(MapSrc)
+        try:
+            WriteCompiledMapping(filename, OFXGlobals.params, mapping)
+        except OSError:
+            pass     # Not compiled this time; the mapping itself is fine
+    return mapping
\ No newline at end of file
@@ -1,5 +1,5 @@
 #  Read a financial institution's Quicken-format file (.qfx) and produce data records that can be written to a variety
-#   of formats: currently Postgres data base, Excel workbook, and .CSV files is supported.  Most of a .qfx file consists
+#   of formats: currently Postgres data base, Excel workbook, .CSV and Parquet files are supported.  Most of a .qfx file consists
 #   of SGML/XML data arranged according to an Open Financial eXchange protocol, or OFX.  The program is divided into
 #   three parts: this main module is responsible for producing OFX data within a logical table and record paradigm.  The
 #   OFXWriter module reads mapping specs in a very specific format, translates them into an internal data structure for
@@ -27,47 +27,70 @@
 #   entry (see the path documentation for xml.etree.ElementTree) as long as it ends in one of the known OFX-defined list
 #   wrappers (SECLIST,INVPOSLIST,INVTRANLIST,BANKTRANLIST,BANKTRANLISTP,LOANTRANLIST,AMRTTRANLIST,CLOSING).
 #
+# The program can also run in batch mode.  The OFX file given on the command line (or as OFXFile in the .ini) can be
+#   a directory (every .qfx/.ofx file in it is processed), a wildcard pattern such as C:\Downloads\*.qfx, or a
+#   manifest file named with a leading '@' (e.g. @tonight.txt) that lists one statement file per line.  Any further
+#   command line arguments are treated the same way, so dragging several files onto the shortcut works too.  In batch
+#   mode the Writer, its mapping, and any indexes it builds are created once and every file is streamed through them.
+#   The combined Add/Update statistics are printed at the end, followed by the counts for each file.
+#
+# Parsing and flattening a file is pure Python and holds the GIL, so a batch can be spread over a pool of worker
+#   processes by setting ParallelWorkers in the [common] section (a number, or Auto for one per CPU).  Each worker
+#   turns whole files into finished records with an OFXWriter.RecordCollector and the one real Writer in this process
+#   merges them, file by file and list by list, in the same order a sequential run would.
+#
+# Without a pool, Pipeline = Async in [common] still lets parsing overlap writing.  One thread parses and flattens while
+#   the Writer writes what came before it: list N+1 (or the next file) is flattened while list N is going into the data
+#   base.  The two stages are joined by a bounded asyncio queue (PipelineDepth lists) and the Writer takes the lists in
+#   the order they were flattened, which is the Writer's own order (the foreign key order MappingFromDB works out).
+#   See Pipeline.
+#
+# Setting Parser = Stream in [common] swaps ofxtools' OFXTree for the OFXStream module, which reads the file in a few
+#   streaming passes and only ever holds one list entry (plus its nearby context) in memory.  See OFXStream.py.
+#
+# With Enabled = Yes in [Metrics] the run times its stages and the Writer's events and counts records per list and
+#   table, and reports them as JSON and/or a Prometheus textfile.  See OFXMetrics.py.
+#
+# With Enabled = Yes in [Ledger] a statement file whose content was already loaded is skipped without being parsed,
+#   and (SkipOverlap = Yes) only the entries dated outside statements already loaded are pushed.  Incremental = Yes in
+#   [common] asks the Writer for the latest date it holds per account and skips the entries older than that.  See
+#   IngestLedger.py.
+#
 import sys
+import os
+import glob
+import threading
 import OFXtoDataParams
 import OFXGlobals
 import WalkElementTree
+import OFXStream
 import xml.etree.ElementTree
-from ofxtools import OFXTree
 from collections import namedtuple
 from zoneinfo import ZoneInfo
-import copy
 import re
 import ChooseWriter
+import OFXWriter
+import OFXMetrics
+import IngestLedger
+
+XMLPairs = namedtuple("XMLPairs", "tag value alttag")
+OFXFileTypes = ('.qfx', '.ofx')   # What a statement file looks like when we are handed a whole directory
 
 def AddData(subTree,globalvars,listtag):    # These two functions get a lot of the list-specific logic out of the main process
-    local = copy.deepcopy(globalvars)  # Walk the subTree, except for the known lists in the uppercontext
-    save = [[subTree]]                 #  this gets all the uppercontext elements whose data goes in every record
-    while len(save)>0:
-        if len(save[-1])>0:    # save is a pushdown list of lists to remember where we still need to go
-            e = save[-1][0]      # Next element
-            if e.tag not in knownlists:  # don't traverse the known lists
-                if e.text:  # elements have Text, aggregates do not.  However, this checks for children even with text
-                    if len(save)>1 and len(save[-1])>0:
-                        parent = save[-2][0].tag
-                    else:
-                        parent = ""
-                    local.append(XMLPairs(e.tag, e.text,
-                                 "{0}/{1}".format(parent, e.tag)))
-                save.append(e.findall('*'))  # aggregate? If so, empty list will be appended and popped right off next
-            else:
-                if e.tag == listtag:     # Known exception: In the list we wish to process, elevate DTSTART & DTEND
-                    for dttag in ['DTSTART', 'DTEND']:  #  to be context variables, not separate list entries
-                        dt = e.find(dttag)
-                        if dt is not None:
-                            local.append(XMLPairs(dt.tag, dt.text, "{0}/{1}".format(e.tag,dt.tag)))
-                save[-1].pop(0)   # Skip over the lists themselves - just doing upper context here.
-        else:    # No more entries at this level. Pop it off and pop off the head entry just above it.
-            save.pop(-1)
-            if len(save)>0: save[-1].pop(0)
+    local = list(globalvars)  # Walk the subTree, except for the known lists in the uppercontext
+    for e, parent, path in WalkElementTree.Walk(subTree, OFXGlobals.KnownLists, ""):  # this gets all the uppercontext
+        if e.tag not in OFXGlobals.KnownLists:               #  elements whose data goes in every record
+            if e.text:  # elements have Text, aggregates do not
+                local.append(XMLPairs(e.tag, e.text, path))
+        elif e.tag == listtag:     # Known exception: In the list we wish to process, elevate DTSTART & DTEND
+            for dttag in ['DTSTART', 'DTEND']:  #  to be context variables, not separate list entries
+                dt = e.find(dttag)
+                if dt is not None:
+                    local.append(XMLPairs(dt.tag, dt.text, WalkElementTree.TagPath(e.tag, dt.tag)))
     return local
 
 
-def ProcessListEntry(ListEntry:xml.etree.ElementTree.Element, WhatList):  # This adds two special tags not in the OFX spec - ELEMENTNAME & BUYSELL
+def ProcessListEntry(ListEntry:xml.etree.ElementTree.Element, WhatList, DataWriter):  # This adds two special tags not in the OFX spec - ELEMENTNAME & BUYSELL
     match WhatList:  # The BUYSELL pseudo-tag logic could also be migrated to the database, but not ELEMENTNAME logic
         case "INVTRANLIST":
             match ListEntry.tag:
@@ -86,66 +109,479 @@ def ProcessListEntry(ListEntry:xml.etree.ElementTree.Element, WhatList):  # This
                     DataWriter.OFXPutData("BUYSELL","OTHER", "INVTRANLIST/BUYSELL")
     DataWriter.OFXPutData("ELEMENTNAME",ListEntry.tag, WhatList + "/ELEMENTNAME")
 
-#  MAIN PROGRAM STARTS HERE
 
-parameters = OFXtoDataParams.readconfig(sys.argv)
-OFXGlobals.params = parameters
-OFXGlobals.TargetTZ = ZoneInfo(parameters['common']['TimeZone'])  # All timestamps will be cast to this IANA zone name.
-if parameters.has_option('common', 'OFXFile'):
-    OFXfile = parameters['common']['OFXFile']  # Filename can come either from commandline (argv[1]) or .ini file
-else:
-    sys.exit("No OFX file to process")
-knownlists = [e[0].upper() for e in parameters.items('OFXListUniverse')]
-FIStmt = OFXTree()       # Thanks to Chris Singley for his OFXTools.  After these two statements, file has been read in
-FIStmt.parse(OFXfile)    #   and turned into a set of xml.etree.ElementTree.Elements.  Easy to walk this tree.
-OFXGlobals.InThisFile = knownlists   # Chop down the lists to just those present in this file - save some processing later
-for i in reversed(range(len(OFXGlobals.InThisFile))):
-    if FIStmt.find(".//"+ OFXGlobals.InThisFile[i]) is None:
-        OFXGlobals.InThisFile.pop(i)
-XMLPairs = namedtuple("XMLPairs", "tag value alttag")
-globalvars = []
-x = FIStmt.find(".//SONRS//FI")  # As far as I can tell, FID & ORG are the only two elements of interest that are NOT...
-globalvars.append(XMLPairs("FID", x.find("FID").text, "FI/FID"))  # inside the list or 'nearby' the list.  Put them in globalvars,
-globalvars.append(XMLPairs("ORG", x.find("ORG").text, "FI/ORG"))  # where they will be transferred to listvars
-wr = parameters['common']['Writer'] if 'Writer' in parameters['common'] else None
-if wr:
-    if wr in parameters['Writers']:  # See if chosen output formatter (Writer) is in the known list of Writers
-        wrparams = {key:value for (key,value) in parameters.items(wr)} if wr in parameters else None
-    else:
-        sys.exit("{0} is not a valid output choice.  Valid writers are {1}".format(wr,','.join(parameters['Writers'])) )
-else:
-    wrparams=None
-DataWriter = ChooseWriter.WhichWriter(wr,wrparams)
-for OFXList in DataWriter:  # The Writer knows which OFX lists the user is interested in & what order to process
-    searchable = './/' + OFXList
-    if FIStmt.find(searchable) is not None:  # This code checks to see if there is at least one list in the file
-        uppercontext = re.sub(r'(//?)?\w+$','',OFXList)  # Remove the bottom tag to create a 'nearby' context
-        listtag = re.sub(r'^.*?(\w+)$',r'\1',OFXList)
-        if uppercontext:
-            uppercontext = './/' + uppercontext
-        else:
-            uppercontext = './/' + listtag
+# Turn one command line argument (or the OFXFile .ini entry) into the list of statement files it stands for: a directory,
+#   a wildcard pattern, an @manifest file, or just a plain file name.  Manifest entries are relative to the manifest.
+def ExpandOFXFiles(spec):
+    if spec.startswith('@'):
+        manifest = os.path.expandvars(spec[1:])
+        with open(manifest, 'r') as f:
+            entries = [line.strip() for line in f]
+        OFXFiles = []
+        for entry in entries:
+            if entry and not entry.startswith('#'):
+                OFXFiles.extend(ExpandOFXFiles(os.path.join(os.path.dirname(manifest), os.path.expandvars(entry))))
+        return OFXFiles
+    spec = os.path.expandvars(spec)
+    if os.path.isdir(spec):
+        return sorted(os.path.join(spec, fn) for fn in os.listdir(spec) if fn.lower().endswith(OFXFileTypes))
+    if glob.has_magic(spec):
+        return sorted(glob.glob(spec))
+    return [spec]
+
+
+def ReadOFXFile(OFXfile):
+    if OFXGlobals.Parser == 'Stream':
+        open(OFXfile, 'rb').close()   # Nothing is read until the Writer asks, but a missing file should fail here
+        return OFXStream.OFXStream(OFXfile)
+    from ofxtools import OFXTree   # Imported on first use: a Parser = Stream run never needs it
+    FIStmt = OFXTree()       # Thanks to Chris Singley for his OFXTools.  After these two statements, file has been read in
+    FIStmt.parse(OFXfile)    #   and turned into a set of xml.etree.ElementTree.Elements.  Easy to walk this tree.
+    return FIStmt
+
+
+def ListsInFile(FIStmt, lists):   # Chop down the lists to just those present in this file - save some processing later
+    if isinstance(FIStmt, OFXStream.OFXStream):
+        return [e for e in lists if FIStmt.HasTag(e)]
+    return [e for e in lists if FIStmt.find(".//" + e) is not None]
+
+
+# One list entry becomes one record in each table mapped to its list.  The context data (listvars) was already handed
+#   to the Writer with OFXSetContext, so only the entry itself is walked here.
+def ProcessEntry(listentry, listtag, DataWriter):
+    DataWriter.OFXRecStart()
+    ProcessListEntry(listentry, listtag, DataWriter)  # Each list entry tag carries information about the entry type
+    for el, parent, path in WalkElementTree.Walk(listentry):
+        if el.text is not None:
+            DataWriter.OFXPutData(el.tag, el.text, path)
+    DataWriter.OFXRecEnd()
+
+
+# The streaming equivalent of ProcessFile below.  OFXStream hands back each list entry with the context data that
+#   AddData would have found for it, all the lists in one pass over the file and in document order.  The Writer still
+#   takes its lists one after the other, in its own order: the first goes straight to it, and each of the others is
+#   flattened into a RecordCollector on the side and handed over once the pass is done, as MergeFile does for a pool.
+def ProcessStream(FIStmt, DataWriter, Filter=None):
+    FIStmt.Survey(list(DataWriter.OFXListDict))
+    globalvars = [XMLPairs._make(v) for v in FIStmt.FIData()]
+    OFXLists = [OFXList for OFXList in DataWriter if FIStmt.HasList(OFXList)]
+    if not OFXLists:
+        return
+    Writers = {OFXList: OFXWriter.RecordCollector({OFXList: DataWriter.OFXListDict[OFXList]}) for OFXList in OFXLists[1:]}
+    Writers[OFXLists[0]] = DataWriter
+    ListTags = {OFXList: OFXStream.SplitOFXList(OFXList)[1] for OFXList in OFXLists}
+    for OFXList in OFXLists:
+        Writers[OFXList].OFXListStart(OFXList)
+    contextvars = None
+    for OFXList, entryvars, listentry in FIStmt.Entries(OFXLists):
+        if entryvars is not contextvars:   # First entry of a new context
+            contextvars = entryvars
+            listvars = globalvars + [XMLPairs._make(v) for v in contextvars]
+            Writers[OFXList].OFXSetContext(listvars)
+            if Filter is not None:
+                Filter.Context(OFXList, listvars)
+        if Filter is None or Filter.Wanted(listentry):
+            ProcessEntry(listentry, ListTags[OFXList], Writers[OFXList])
+    DataWriter.OFXListEnd()
+    for OFXList in OFXLists[1:]:
+        Writers[OFXList].OFXListEnd()
+        MergeFile(Writers[OFXList].Collected, DataWriter)
+
+
+# Deliver all the records of one parsed statement to the Writer.  This is called once per file, so in batch mode the
+#   same Writer (with its mapping and indexes) sees every file in turn.  Filter, if given, is the ingest ledger's
+#   IngestLedger.DateFilter: it is told about each list context and passes only the entries still to be pushed.
+def ProcessFile(FIStmt, DataWriter, Filter=None):
+    if isinstance(FIStmt, OFXStream.OFXStream):
+        return ProcessStream(FIStmt, DataWriter, Filter)
+    globalvars = []
+    x = FIStmt.find(".//SONRS//FI")  # As far as I can tell, FID & ORG are the only two elements of interest that are NOT...
+    globalvars.append(XMLPairs("FID", x.find("FID").text, "FI/FID"))  # inside the list or 'nearby' the list.  Put them in globalvars,
+    globalvars.append(XMLPairs("ORG", x.find("ORG").text, "FI/ORG"))  # where they will be transferred to listvars
+    for OFXList in DataWriter:  # The Writer knows which OFX lists the user is interested in & what order to process
+        searchable = './/' + OFXList
+        if FIStmt.find(searchable) is not None:  # This code checks to see if there is at least one list in the file
+            uppercontext = re.sub(r'(//?)?\w+$','',OFXList)  # Remove the bottom tag to create a 'nearby' context
+            listtag = re.sub(r'^.*?(\w+)$',r'\1',OFXList)
+            if uppercontext:
+                uppercontext = './/' + uppercontext
+            else:
+                uppercontext = './/' + listtag
+            DataWriter.OFXListStart(OFXList)
+            for listcontext in FIStmt.iterfind(uppercontext):  # Some data sits in an upper context near the OFXList
+                listvars = AddData(listcontext,globalvars,listtag)  # get all data outside the list proper
+                DataWriter.OFXSetContext(listvars)
+                if Filter is not None:
+                    Filter.Context(OFXList, listvars)
+                for listwrapper in listcontext.iter(listtag):
+                    for listentry in listwrapper:
+                        if listentry.tag not in ["DTSTART", "DTEND"] and (Filter is None or Filter.Wanted(listentry)):
+                            ProcessEntry(listentry, listtag, DataWriter)
+            DataWriter.OFXListEnd()
+
+
+# Parallel parsing.  FlattenInit runs once in each worker process to give it what the main process set up before the
+#   pool started (the mapping and the globals); FlattenFile then turns one statement file into its list of
+#   (OFXList, {table: [records]}) pairs.  The worker's exception, if any, comes back as a string so a bad file is
+#   reported and skipped like it is in a sequential batch.  With an ingest ledger date filter the worker also sends
+#   back the date windows the file covered and how many entries it skipped.
+def FlattenInit(OFXListDict, TimeZone, KnownLists, InThisFile, Parser, DateFilter):
+    global Collector, Filter
+    Filter = DateFilter
+    OFXGlobals.Parser = Parser
+    OFXGlobals.TargetTZ = ZoneInfo(TimeZone)
+    OFXGlobals.KnownLists = KnownLists
+    OFXGlobals.InThisFile = InThisFile
+    Collector = OFXWriter.RecordCollector(OFXListDict)
+
+
+def FlattenFile(OFXfile):
+    try:
+        FIStmt = ReadOFXFile(OFXfile)
+        Collector.OFXFileStart(OFXfile)
+        if Filter is not None:
+            Filter.FileStart()
+        ProcessFile(FIStmt, Collector, Filter)   # Nothing reaches the Writer before this is through, so a file that
+    except Exception as err:                     #   fails part way is simply skipped
+        return OFXfile, None, "{0}: {1}".format(type(err).__name__, err), None
+    return OFXfile, Collector.Collected, None, (Filter.Windows, Filter.Skipped) if Filter is not None else None
+
+
+# Yield flattened files in their original order.  Only a couple of files per worker are allowed to run ahead of the
+#   Writer so a slow destination does not let finished records pile up in memory.
+def FlattenInPool(OFXFiles, DataWriter, Workers, TimeZone, DateFilter=None):
+    import concurrent.futures   # Imported on first use: only a parallel batch needs it
+    with concurrent.futures.ProcessPoolExecutor(max_workers=Workers, initializer=FlattenInit,
+                    initargs=(DataWriter.OFXListDict, TimeZone, OFXGlobals.KnownLists, OFXGlobals.InThisFile,
+                              OFXGlobals.Parser, DateFilter)) as pool:
+        pending = []
+        for OFXfile in OFXFiles:
+            pending.append(pool.submit(FlattenFile, OFXfile))
+            if len(pending) >= 2 * Workers:
+                yield pending.pop(0).result()
+        while len(pending) > 0:
+            yield pending.pop(0).result()
+
+
+# Replay one flattened file through the real Writer.
+def MergeFile(Collected, DataWriter):
+    for OFXList, tables in Collected:
         DataWriter.OFXListStart(OFXList)
-        for listcontext in FIStmt.iterfind(uppercontext):  # Some data sits in an upper context near the OFXList
-            listvars = AddData(listcontext,globalvars,listtag)  # get all data outside the list proper
-            for listwrapper in listcontext.iter(listtag):
-                for listentry in listwrapper:
-                    if listentry.tag not in ["DTSTART", "DTEND"]:
-                        DataWriter.OFXRecStart()
-                        ProcessListEntry(listentry, listtag)  # Each list entry tag carries information about the entry type
-                        for lv in listvars:
-                            DataWriter.OFXPutData(lv.tag, lv.value, lv.alttag)
-                        for alldata in WalkElementTree.ElandParent(listentry):
-                            if alldata[0].text is not None:
-                                DataWriter.OFXPutData(alldata[0].tag, alldata[0].text, "{0}{1}".format(
-                                            alldata[1].tag + "/" if alldata[1] is not None else "", alldata[0].tag))
-                        DataWriter.OFXRecEnd()
+        DataWriter.OFXAddRecords(tables)
         DataWriter.OFXListEnd()
-DataWriter.OFXAllDone()
-if len(DataWriter.Stats)>0:
-    print("{0:25}{1:>10}{2:>10}".format(DataWriter.destination[0:24],'Added','Updated'))
-    print("{0:25}{1:>10}{2:>10}".format(DataWriter.destination[25:49],'New','Existing'))
-    for table,t in DataWriter.Stats.items():
-        print("{0:25}{1:>10d}{2:>10d}".format(table,t[0],t[1]))
-else:
-    print("No relevant lists in the datafile.  No records were processed")
+
+
+# A file failed part way through (a value that will not convert, a data base error...).  The Writer throws away what it
+#   can of it (OFXFileAbort).  When the Writer stores each file as it ends and the abort really takes all of this one
+#   back, the files before it are safe and the batch goes on without it, as the ingest service does; True says so.
+#   Otherwise either the earlier files were not stored yet (a workbook, CommitEvery = Run) or part of this one stays in
+#   the output (CSV files already appended to), so the run had better stop: False, and the caller re-raises.
+def FileFailed(OFXfile, err, DataWriter):
+    DataWriter.OFXFileAbort()
+    if not (DataWriter.SavedAtFileEnd and DataWriter.UndoesFile):
+        return False
+    print("Skipping {0}: failed part way through - {1}: {2}".format(OFXfile, type(err).__name__, err))
+    return True
+
+
+# Pipeline = Async.  Produce runs in a thread of its own: it parses each file and flattens it with a RecordCollector,
+#   handing each finished list to Put as ('List', file, (OFXList, {table: [records]})), then ('End', file, Filtered)
+#   when the file is done, ('Abort', file, exception) when it failed part way through, or ('Skip', file, error) when it
+#   cannot be read.  None ends the stream.  Put blocks while
+#   PipelineDepth lists are waiting, so a slow destination does not let finished records pile up in memory.  As the
+#   producer runs ahead of the Writer, Incremental = Yes uses the watermarks from before the run, as a pool does.
+class PipelineStopped(Exception):   # The writer stage failed: the producer gives up at its next Put
+    pass
+
+
+def Produce(OFXFiles, FIStmt, OFXListDict, Filter, Put):
+    def Deliver(OFXList, tables):
+        Put(('List', OFXfile, (OFXList, tables)))
+    Collector = OFXWriter.RecordCollector(OFXListDict, Deliver)
+    try:
+        for OFXfile in OFXFiles:
+            if FIStmt is not None:
+                thisStmt = FIStmt
+            else:
+                try:
+                    thisStmt = ReadOFXFile(OFXfile)
+                except Exception as err:
+                    Put(('Skip', OFXfile, str(err)))
+                    continue
+            try:
+                Collector.OFXFileStart(OFXfile)
+                if Filter is not None:
+                    Filter.FileStart()
+                ProcessFile(thisStmt, Collector, Filter)
+            except PipelineStopped:
+                raise
+            except Exception as err:   # The writer stage decides what becomes of the file and the run (FileFailed)
+                Put(('Abort', OFXfile, err))
+                continue
+            Filtered = (Filter.Windows, Filter.Skipped) if Filter is not None else None
+            if Filtered:
+                Filter.Add(Filtered[0])   # Later files are checked against this one's windows, as in a sequential run
+            Put(('End', OFXfile, Filtered))
+    finally:
+        Put(None)
+
+
+# The writer stage.  Every Writer event runs in one thread of its own, one list at a time and in the order the lists were
+#   queued, while the event loop keeps taking lists from the producer.  A file that fails part way through, in either
+#   stage, is aborted and then skipped or ends the run just as in a sequential batch (FileFailed); what is left of it
+#   in the queue is passed over.  Anything else that goes wrong ends the run, after the producer is stopped.  Returns
+#   the per file statistics.
+async def Pipeline(OFXFiles, FIStmt, DataWriter, Depth, Filter, ledger, metrics):
+    import asyncio   # Imported where it is used: it pulls in ssl & more, which a run without Pipeline = Async never needs
+    import concurrent.futures
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(Depth)
+    stop = threading.Event()
+
+    def Put(item):   # From the producer thread
+        if stop.is_set():
+            raise PipelineStopped()
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='OFXWriter')
+    producer = asyncio.ensure_future(asyncio.to_thread(Produce, OFXFiles, FIStmt, DataWriter.OFXListDict, Filter, Put))
+    PerFile = {}
+    current = None
+    dropped = None   # The file that failed, if its remaining lists are still coming
+    try:
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            kind, OFXfile, payload = item
+            if kind == 'Skip':
+                print("Skipping {0}: {1}".format(OFXfile, payload))
+                continue
+            if OFXfile == dropped:
+                if kind != 'List':   # Its last item
+                    dropped = None
+                continue
+            try:
+                if OFXfile != current:
+                    current = OFXfile
+                    metrics.FileRead(OFXfile)
+                    before = {table: list(t) for table, t in DataWriter.Stats.items()}
+                    await loop.run_in_executor(writer, DataWriter.OFXFileStart, OFXfile)
+                if kind == 'Abort':
+                    raise payload
+                if kind == 'List':
+                    await loop.run_in_executor(writer, MergeFile, [payload], DataWriter)
+                    continue
+                await loop.run_in_executor(writer, DataWriter.OFXFileEnd)
+            except Exception as err:
+                current = None
+                dropped = OFXfile if kind == 'List' else None
+                if not await loop.run_in_executor(writer, FileFailed, OFXfile, err, DataWriter):
+                    raise
+                continue
+            current = None
+            PerFile[OFXfile] = StatsDelta(before, DataWriter.Stats)
+            if ledger is not None:
+                ledger.Record(OFXfile, payload[0] if payload else ())
+                if DataWriter.SavedAtFileEnd:
+                    ledger.Commit()
+            if payload and payload[1]:
+                print("{0}: {1} entries already loaded were skipped".format(os.path.basename(OFXfile), payload[1]))
+        await producer
+    except BaseException:
+        stop.set()
+        while not producer.done():   # Make room for a Put the producer may be waiting on, so that it sees stop
+            while not queue.empty():
+                queue.get_nowait()
+            await asyncio.wait({producer}, timeout=0.1)
+        failed = None if producer.cancelled() else producer.exception()
+        if failed is None or isinstance(failed, PipelineStopped):
+            raise
+        raise failed   # A parse error is the one to report
+    finally:
+        writer.shutdown()
+    return PerFile
+
+
+def PipelineDepth(parameters):   # Lists queued between the stages with Pipeline = Async; 0 for a sequential run
+    setting = parameters['common'].get('Pipeline', 'Sequential').strip()
+    if setting.upper() == 'SEQUENTIAL':
+        return 0
+    if setting.upper() != 'ASYNC':
+        sys.exit("Pipeline must be Sequential or Async, not {0}".format(setting))
+    try:
+        depth = int(parameters['common'].get('PipelineDepth', '4'))
+    except ValueError:
+        depth = 0
+    if depth < 1:
+        sys.exit("PipelineDepth must be a number of lists, not {0}".format(parameters['common'].get('PipelineDepth')))
+    return depth
+
+
+def ParallelWorkers(parameters):
+    setting = parameters['common'].get('ParallelWorkers', '0').strip()
+    if setting.upper() == 'AUTO':
+        return os.cpu_count() or 1
+    try:
+        return int(setting)
+    except ValueError:
+        sys.exit("ParallelWorkers must be a number or Auto, not {0}".format(setting))
+
+
+def PrintStats(destination, Stats):
+    print("{0:25}{1:>10}{2:>10}{3:>10}".format(destination[0:24],'Added','Updated','Dropped'))
+    print("{0:25}{1:>10}{2:>10}{3:>10}".format(destination[25:49],'New','Existing','Dups'))
+    for table,t in Stats.items():
+        print("{0:25}{1:>10d}{2:>10d}{3:>10d}".format(table,t[0],t[1],t[2]))
+
+
+# The counts one file added to each table's Stats.  before is a copy of Stats taken before the file was processed.
+def StatsDelta(before, Stats):
+    return {table: [n - m for n, m in zip(t, before.get(table, [0] * len(t)))] for table, t in Stats.items()}
+
+
+# Read the .ini (plus command line) and set up the globals every part of the program relies on.
+def Configure(argv):
+    parameters = OFXtoDataParams.readconfig(argv)
+    OFXGlobals.params = parameters
+    OFXGlobals.TargetTZ = ZoneInfo(parameters['common']['TimeZone'])  # All timestamps will be cast to this IANA zone name.
+    OFXGlobals.Parser = parameters['common'].get('Parser', 'OFXTree')
+    if OFXGlobals.Parser not in ('OFXTree', 'Stream'):
+        sys.exit("Parser must be OFXTree or Stream, not {0}".format(OFXGlobals.Parser))
+    OFXGlobals.KnownLists = [e[0].upper() for e in parameters.items('OFXListUniverse')]
+    return parameters
+
+
+# Create the Writer chosen in [common].  overrides, if given, replace entries in the Writer's own .ini section.
+def MakeWriter(parameters, overrides=None):
+    wr = parameters['common']['Writer'] if 'Writer' in parameters['common'] else None
+    if wr:
+        if wr in parameters['Writers'] or ChooseWriter.IsWriter(wr):  # Is the chosen Writer known, or a plug-in?
+            wrparams = {key:value for (key,value) in parameters.items(wr)} if wr in parameters else None
+        else:
+            sys.exit("{0} is not a valid output choice.  Valid writers are {1}".format(
+                wr, ','.join(list(parameters['Writers']) + list(ChooseWriter.Plugins()))))
+        if overrides:
+            wrparams = dict(wrparams or {}, **overrides)
+    else:
+        wrparams=None
+    DataWriter = ChooseWriter.WhichWriter(wr,wrparams)
+    if OFXGlobals.Parser == 'Stream':
+        unsupported = [OFXList for OFXList in DataWriter.OFXListDict if not OFXStream.Supported(OFXList)]
+        if unsupported:
+            sys.exit("Parser = Stream cannot follow the OFX list path(s) {0}.  Use Parser = OFXTree".format(
+                ', '.join(unsupported)))
+    return DataWriter
+
+
+def main(argv):
+    parameters = Configure(argv)
+    metrics = OFXMetrics.FromConfig(parameters)   # Timings and counts, when [Metrics] Enabled = Yes
+    OFXFiles = []
+    if parameters.has_option('common', 'OFXFile'):
+        for spec in [parameters['common']['OFXFile']] + argv[2:]:  # Filename can come either from commandline (argv[1]) or .ini file
+            OFXFiles.extend(ExpandOFXFiles(spec))
+    if len(OFXFiles) == 0:
+        sys.exit("No OFX file to process")
+    ledger = IngestLedger.FromConfig(parameters, parameters['common'].get('Writer'))   # [Ledger] Enabled = Yes
+    if ledger is not None:
+        OFXFiles = ledger.NewFiles(OFXFiles)   # Files already ingested are skipped before they are parsed
+        if len(OFXFiles) == 0:
+            print("Nothing new to process")
+            return
+    if len(OFXFiles) == 1:  # Single file: read it first so the Writer only maps the lists actually in this file
+        with metrics.Stage('parse'):
+            FIStmt = ReadOFXFile(OFXFiles[0])
+        OFXGlobals.InThisFile = ListsInFile(FIStmt, OFXGlobals.KnownLists)
+    else:                   # Batch: the Writer is built once, so it has to be ready for any list in any file
+        FIStmt = None
+        OFXGlobals.InThisFile = list(OFXGlobals.KnownLists)
+    with metrics.Stage('writer_init'):
+        DataWriter = MakeWriter(parameters)
+    if ledger is not None and IngestLedger.CheckWriter(DataWriter):
+        sys.exit(IngestLedger.CheckWriter(DataWriter))
+    metrics.Instrument(DataWriter)
+    Workers = ParallelWorkers(parameters) if len(OFXFiles) > 1 and DataWriter.Parallelizable else 0
+    Depth = PipelineDepth(parameters) if Workers <= 1 and DataWriter.Parallelizable else 0   # A pool parses ahead already
+    watermarks = IngestLedger.WatermarksFromConfig(parameters)   # Incremental = Yes
+    Filter = IngestLedger.Combine(ledger.Filter() if ledger is not None else None, watermarks)
+    if Depth:   # Pipeline = Async
+        if watermarks is not None:
+            watermarks.Refresh(DataWriter)
+        with metrics.Stage('process'):
+            import asyncio
+            PerFile = asyncio.run(Pipeline(OFXFiles, FIStmt, DataWriter, Depth, Filter, ledger, metrics))
+    else:
+        if Workers > 1:
+            if watermarks is not None:
+                watermarks.Refresh(DataWriter)
+            Flattened = FlattenInPool(OFXFiles, DataWriter, Workers, parameters['common']['TimeZone'], Filter)
+        else:
+            Flattened = ((OFXfile, None, None, None) for OFXfile in OFXFiles)
+        PerFile = {}
+        for OFXfile, Collected, err, Filtered in Flattened:
+            if err is not None:
+                print("Skipping {0}: {1}".format(OFXfile, err))
+                continue
+            if Collected is None and FIStmt is None:
+                try:
+                    with metrics.Stage('parse'):
+                        thisStmt = ReadOFXFile(OFXfile)
+                except Exception as err:   # One unreadable download should not sink the rest of a nightly batch
+                    print("Skipping {0}: {1}".format(OFXfile, err))
+                    continue
+            else:
+                thisStmt = FIStmt
+            metrics.FileRead(OFXfile)
+            before = {table: list(t) for table, t in DataWriter.Stats.items()}
+            try:
+                DataWriter.OFXFileStart(OFXfile)
+                if Filter is not None and Collected is None:
+                    if watermarks is not None:
+                        watermarks.Refresh(DataWriter)   # What the files before this one added counts too
+                    Filter.FileStart()
+                with metrics.Stage('process'):
+                    if Collected is None:
+                        ProcessFile(thisStmt, DataWriter, Filter)
+                        Filtered = (Filter.Windows, Filter.Skipped) if Filter is not None else None
+                    else:
+                        MergeFile(Collected, DataWriter)
+                DataWriter.OFXFileEnd()
+            except Exception as err:
+                if not FileFailed(OFXfile, err, DataWriter):
+                    raise
+                continue
+            PerFile[OFXfile] = StatsDelta(before, DataWriter.Stats)
+            if ledger is not None:
+                ledger.Record(OFXfile, Filtered[0] if Filtered else ())
+                if DataWriter.SavedAtFileEnd:
+                    ledger.Commit()
+            if Filtered:
+                Filter.Add(Filtered[0])
+                if Filtered[1]:
+                    print("{0}: {1} entries already loaded were skipped".format(
+                        os.path.basename(OFXfile), Filtered[1]))
+    DataWriter.OFXAllDone()
+    metrics.Report(DataWriter)
+    if ledger is not None:
+        ledger.Commit()   # Everything the Writer was handed is stored now
+        ledger.Close()
+    if len(DataWriter.Stats)>0:
+        PrintStats(DataWriter.destination, DataWriter.Stats)
+        if len(OFXFiles) > 1:
+            for OFXfile, FileStats in PerFile.items():
+                print()
+                print(os.path.basename(OFXfile))
+                for table,t in FileStats.items():
+                    print("  {0:23}{1:>10d}{2:>10d}{3:>10d}".format(table,t[0],t[1],t[2]))
+    else:
+        print("No relevant lists in the datafile.  No records were processed")
+
+
+#  MAIN PROGRAM STARTS HERE
+
+if __name__ == '__main__':
+    if getattr(sys, 'frozen', False):   # Worker processes of a PyInstaller-built .exe must not re-run the main program
+        import multiprocessing
+        multiprocessing.freeze_support()
+    main(sys.argv)
@@ -9,7 +9,7 @@ a = Analysis(
     pathex=[],
     binaries=[],
     datas=[],
-    hiddenimports=[],
+    hiddenimports=['PostgresWriter', 'ExcelWriter', 'CSVWriter', 'SQLiteWriter', 'ParquetWriter'],  # ChooseWriter imports these by name
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
@@ -12,6 +12,16 @@ def readconfig(argv):
     [common]
     TimeZone = America/New_York
     Writer = Postgres
+    ParallelWorkers = 0
+    Pipeline = Sequential
+    PipelineDepth = 4
+    Parser = OFXTree
+    DuplicatePolicy = FirstWins
+    Incremental = No
+    SpillRecords = 0
+    SpillDirectory =
+    ChunkSize = 0
+    CompiledMapping =
     
     [Postgres]
     host=localhost
@@ -19,23 +29,61 @@ def readconfig(argv):
     dbname=postgres
     user=postgres
     OFXmapping = OFX_to_Tables
+    CommitEvery = File
+    
+    [Daemon]
+    PollSeconds = 5
+    SettleSeconds = 2
+    SocketPort = 0
+    SocketToken =
+    PoolSize = 2
+    
+    [Excel]
+    IndexInProcesses = 5000
     
     [CSV]
     WhenToQuote = SeparatorOnly
     ExcelCompatibility = Yes
     QuoteChar = "
     ColumnSeparator = ,
+    PKIndex = No
+    Append = No
+    Stream = No
+    Compress = None
+    
+    [SQLite]
+    Database = OFXtoDB.sqlite
+    CommitEvery = File
+    
+    [Parquet]
+    PartitionBy =
+    Mode = Upsert
+    Compression = snappy
+    DecimalPrecision = 18
+    DecimalScale = 6
+    
+    [Metrics]
+    Enabled = No
+    JSONFile = OFXtoDB.metrics.json
+    PrometheusFile =
+    
+    [Ledger]
+    Enabled = No
+    LedgerFile = OFXtoDB.ledger
+    SkipOverlap = No
     '''
 
     NoOverride = '''# These are internal parameters that cannot be altered/overridden.
     [common]
     {0}
     
-    # Includes the list of supported Writers which must accurately reflect those in ChooseWriter.
+    # Includes the list of built-in Writers which must accurately reflect the Registry in ChooseWriter.
     [Writers]
     Postgres
     Excel
     CSV
+    Parquet
+    SQLite
     
     [OFXListUniverse]
     SECLIST
@@ -57,5 +105,6 @@ def readconfig(argv):
         if platform.system()=="Windows": f = open(os.path.expandvars("%APPDATA%\OFXtoDB\OFXtoDB.ini"), 'r')
     cf.read_file(f, 'ExternalFile')
     f.close()
+    cf.IniFile = os.path.abspath(f.name)   # Where the mapping came from, for the compiled mapping's staleness check
     cf.read_string(NoOverride, 'internals')
     return cf
@@ -0,0 +1,89 @@
+#  A compact on-disk primary key index for the Writers whose output is a plain file (Excel and CSV).  Without one they
+#  either re-read every row of their output to find out what is already there (Excel) or cannot tell at all (CSV).
+#
+#  The store is a small SQLite data base.  Each output table has one row in Tables, saying which primary key columns
+#  the index is built on, how many rows the output holds, and a stamp (size & modification time) of the output file as
+#  it was when the index was last brought up to date.  Keys holds one row per primary key: the pickled PK tuple and its
+#  location in the output (the row number).  A Writer trusts the index only when the stamp still matches the file, so
+#  an output file edited or replaced behind our back is simply re-indexed once.  New keys are added as they are written,
+#  so keeping the index current costs in proportion to the new data, not to the size of the output.
+
+import os
+import pickle
+import sqlite3
+
+StoreVersion = 1
+FindChunk = 500   # Keys per SELECT ... IN (...) when looking up a batch of keys
+
+
+def FileStamp(filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return "{0}:{1}".format(st.st_size, st.st_mtime_ns)
+
+
+def KeyBytes(PK):
+    return pickle.dumps(PK, protocol=4)
+
+
+class PKIndexStore:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        try:
+            version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        except sqlite3.DatabaseError:   # Not a data base at all (an index file of some older kind): it is only an index
+            self.db.close()
+            os.remove(filename)
+            self.db = sqlite3.connect(filename)
+            version = None
+        if version != StoreVersion:
+            self.db.executescript("DROP TABLE IF EXISTS Tables; DROP TABLE IF EXISTS Keys;")
+            self.db.execute("PRAGMA user_version = {0}".format(StoreVersion))
+        self.db.execute("CREATE TABLE IF NOT EXISTS Tables (tbl TEXT PRIMARY KEY, pkcols TEXT, rows INTEGER, stamp TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS Keys (tbl TEXT, pk BLOB, loc INTEGER, PRIMARY KEY (tbl, pk))"
+                        " WITHOUT ROWID")
+        self.db.commit()
+
+    # The row count the index describes, or None when there is no usable index for the table: never built, built on other
+    #   primary key columns, or the output file has changed since.
+    def Rows(self, table, PKCols, stamp):
+        found = self.db.execute("SELECT pkcols, rows, stamp FROM Tables WHERE tbl = ?", (table,)).fetchone()
+        if found is None or found[0] != '\t'.join(PKCols) or stamp is None or found[2] != stamp:
+            return None
+        return found[1]
+
+    def Load(self, table):   # The whole index of a table as a {PK: location} dictionary
+        return {pickle.loads(pk): loc for pk, loc in self.db.execute("SELECT pk, loc FROM Keys WHERE tbl = ?", (table,))}
+
+    def Find(self, table, PKs):   # Just the given keys that are already in the index, {PK: location}
+        found = {}
+        PKs = list(PKs)
+        for start in range(0, len(PKs), FindChunk):
+            chunk = {KeyBytes(PK): PK for PK in PKs[start:start + FindChunk]}
+            for pk, loc in self.db.execute("SELECT pk, loc FROM Keys WHERE tbl = ? AND pk IN ({0})".format(
+                    ','.join('?' * len(chunk))), [table] + list(chunk)):
+                found[chunk[pk]] = loc
+        return found
+
+    def Add(self, table, entries):   # entries is {PK: location}
+        self.db.executemany("INSERT OR REPLACE INTO Keys (tbl, pk, loc) VALUES (?, ?, ?)",
+                            ((table, KeyBytes(PK), loc) for PK, loc in entries.items()))
+
+    def Replace(self, table, entries):   # Throw away the table's index and start over from entries
+        self.db.execute("DELETE FROM Keys WHERE tbl = ?", (table,))
+        self.Add(table, entries)
+
+    def Mark(self, table, PKCols, rows, stamp):   # Record the state of the output file the index now describes
+        self.db.execute("INSERT OR REPLACE INTO Tables (tbl, pkcols, rows, stamp) VALUES (?, ?, ?, ?)",
+                        (table, '\t'.join(PKCols), rows, stamp))
+
+    def Commit(self):
+        self.db.commit()
+
+    def Close(self):
+        self.db.commit()
+        self.db.close()
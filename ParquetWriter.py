@@ -0,0 +1,172 @@
+#  A Writer for analytics: each table becomes a Hive-partitioned Parquet dataset (a directory tree of Parquet files) that
+#  pandas, DuckDB, Spark and friends read directly, typed, without parsing text back the way a CSV file must be.
+#
+#  Column types come from the typcategory in the mapping (the same one-letter format that picks the converter):
+#    N -> decimal128(DecimalPrecision, DecimalScale), D and DATE -> timestamp, B -> bool, S and E -> string.
+#
+#  [Parquet] parameters:
+#    WriteToDirectory   where the datasets go, one subdirectory per table.
+#    PartitionBy        comma separated partition columns, e.g. "AcctNbr, year".  Each table uses the ones it has.
+#                       "year" is the year of the table's first date column.  Leave empty for no partitions.
+#    Mode               Upsert (the default) replaces rows with the same primary key, Append just adds the new rows.
+#                       Upsert rewrites the partitions the new rows fall into, which assumes the partition columns of a
+#                       record never change (an account number, a trade date).
+#    Compression        anything pyarrow.parquet knows: snappy (the default), zstd, gzip, none...
+#
+#  The rows of all lists in a statement file are gathered per table and written together at the end of the file, so
+#  each file adds one Parquet file per partition rather than one per list.
+
+import OFXWriter
+import uuid
+from decimal import Decimal
+from os import path
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.dataset
+except ImportError:     # Only needed when this Writer is chosen
+    pyarrow = None
+
+
+class ParquetWriter(OFXWriter.Writer):
+    UndoesFile = True   # Nothing is written before OFXFileEnd
+    def __init__(self, plist):
+        if pyarrow is None:
+            raise OFXWriter.ConfigurationError("The Parquet Writer needs the pyarrow package (pip install pyarrow)")
+        self.savedir = path.expandvars(plist['WriteToDirectory'] if 'WriteToDirectory' in plist else ".")
+        self.PartitionBy = [p.strip() for p in plist.get('PartitionBy', '').split(',') if p.strip()]
+        self.Mode = plist.get('Mode', 'Upsert')
+        if self.Mode not in ('Upsert', 'Append'):
+            raise OFXWriter.ConfigurationError("Mode in [Parquet] must be Upsert or Append, not {0}".format(self.Mode))
+        self.Compression = plist.get('Compression', 'snappy')
+        self.Precision = int(plist.get('DecimalPrecision', '18'))
+        self.Quantum = Decimal(1).scaleb(-int(plist.get('DecimalScale', '6')))
+        self.destination = 'Parquet Datasets'
+        self.__pending = {}   # Table -> {PK: record} gathered for the current file
+        super().__init__(plist)
+        self.__layouts = {}
+        for OFXList in self.OFXListDict:
+            for EachTable, datatuple in self.OFXListDict[OFXList].items():
+                if EachTable not in self.__layouts:
+                    self.__layouts[EachTable] = self.__Layout(datatuple[0])
+
+#   For one table: the Arrow schema, a converter per column, the partition columns, and where "year" comes from.
+    def __Layout(self, specs):
+        fmts = {}
+        for entry in specs.OFXDict.values():
+            fmts.setdefault(entry.pos, entry.fmt)
+        fields = []
+        fixes = []
+        yearfrom = None
+        for col, pos in specs.Cols.items():
+            fmt = fmts.get(pos, 'S')
+            if fmt == 'N':
+                fields.append(pyarrow.field(col, pyarrow.decimal128(self.Precision, self.Quantum.as_tuple().exponent * -1)))
+                fixes.append(self.__Quantize)
+            elif fmt in ('D', 'DATE'):
+                fields.append(pyarrow.field(col, pyarrow.timestamp('us')))
+                fixes.append(None)
+                if yearfrom is None:
+                    yearfrom = pos
+            elif fmt == 'B':
+                fields.append(pyarrow.field(col, pyarrow.bool_()))
+                fixes.append(None)
+            else:
+                fields.append(pyarrow.field(col, pyarrow.string()))
+                fixes.append(None)
+        partitions = [p for p in self.PartitionBy if p in specs.Cols or (p == 'year' and yearfrom is not None)]
+        if 'year' in partitions and 'year' not in specs.Cols:
+            fields.append(pyarrow.field('year', pyarrow.int32()))
+        else:
+            yearfrom = None
+        schema = pyarrow.schema(fields)
+        return schema, fixes, partitions, yearfrom, tuple(specs.PKCols)
+
+    def __Quantize(self, value):   # decimal128 has a fixed scale, so round to it rather than have pyarrow refuse the value
+        return value.quantize(self.Quantum)
+
+    def __Arrow(self, EachTable, records):
+        schema, fixes, partitions, yearfrom, PKCols = self.__layouts[EachTable]
+        columns = [list(col) for col in zip(*records)] if records else [[] for fix in fixes]
+        for col, fix in zip(columns, fixes):
+            if fix is not None:
+                col[:] = [None if value is None else fix(value) for value in col]
+        if yearfrom is not None:
+            columns.append([None if rec[yearfrom] is None else rec[yearfrom].year for rec in records])
+        return pyarrow.Table.from_arrays([pyarrow.array(col, type=field.type) for col, field in zip(columns, schema)],
+                                         schema=schema)
+
+#   Incremental mode: the latest date per account in a table's dataset, as written by the files before this one.
+    def Watermarks(self, EachTable, datecol, acctcol):
+        tabledir = path.join(self.savedir, EachTable)
+        if not path.isdir(tabledir):
+            return {}
+        schema, fixes, partitions, yearfrom, PKCols = self.__layouts[EachTable]
+        partitioning = pyarrow.dataset.partitioning(
+            pyarrow.schema([schema.field(p) for p in partitions]), flavor='hive') if partitions else None
+        table = pyarrow.dataset.dataset(tabledir, schema=schema, format='parquet', partitioning=partitioning).to_table(
+            columns=[acctcol, datecol])
+        return {row[acctcol]: row[datecol + '_max']
+                for row in table.group_by(acctcol).aggregate([(datecol, 'max')]).to_pylist()}
+
+    def OFXFileStart(self, ofxfile):
+        self.__pending = {}
+
+    def OFXListEnd(self):
+        if self.curOFXList is not None:
+            for EachTable in self.curOFXList:
+                self.TableStats(EachTable)
+                pending = self.__pending.setdefault(EachTable, {})
+                for rec, PK in zip(self.Records(EachTable), self.Records(EachTable).Keys()):
+                    pending[PK] = rec   # A later list's version of a record replaces an earlier one, as an update would
+
+    def OFXFileEnd(self):
+        for EachTable, pending in self.__pending.items():
+            if pending:
+                self.__WriteTable(EachTable, list(pending.values()))
+        self.__pending = {}
+
+    def OFXFileAbort(self):
+        self.__pending = {}
+
+    def OFXAllDone(self):
+        self.OFXFileEnd()   # Anything not yet written by a file end
+
+#   Append writes the new rows as new files.  Upsert reads back the partitions the new rows fall into, keeps the old rows
+#     whose primary key is not among the new ones, and writes the partitions afresh (delete_matching clears each one).
+    def __WriteTable(self, EachTable, records):
+        schema, fixes, partitions, yearfrom, PKCols = self.__layouts[EachTable]
+        tabledir = path.join(self.savedir, EachTable)
+        newrows = self.__Arrow(EachTable, records)
+        partitioning = pyarrow.dataset.partitioning(
+            pyarrow.schema([schema.field(p) for p in partitions]), flavor='hive') if partitions else None
+        existing = None
+        if self.Mode == 'Upsert' and path.isdir(tabledir):
+            olddata = pyarrow.dataset.dataset(tabledir, schema=schema, format='parquet', partitioning=partitioning)
+            if partitions:
+                touched = None
+                for values in set(zip(*[newrows.column(p).to_pylist() for p in partitions])):
+                    match = None
+                    for p, value in zip(partitions, values):
+                        test = pyarrow.compute.field(p).is_null() if value is None else pyarrow.compute.field(p) == value
+                        match = test if match is None else match & test
+                    touched = match if touched is None else touched | match
+                existing = olddata.to_table(filter=touched)
+            else:
+                existing = olddata.to_table()
+        replaced = 0
+        if existing is not None and existing.num_rows > 0:
+            if PKCols:
+                newPKs = set(zip(*[newrows.column(pk).to_pylist() for pk in PKCols]))
+                keep = [PK not in newPKs for PK in zip(*[existing.column(pk).to_pylist() for pk in PKCols])]
+                replaced = keep.count(False)
+                existing = existing.filter(pyarrow.array(keep, type=pyarrow.bool_()))
+            newrows = pyarrow.concat_tables([existing.select(schema.names), newrows])
+        self.Stats[EachTable][0] += len(records) - replaced
+        self.Stats[EachTable][1] += replaced
+        pyarrow.dataset.write_dataset(
+            newrows, tabledir, format='parquet', partitioning=partitioning,
+            basename_template='part-{0}-{{i}}.parquet'.format(uuid.uuid4().hex),
+            existing_data_behavior='delete_matching' if self.Mode == 'Upsert' else 'overwrite_or_ignore',
+            file_options=pyarrow.dataset.ParquetFileFormat().make_write_options(
+                compression=None if self.Compression.lower() == 'none' else self.Compression))
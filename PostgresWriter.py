@@ -1,6 +1,50 @@
+import OFXGlobals
 import OFXWriter
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
+import datetime
+import hashlib
+import io
+import json
+import os
+
+CopyEscapes = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+# One value in COPY's text format: \N for NULL, t/f for booleans, and backslash escapes for the few characters that
+#   would otherwise end a field or a row.
+def CopyField(field):
+    if field is None:
+        return '\\N'
+    if field is True or field is False:
+        return 't' if field else 'f'
+    if isinstance(field, datetime.datetime):
+        return field.isoformat(' ')
+    return str(field).translate(CopyEscapes)
+
+
+# Connection pools, one per distinct set of connection parameters.  A Writer only draws from a pool when PoolSize in
+#   [Postgres] is above 0, which is what a long-running process such as OFXDaemon wants: a connection that died while
+#   idle is replaced instead of ending the process, and connections stay open (and warm) between files.
+ConnectionPools = {}
+
+def Connect(poolsize, **connectargs):
+    if poolsize <= 0:
+        return psycopg2.connect(**connectargs)
+    key = tuple(sorted(connectargs.items()))
+    if key not in ConnectionPools:
+        ConnectionPools[key] = psycopg2.pool.ThreadedConnectionPool(1, poolsize, **connectargs)
+    return ConnectionPools[key].getconn()
+
+def Release(session, poolsize, discard=False, closepool=False, **connectargs):
+    if poolsize <= 0:
+        session.close()
+    else:
+        key = tuple(sorted(connectargs.items()))
+        ConnectionPools[key].putconn(session, close=discard)
+        if closepool:
+            ConnectionPools.pop(key).closeall()
 
 
 class PostgresDBWriter(OFXWriter.Writer):
@@ -13,7 +57,18 @@ class PostgresDBWriter(OFXWriter.Writer):
         self.__schema = plist['schema'] if 'schema' in plist else None
         mappingsource = plist['mapping'] if 'mapping' in plist else None
         mappingtable = plist['OFXmapping'] if 'OFXmapping' in plist else None
-        self.DBSession = psycopg2.connect(host=phost, port=pport, dbname=pdbname, user=puser, password=ppwd)
+        self.__commitevery = plist['CommitEvery'] if 'CommitEvery' in plist else 'File'
+        if self.__commitevery not in ('Table', 'File', 'Run'):
+            raise OFXWriter.ConfigurationError("CommitEvery must be Table, File or Run, not {0}".format(self.__commitevery))
+        self.SavedAtFileEnd = self.__commitevery != 'Run'
+        self.UndoesFile = True   # OFXFileAbort rolls back to the last commit
+        self.__statements = {}
+        mappingcache = plist['MappingCache'] if 'MappingCache' in plist else MappingCacheFile(
+            phost, pport, pdbname, self.__schema, mappingtable)
+        mappingcache = None if mappingcache.upper() in ('', 'OFF', 'NO', 'NONE') else os.path.expandvars(mappingcache)
+        self.__poolsize = int(plist['PoolSize']) if 'PoolSize' in plist else 0
+        self.__connectargs = {'host': phost, 'port': pport, 'dbname': pdbname, 'user': puser, 'password': ppwd}
+        self.DBSession = Connect(self.__poolsize, **self.__connectargs)
         curs = self.DBSession.cursor()
         curs.execute("select version()")
         self.destination = curs.fetchone()[0].split(",")[0]
@@ -24,78 +79,213 @@ class PostgresDBWriter(OFXWriter.Writer):
 #  specification gatherer in Postgres is a query that is aware of foreign key relationships between tables and will
 #  re-order the processing of OFXLists and tables automatically to avoid referential integrity problems.
         if mappingsource!='UseIniFile':
-            self.MapSrc = MappingFromDB(self.__schema,self.DBSession,mappingtable)
+            self.MapSrc = MappingFromDB(self.__schema,self.DBSession,mappingtable,mappingcache)
         super().__init__(plist)     # Finish the mapping spec processing in the base class init using MappingFromDB
                                     #  class (below) to deliver the mapping record-by-record.
 
 # Most of the data accumulation logic has been placed into the superclass (in OFXWriter) and only the actual data base
 #   interfacing logic (query mapping specs and db Writes/Updates) is kept here.
 
-#   Now that an entire OFX list is complete, do a 2-step write to the DB.  First, write it all to an identical TEMP
-#     table in the DB. Then execute a MERGE to not duplicate any common keys.  I was on the fence as to whether to
-#     delete from DTSTART to DTEND first, in case intervening corrections have removed items at the F.I.  But ultimately
-#     I did not do it.
+#   Now that an entire OFX list is complete, do a 2-step write to the DB.  First, COPY it all into an identical TEMP
+#     staging table in the DB. Then execute a MERGE to not duplicate any common keys.  I was on the fence as to whether
+#     to delete from DTSTART to DTEND first, in case intervening corrections have removed items at the F.I.  But
+#     ultimately I did not do it.  The staging table ("<table>_Hold") is created the first time a table is written and
+#     then just truncated and reused for the rest of the session.  On PostgreSQL 17 and later the MERGE itself reports
+#     which rows it inserted and which it updated (RETURNING merge_action()); older servers get a count of matching
+#     keys before the MERGE instead.  Commits happen once per file by default (CommitEvery = File in [Postgres]);
+#     Table commits after every table as older releases did, and Run only at the very end.
     def OFXListEnd(self):
         if self.curOFXList is not None:
             for EachTable in self.curOFXList:
-                datatuple = self.curOFXList[EachTable][0]
-                TempTblCreate = 'Create Temp Table "{table}_Hold" (LIKE "{schema}"."{table}")'.format(table=EachTable,schema=self.__schema)
-                TempTblInsert = 'Insert Into "{table}_Hold" ({cols}) VALUES %s'.format(table=EachTable,
+                self.__WriteTable(EachTable)
+
+    def OFXFlushBatch(self, EachTable):   # ChunkSize: a chunk goes through the same COPY & MERGE as a whole list
+        self.__WriteTable(EachTable)
+        return True
+
+    def __WriteTable(self, EachTable):
+        self.TableStats(EachTable)
+        records = self.Records(EachTable)
+        if len(records) == 0:
+            return
+        CopyIn, QryMatches, PermMerge = self.__Statements(EachTable, self.curOFXList[EachTable][0])
+        buffer = io.StringIO()
+        for rec in records:
+            buffer.write('\t'.join([CopyField(field) for field in rec]))
+            buffer.write('\n')
+        buffer.seek(0)
+#   Get a cursor to execute the SQL steps
+        curs = self.DBSession.cursor()
+        curs.execute('Truncate "{table}_Hold"'.format(table=EachTable))
+        curs.copy_expert(CopyIn, buffer)
+        if QryMatches:
+            curs.execute(QryMatches)
+            NbrUpdates = curs.fetchone()[0]
+            curs.execute(PermMerge)
+            NbrInserts = curs.rowcount - NbrUpdates
+        else:
+            curs.execute(PermMerge)
+            actions = [row[0] for row in curs.fetchall()]
+            NbrInserts = actions.count('INSERT')
+            NbrUpdates = actions.count('UPDATE')
+        curs.close()
+        if self.__commitevery == 'Table':
+            self.DBSession.commit()
+        self.TableStats(EachTable)[0] += NbrInserts  # Update statistics
+        self.TableStats(EachTable)[1] += NbrUpdates
+
+#   Build (once per table per session) the statements OFXListEnd needs, creating the session's staging table as well.
+    def __Statements(self, EachTable, datatuple):
+        if EachTable not in self.__statements:
+            curs = self.DBSession.cursor()
+            curs.execute('Create Temp Table If Not Exists "{table}_Hold" (LIKE "{schema}"."{table}")'.format(
+                table=EachTable, schema=self.__schema))
+            curs.close()
+            CopyIn = 'Copy "{table}_Hold" ({cols}) From STDIN'.format(table=EachTable,
                                                     cols=",".join(['"{0}"'.format(i) for i in datatuple.Cols]))
-# interpose a Select to distinguish Updates from Inserts in the following Merge to give better statistics
-                if len(datatuple.PKCols) > 0:
-                    QryMatches = 'Select count(*) From "{table}_Hold" t Inner Join "{schema}"."{table}" M'.format(table=EachTable,schema=self.__schema)
-                    QryMatches +=" ON " + " AND ".join(['M."{pk}"=t."{pk}"'.format(pk=i) for i in datatuple.PKCols])
-                else:
-                    QryMatches = 'Select 0'
 # Merge statement to go from the temp table to the permanent one.  This blows up with a SQL error for tables without
 #   primary keys (or whose primary keys are not in the mapping, such as a sequence).  I think this is preferable to
 #   always Inserting records, because re-runs of the same file, or running overlapping date ranges from two files will
 #   produce duplicate transaction records.
-                PermMerge = 'Merge Into "{schema}"."{table}" M Using "{table}_Hold" t'.format(table=EachTable,schema=self.__schema)
-                PermMerge += " ON " + " AND ".join(['M."{pk}"=t."{pk}"'.format(pk=i) for i in datatuple.PKCols])
-                PermMerge += ' When Matched Then Update Set '
-                connector = ''
-                for tbCols in datatuple.Cols:
-                    if tbCols not in datatuple.PKCols:
-                        PermMerge += connector + '"{0}"=t."{0}"'.format(tbCols)
-                        connector = ', '
-                PermMerge += ' When Not Matched Then Insert ({cols}) Values '.format(
-                    cols=",".join(['"{0}"'.format(i) for i in datatuple.Cols]))
-                PermMerge += '(' + ', '.join(['t."{col}"'.format(col=i) for i in datatuple.Cols]) + ')'
-                DropTemp = 'Drop Table "{table}_Hold"'.format(table=EachTable)
+            PermMerge = 'Merge Into "{schema}"."{table}" M Using "{table}_Hold" t'.format(table=EachTable,schema=self.__schema)
+            PermMerge += " ON " + " AND ".join(['M."{pk}"=t."{pk}"'.format(pk=i) for i in datatuple.PKCols])
+            PermMerge += ' When Matched Then Update Set '
+            connector = ''
+            for tbCols in datatuple.Cols:
+                if tbCols not in datatuple.PKCols:
+                    PermMerge += connector + '"{0}"=t."{0}"'.format(tbCols)
+                    connector = ', '
+            PermMerge += ' When Not Matched Then Insert ({cols}) Values '.format(
+                cols=",".join(['"{0}"'.format(i) for i in datatuple.Cols]))
+            PermMerge += '(' + ', '.join(['t."{col}"'.format(col=i) for i in datatuple.Cols]) + ')'
+            if self.DBSession.server_version >= 170000:
+                QryMatches = None
+                PermMerge += ' Returning merge_action()'
+# interpose a Select to distinguish Updates from Inserts in the Merge to give better statistics
+            elif len(datatuple.PKCols) > 0:
+                QryMatches = 'Select count(*) From "{table}_Hold" t Inner Join "{schema}"."{table}" M'.format(table=EachTable,schema=self.__schema)
+                QryMatches +=" ON " + " AND ".join(['M."{pk}"=t."{pk}"'.format(pk=i) for i in datatuple.PKCols])
+            else:
+                QryMatches = 'Select 0'
+            self.__statements[EachTable] = (CopyIn, QryMatches, PermMerge)
+        return self.__statements[EachTable]
 
-#   Get a cursor to execute the SQL steps
+#   Incremental mode: the latest date per account already in the table (this session's own writes included).
+    def Watermarks(self, EachTable, datecol, acctcol):
+        curs = self.DBSession.cursor()
+        curs.execute('Select "{acct}", max("{date}") From "{schema}"."{table}" Group By 1'.format(
+            acct=acctcol, date=datecol, schema=self.__schema, table=EachTable))
+        found = dict(curs.fetchall())
+        curs.close()
+        return found
+
+    def OFXFileEnd(self):
+        if self.__commitevery == 'File':
+            self.DBSession.commit()
+
+#   Swap the session for a fresh one from the pool.  The staging tables went with the old session, so the statements
+#     that create them on first use are forgotten too.
+    def __Reconnect(self):
+        Release(self.DBSession, self.__poolsize, True, **self.__connectargs)
+        self.DBSession = Connect(self.__poolsize, **self.__connectargs)
+        self.__statements = {}
+
+#   With a pool, check the session before each file: the server may have been restarted while we sat idle.
+    def OFXFileStart(self, ofxfile):
+        if self.__poolsize > 0:
+            try:
                 curs = self.DBSession.cursor()
-                curs.execute(TempTblCreate)
-                # execute_values is happiest with the records in a list of tuples, that's why they were saved that way.
-                psycopg2.extras.execute_values(curs,TempTblInsert,self.curOFXList[EachTable][2])
-                curs.execute(QryMatches)
-                NbrUpdates = curs.fetchone()
-                curs.execute(PermMerge)
-                NbrTotal = curs.rowcount
-                curs.execute(DropTemp)
-                self.DBSession.commit()
+                curs.execute('Select 1')
                 curs.close()
-                if EachTable not in self.Stats:
-                    self.Stats[EachTable]=[0,0]  # Update statistics
-                self.Stats[EachTable][0] += NbrTotal-NbrUpdates[0]
-                self.Stats[EachTable][1] += NbrUpdates[0]
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                self.__Reconnect()
+
+#   A file failed part way through: throw away whatever it wrote since the last commit.
+    def OFXFileAbort(self):
+        try:
+            self.DBSession.rollback()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            pass
+        self.__statements = {}   # The rollback may have taken staging tables created since, so create them anew
+        if self.DBSession.closed:
+            self.__Reconnect()
 
-#   Finish up by closing out the DB session & releasing server resources
+#   Finish up by committing whatever is still open, closing out the DB session & releasing server resources
     def OFXAllDone(self):
-        self.DBSession.close()
+        self.DBSession.commit()
+        Release(self.DBSession, self.__poolsize, closepool=True, **self.__connectargs)
 
 # The following class is a specification (mapping) reader.  This one gets its data out of the data base itself, from a
 #  mapping table whose name is passed in as maptable and various metadata elements from information_schema & pg_catalog.
 #  Its sole purpose is to provide those records to the caller as an Iterator so it can build the internal mapping data.
+#
+#  The query below crawls information_schema and pg_catalog and can take longer than loading a statement, so its result
+#  is kept in a local cache file (MappingCache in [Postgres]; Off to disable).  The cache is only used when a cheap
+#  fingerprint of the schema's tables, columns and constraints and of the mapping table's contents is unchanged since
+#  the cache was written; any DDL in the schema or any edit to the mapping table rebuilds it.  The cache is plain JSON,
+#  readable by its owner only, and by default sits next to the .ini file (in the home directory when that is not known),
+#  named after the server, data base, schema and mapping table it was read from.
+MappingCacheVersion = 2
+
+def MappingCacheFile(*source):
+    IniFile = getattr(OFXGlobals.params, 'IniFile', None)
+    where = os.path.dirname(IniFile) if IniFile else os.path.expanduser('~')
+    return os.path.join(where, 'OFXtoDB_mapping_{0}.json'.format(
+        hashlib.sha256('|'.join(str(s) for s in source).encode()).hexdigest()[:16]))
+
 class MappingFromDB(OFXWriter.MappingFromIniFile):
-    def __init__(self,useschema,usesession,maptable):
+    def __init__(self,useschema,usesession,maptable,cachefile=None):
         self.schema=useschema
         self.session = usesession
         self.maptable = maptable
+        self.cachefile = cachefile
+
+    def __Fingerprint(self):
+        curs = self.session.cursor()
+        curs.execute('''Select md5(concat_ws('|', current_database(), %(schema)s, %(maptable)s,
+            (Select string_agg(format('%%s.%%s:%%s:%%s:%%s', c.relname, a.attname, a.atttypid, a.attnum, a.attnotnull), ','
+                               Order By c.relname, a.attnum)
+               From pg_catalog.pg_class c Inner Join pg_catalog.pg_namespace n On n.oid=c.relnamespace
+                    Inner Join pg_catalog.pg_attribute a On a.attrelid=c.oid
+              Where n.nspname=%(schema)s And c.relkind In ('r','p','v','f') And a.attnum>0 And Not a.attisdropped),
+            (Select string_agg(format('%%s:%%s:%%s:%%s:%%s', con.conname, con.contype, con.conrelid, con.confrelid, con.conkey), ','
+                               Order By con.conrelid, con.conname)
+               From pg_catalog.pg_constraint con Inner Join pg_catalog.pg_namespace n On n.oid=con.connamespace
+              Where n.nspname=%(schema)s),
+            (Select string_agg(m::text, ',' Order By m::text) From "{0}"."{1}" m)))
+        '''.format(self.schema, self.maptable), {'schema': self.schema, 'maptable': self.maptable})
+        fingerprint = curs.fetchone()[0]
+        curs.close()
+        return fingerprint
+
+    def __ReadCache(self, fingerprint):
+        try:
+            with open(self.cachefile, 'r') as f:
+                cache = json.load(f)
+            if cache['version'] != MappingCacheVersion or cache['fingerprint'] != fingerprint:
+                return None
+            return [OFXWriter.MappingRecord._make(rcd) for rcd in cache['records']]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def __WriteCache(self, fingerprint, records):
+        try:
+            if os.path.exists(self.cachefile + '.tmp'):
+                os.remove(self.cachefile + '.tmp')   # So the new one is created with the permissions below
+            with os.fdopen(os.open(self.cachefile + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as f:
+                json.dump({'version': MappingCacheVersion, 'fingerprint': fingerprint,
+                           'records': [list(rcd) for rcd in records]}, f)
+            os.replace(self.cachefile + '.tmp', self.cachefile)
+        except OSError:
+            pass     # No cache this time; the mapping itself is fine
 
     def __iter__(self):
+        if self.cachefile:
+            fingerprint = self.__Fingerprint()
+            records = self.__ReadCache(fingerprint)
+            if records is not None:
+                self.__records = iter(records)
+                return self
         self.curs = self.session.cursor(cursor_factory=psycopg2.extras.NamedTupleCursor)
         self.curs.execute('''With Recursive dependencies AS (
         	Select table_schema,table_name, 0 as dependency_level, table_schema as foreign_schema,table_name as foreign_name, ot."OFXList" as ofxgroup
@@ -159,10 +349,12 @@ class MappingFromDB(OFXWriter.MappingFromIniFile):
     # the same table, although you can mostly accomplish this on the data base side as well through triggers or
     # generated columns (Postgres-only).
     #
+        records = [OFXWriter.MappingRecord._make(rcd) for rcd in self.curs.fetchall()]
+        self.curs.close()
+        if self.cachefile:
+            self.__WriteCache(fingerprint, records)
+        self.__records = iter(records)
         return self
 
     def __next__(self):
-        rcd = self.curs.fetchone()
-        if rcd is not None: return rcd
-        self.curs.close()
-        raise StopIteration
+        return next(self.__records)
@@ -0,0 +1,135 @@
+#  The records a Writer accumulates for one table over one OFX list, from OFXListStart to OFXListEnd.
+#
+#  Records are kept column by column, one Python list per table column, so a record costs one pointer per column rather
+#  than a tuple object of its own plus the slot of the list holding it, and the working record built by OFXRecStart and
+#  OFXPutData goes into the columns as it is, without first being frozen into a tuple.  The primary key index (PK tuple
+#  -> record position) is also the list of PKs in record order, since a dictionary keeps its keys in insertion order, so
+#  no separate list of PKs is kept alongside it.
+#
+#  With SpillRecords = n in [common], once n records of a table are held in memory they are pickled (still column by
+#  column) to a temporary file in SpillDirectory (the system's temporary directory when empty) and the columns start
+#  again empty.  A huge list then costs at most n records per table in memory, plus its key index.  The spilled records
+#  are read back a chunk at a time, in the order they were added.  The file goes away when the store is cleared.
+#
+#  With ChunkSize = n in [common] the Writer's OFXFlushBatch writes a table's records out every n records, and the store
+#  is then Flushed: its records go, but the keys of the records flushed are kept (in a set, which is smaller than the
+#  position index) so that a duplicate arriving after its first version was written is still caught.  Find gives
+#  Flushed for those.
+#
+#  Writers read a store (Writer.Records(EachTable)) through:
+#    len(store)            the number of records
+#    for rec in store      every record, as a tuple in table column order
+#    store.Batches(size)   the same records as lists of at most size tuples
+#    store.Keys()          the PK tuple of every record, in the same order
+#  The base Writer fills it through Find, Append, Get and Replace.
+
+import collections
+import pickle
+import tempfile
+
+BatchSize = 10000   # Records per batch when a store is simply iterated
+Flushed = -1        # Find's answer for a key whose record was already flushed
+Drain = collections.deque(maxlen=0).extend   # Runs an iterator for its side effects (the column appends) at C speed
+
+
+class RecordStore:
+
+    def __init__(self, width, spill=0, spilldir=None):
+        self.width = width
+        self.spill = spill
+        self.spilldir = spilldir
+        self.__file = None
+        self.Clear()
+
+#   A store is copied (with the mapping, into a RecordCollector or a worker process) empty: only its settings go along.
+    def __getstate__(self):
+        return (self.width, self.spill, self.spilldir)
+
+    def __setstate__(self, state):
+        self.width, self.spill, self.spilldir = state
+        self.__file = None
+        self.Clear()
+
+    def Clear(self):
+        self.__done = set()    # Keys of the records flushed
+        self.__Reset()
+
+    def Flush(self):   # The records were written out: let them go, remembering their keys
+        self.__done.update(self.__index)
+        self.__Reset()
+
+    def __Reset(self):
+        self.__cols = [[] for i in range(self.width)]
+        self.__index = {}      # PK tuple -> position
+        self.__count = 0
+        self.__spilled = 0     # Positions below this are in the spill file
+        self.__chunks = []     # (file offset, first position, number of records) of each spilled chunk
+        self.__changed = {}    # Position -> record, for spilled records replaced since
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    def __len__(self):
+        return self.__count
+
+    def Find(self, key):   # Where the record with this PK tuple is, Flushed, or None
+        where = self.__index.get(key)
+        if where is None and key in self.__done:
+            return Flushed
+        return where
+
+    def Append(self, rec, key):
+        self.__index[key] = self.__count
+        self.__count += 1
+        Drain(map(list.append, self.__cols, rec))
+        if self.spill and self.__count - self.__spilled >= self.spill:
+            self.__Spill()
+
+    def Get(self, where):
+        if where >= self.__spilled:
+            return tuple(col[where - self.__spilled] for col in self.__cols)
+        if where in self.__changed:
+            return self.__changed[where]
+        for offset, first, count in self.__chunks:
+            if first <= where < first + count:
+                return tuple(col[where - first] for col in self.__Load(offset))
+
+    def Replace(self, where, rec):
+        if where >= self.__spilled:
+            where -= self.__spilled
+            for col, value in zip(self.__cols, rec):
+                col[where] = value
+        else:
+            self.__changed[where] = tuple(rec)
+
+    def Keys(self):
+        return iter(self.__index)
+
+    def __iter__(self):
+        for batch in self.Batches(BatchSize):
+            yield from batch
+
+    def Batches(self, size=None):   # Lists of record tuples, in order.  No size: a spilled chunk or the rest at a time
+        for offset, first, count in self.__chunks:
+            rows = list(zip(*self.__Load(offset)))
+            for where, rec in self.__changed.items():
+                if first <= where < first + count:
+                    rows[where - first] = rec
+            for start in range(0, count, size or count):
+                yield rows[start:start + (size or count)]
+        inmemory = self.__count - self.__spilled
+        for start in range(0, inmemory, size or inmemory or 1):
+            yield list(zip(*[col[start:start + (size or inmemory)] for col in self.__cols]))
+
+    def __Spill(self):
+        if self.__file is None:
+            self.__file = tempfile.TemporaryFile(prefix='OFXtoDB', dir=self.spilldir or None)
+        self.__file.seek(0, 2)
+        self.__chunks.append((self.__file.tell(), self.__spilled, self.__count - self.__spilled))
+        pickle.dump(self.__cols, self.__file, pickle.HIGHEST_PROTOCOL)
+        self.__spilled = self.__count
+        self.__cols = [[] for i in range(self.width)]
+
+    def __Load(self, offset):
+        self.__file.seek(offset)
+        return pickle.load(self.__file)
@@ -0,0 +1,156 @@
+#  A Writer for a SQLite data base file: OFX history kept in a real, queryable data base without running a server.
+#
+#  The tables are created (if they are not there yet) from the [Table:...] sections of the .ini file, the same ones the
+#  .ini mapping uses: every column listed, typed by its format, with the PK columns as the primary key.  The formats
+#  become SQLite declared types S,E -> TEXT, N -> NUMERIC, D -> TIMESTAMP (ISO text), DATE -> DATE (ISO text) and
+#  B -> BOOLEAN.  Besides the primary key, each date column gets an index on (date, primary key) so date range queries
+#  are answered from the index alone.
+#
+#  Writing follows the Postgres Writer: each list is loaded (executemany) into a TEMP staging table "<table>_Hold" and
+#  then upserted in one statement, INSERT ... SELECT ... ON CONFLICT DO UPDATE ... RETURNING rowid.  Rows inserted get
+#  rowids above the table's highest rowid before the statement, which tells Added from Updated.  Tables without a
+#  primary key are simply appended to.  The data base runs in WAL mode and commits once per file (CommitEvery in
+#  [SQLite], as in [Postgres]).
+#
+#  [SQLite] parameters: Database (the file, created if need be), CommitEvery (Table, File or Run).
+
+import OFXWriter
+import OFXGlobals
+import re
+import sqlite3
+from os import path
+
+DeclaredTypes = {'S': 'TEXT', 'E': 'TEXT', 'N': 'NUMERIC', 'D': 'TIMESTAMP', 'DATE': 'DATE', 'B': 'BOOLEAN'}
+
+
+def ToNumeric(value):
+    return str(value)   # Decimal has no SQLite binding; NUMERIC affinity stores the text as a number
+
+def ToTimestamp(value):
+    return value.isoformat(' ')
+
+def ToDateText(value):
+    return value.date().isoformat()
+
+Binders = {'N': ToNumeric, 'D': ToTimestamp, 'DATE': ToDateText}
+
+
+# The columns of a [Table:...] section as (column, format, IsPK), in order
+def TableColumns(table):
+    section = 'Table:{0}'.format(table)
+    if not OFXGlobals.params.has_section(section):
+        raise OFXWriter.ConfigurationError("No [{0}] section to create the SQLite table from".format(section))
+    columns = []
+    for col in OFXGlobals.params.options(section):
+        cd = re.findall(r'[^\s,]+', OFXGlobals.params.get(section, col) or '')
+        if not cd:
+            raise OFXWriter.ConfigurationError("Table definition missing for Table:{0} and Column:{1}".format(table, col))
+        columns.append((col, cd[0], len(cd) > 1 and cd[1] == 'PK'))
+    return columns
+
+
+class SQLiteDBWriter(OFXWriter.Writer):
+    def __init__(self, plist):
+        self.__dbfile = path.expandvars(plist['Database'] if 'Database' in plist else 'OFXtoDB.sqlite')
+        self.__commitevery = plist['CommitEvery'] if 'CommitEvery' in plist else 'File'
+        if self.__commitevery not in ('Table', 'File', 'Run'):
+            raise OFXWriter.ConfigurationError("CommitEvery must be Table, File or Run, not {0}".format(self.__commitevery))
+        self.SavedAtFileEnd = self.__commitevery != 'Run'
+        self.UndoesFile = True   # OFXFileAbort rolls back to the last commit
+        # Only one thread uses the session at a time, but with Pipeline = Async that is the pipeline's writer thread
+        #   rather than the one that opened it
+        self.DBSession = sqlite3.connect(self.__dbfile, check_same_thread=False)
+        self.DBSession.execute('PRAGMA journal_mode=WAL')
+        self.DBSession.execute('PRAGMA synchronous=NORMAL')
+        self.destination = 'SQLite {0}'.format(sqlite3.sqlite_version)
+        self.__statements = {}
+        super().__init__(plist)
+        for OFXList in self.OFXListDict:
+            for EachTable in self.OFXListDict[OFXList]:
+                self.__CreateTable(EachTable)
+        self.DBSession.commit()
+
+    def __CreateTable(self, EachTable):
+        columns = TableColumns(EachTable)
+        PKCols = [col for col, fmt, IsPK in columns if IsPK]
+        ddl = 'Create Table If Not Exists "{table}" ('.format(table=EachTable)
+        ddl += ', '.join(['"{0}" {1}'.format(col, DeclaredTypes.get(fmt, 'TEXT')) for col, fmt, IsPK in columns])
+        if PKCols:
+            ddl += ', Primary Key (' + ', '.join(['"{0}"'.format(pk) for pk in PKCols]) + ')'
+        self.DBSession.execute(ddl + ')')
+        for col, fmt, IsPK in columns:
+            if fmt in ('D', 'DATE'):
+                self.DBSession.execute('Create Index If Not Exists "{table}_{col}" On "{table}" ({cols})'.format(
+                    table=EachTable, col=col, cols=', '.join(['"{0}"'.format(c) for c in [col] + PKCols])))
+
+#   Build (once per table per session) what OFXListEnd needs: the staging table, its INSERT, the upsert, and a binder
+#     per column to turn Decimals and datetimes into something SQLite stores.
+    def __Statements(self, EachTable, datatuple):
+        if EachTable not in self.__statements:
+            fmts = {}
+            for entry in datatuple.OFXDict.values():
+                fmts.setdefault(entry.pos, entry.fmt)
+            cols = ', '.join(['"{0}"'.format(i) for i in datatuple.Cols])
+            self.DBSession.execute('Create Temp Table If Not Exists "{table}_Hold" ({cols})'.format(
+                table=EachTable, cols=cols))
+            StageIn = 'Insert Into "{table}_Hold" ({cols}) Values ({marks})'.format(
+                table=EachTable, cols=cols, marks=', '.join('?' * len(datatuple.Cols)))
+# "Where true" keeps SQLite from reading ON CONFLICT as a join constraint of the SELECT.
+            Upsert = 'Insert Into main."{table}" ({cols}) Select {cols} From "{table}_Hold" Where true'.format(
+                table=EachTable, cols=cols)
+            if len(datatuple.PKCols) > 0:
+                updates = ['"{0}"=excluded."{0}"'.format(i) for i in datatuple.Cols if i not in datatuple.PKCols]
+                if not updates:   # Nothing but key columns: a no-op update still gets the row RETURNed (and counted)
+                    updates = ['"{0}"=excluded."{0}"'.format(next(iter(datatuple.PKCols)))]
+                Upsert += ' On Conflict (' + ', '.join(['"{0}"'.format(pk) for pk in datatuple.PKCols]) + ')'
+                Upsert += ' Do Update Set ' + ', '.join(updates)
+            Upsert += ' Returning rowid'
+            binders = [Binders.get(fmts.get(pos)) for pos in datatuple.Cols.values()]
+            self.__statements[EachTable] = (StageIn, Upsert, binders)
+        return self.__statements[EachTable]
+
+    def OFXListEnd(self):
+        if self.curOFXList is not None:
+            for EachTable in self.curOFXList:
+                self.__WriteTable(EachTable)
+
+    def OFXFlushBatch(self, EachTable):   # ChunkSize: a chunk is staged and upserted just like a whole list
+        self.__WriteTable(EachTable)
+        return True
+
+    def __WriteTable(self, EachTable):
+        self.TableStats(EachTable)
+        records = self.Records(EachTable)
+        if len(records) == 0:
+            return
+        StageIn, Upsert, binders = self.__Statements(EachTable, self.curOFXList[EachTable][0])
+        curs = self.DBSession.cursor()
+        curs.execute('Delete From "{table}_Hold"'.format(table=EachTable))
+        curs.executemany(StageIn, ([field if field is None or bind is None else bind(field)
+                                    for field, bind in zip(rec, binders)]
+                                   for rec in records))
+        premax = curs.execute('Select coalesce(max(rowid), 0) From main."{table}"'.format(
+            table=EachTable)).fetchone()[0]
+        rowids = [row[0] for row in curs.execute(Upsert).fetchall()]
+        curs.close()
+        NbrInserts = sum(1 for rowid in rowids if rowid > premax)
+        if self.__commitevery == 'Table':
+            self.DBSession.commit()
+        self.TableStats(EachTable)[0] += NbrInserts  # Update statistics
+        self.TableStats(EachTable)[1] += len(rowids) - NbrInserts
+
+    def Watermarks(self, EachTable, datecol, acctcol):   # Incremental mode: the latest date per account in the table
+        return dict(self.DBSession.execute('Select "{acct}", max("{date}") From main."{table}" Group By 1'.format(
+            acct=acctcol, date=datecol, table=EachTable)).fetchall())
+
+    def OFXFileEnd(self):
+        if self.__commitevery == 'File':
+            self.DBSession.commit()
+
+    def OFXFileAbort(self):   # Throw away whatever the failed file wrote since the last commit
+        self.DBSession.rollback()
+        self.__statements = {}   # The rollback may have taken staging tables created since, so create them anew
+
+    def OFXAllDone(self):
+        self.DBSession.commit()
+        self.DBSession.close()
@@ -1,27 +1,158 @@
-#  Extension of the xml.etree.ElementTree.Element object to enable access to both the current node and the immediate
-#  parent node while walking (iterating) the subtree.  Returns a 2-tuple with current node and its parent as two
-#  ElementTree.Element objects.  This was necessary solely because there are a few ambiguous tags in the Banking, Loan,
-#  and Credit Card lists which must be disambiguated by adding its parent.  This was created as a module mainly to get
-#  the messy details of iterating the subtree out of the main logic.
+#  Walking an xml.etree.ElementTree.Element subtree with access to both the current node and its immediate parent.
+#  Walk yields a 3-tuple for every element, in document order: the element, its parent (None for the top element) and
+#  its "parent/tag" path.  The parent was needed solely because there are a few ambiguous tags in the Banking, Loan, and
+#  Credit Card lists which must be disambiguated by adding its parent, and the path is that disambiguated name.  This
+#  was created as a module mainly to get the messy details of iterating the subtree out of the main logic.
+#
+#  The walk keeps a stack of (element, iterator over its children), so each element is visited once and nothing is
+#  shifted off the front of a list: the time is linear in the size of the subtree however wide it is.  The paths are
+#  built once per distinct (parent, tag) pair and interned, so the same few dozen strings are handed out over and over
+#  instead of a new one being formatted for every element of every list entry.
+#
+#  Run this module by itself (python WalkElementTree.py) for a benchmark against the pop(0) walkers it replaced.
 
-class ElandParent:
+import sys
+
+Paths = {}   # (parent tag, tag) -> interned path
+
+
+def TagPath(parenttag, tag):
+    path = Paths.get((parenttag, tag))
+    if path is None:
+        path = Paths[(parenttag, tag)] = sys.intern(tag if parenttag is None else "{0}/{1}".format(parenttag, tag))
+    return path
+
+
+# Yield (element, parent, path) for top and everything below it.  Elements whose tag is in skip are yielded but not
+#   gone into.  parenttag is what the top element's path is built with: None gives just its tag.
+def Walk(top, skip=(), parenttag=None):
+    yield top, None, TagPath(parenttag, top.tag)
+    if top.tag in skip:
+        return
+    stack = [(top, iter(top))]
+    while stack:
+        parent, children = stack[-1]
+        for el in children:
+            yield el, parent, TagPath(parent.tag, el.tag)
+            if len(el) and el.tag not in skip:
+                stack.append((el, iter(el)))   # Its children next; this level carries on where it left off after them
+                break
+        else:
+            stack.pop()
+
+
+class ElandParent:   # The (element, parent) pairs of Walk, for callers that don't need the path
 
     def __init__(self, treeEl):
         self.__start = treeEl
 
     def __iter__(self):
-        self.__PDL = [[self.__start]]
-        return self
-
-    def __next__(self):
-        while len(self.__PDL)>0:
-            if len(self.__PDL[-1])<=0:
-                self.__PDL.pop(-1)      # Empty list on stack top-Pop it off, then pop off the leftmost, topmost entry
-                if len(self.__PDL)>0 and len(self.__PDL[-1])>0:  self.__PDL[-1].pop(0)   # (Already processed)
+        return ((el, parent) for el, parent, path in Walk(self.__start))
+
+
+if __name__ == '__main__':
+    import copy
+    import timeit
+    import xml.etree.ElementTree
+    import OFXGlobals
+    import OFXtoDB
+
+    class LegacyElandParent:   # The walker this module replaced, for comparison only
+        def __init__(self, treeEl):
+            self.__start = treeEl
+
+        def __iter__(self):
+            self.__PDL = [[self.__start]]
+            return self
+
+        def __next__(self):
+            while len(self.__PDL) > 0:
+                if len(self.__PDL[-1]) <= 0:
+                    self.__PDL.pop(-1)
+                    if len(self.__PDL) > 0 and len(self.__PDL[-1]) > 0:
+                        self.__PDL[-1].pop(0)
+                else:
+                    parent = self.__PDL[-2][0] if len(self.__PDL) > 1 else None
+                    current = self.__PDL[-1][0]
+                    self.__PDL.append(current.findall('*'))
+                    return tuple((current, parent))
+            raise StopIteration
+
+    def LegacyAddData(subTree, globalvars, listtag):   # OFXtoDB.AddData before Walk, for comparison only
+        local = copy.deepcopy(globalvars)
+        save = [[subTree]]
+        while len(save) > 0:
+            if len(save[-1]) > 0:
+                e = save[-1][0]
+                if e.tag not in OFXGlobals.KnownLists:
+                    if e.text:
+                        parent = save[-2][0].tag if len(save) > 1 and len(save[-1]) > 0 else ""
+                        local.append(OFXtoDB.XMLPairs(e.tag, e.text, "{0}/{1}".format(parent, e.tag)))
+                    save.append(e.findall('*'))
+                else:
+                    if e.tag == listtag:
+                        for dttag in ['DTSTART', 'DTEND']:
+                            dt = e.find(dttag)
+                            if dt is not None:
+                                local.append(OFXtoDB.XMLPairs(dt.tag, dt.text, "{0}/{1}".format(e.tag, dt.tag)))
+                    save[-1].pop(0)
             else:
-                parent = self.__PDL[-2][0] if len(self.__PDL)>1 else None
-                current = self.__PDL[-1][0]   # Process leftmost, topmost PDL entry (Leave on stack until later)
-                x = current.findall('*')      # Then get all the direct children as a (possibly empty) list
-                self.__PDL.append(x)          # and push the entire list onto the stack to be processed next in order
-                return tuple((current, parent))
-        raise StopIteration
+                save.pop(-1)
+                if len(save) > 0:
+                    save[-1].pop(0)
+        return local
+
+    def Element(tag, children=(), text=None):
+        el = xml.etree.ElementTree.Element(tag)
+        el.text = text
+        el.extend(children)
+        return el
+
+    def Position(n):
+        return Element('POSSTOCK', [Element('INVPOS', [
+            Element('SECID', [Element('UNIQUEID', text='{0:09d}'.format(n)), Element('UNIQUEIDTYPE', text='CUSIP')]),
+            Element('HELDINACCT', text='CASH'), Element('POSTYPE', text='LONG'), Element('UNITS', text=str(n)),
+            Element('UNITPRICE', text='12.34'), Element('MKTVAL', text='1234.00'),
+            Element('DTPRICEASOF', text='20240102160000.000[-5:EST]')])])
+
+    def Security(n):
+        return Element('STOCKINFO', [Element('SECINFO', [
+            Element('SECID', [Element('UNIQUEID', text='{0:09d}'.format(n)), Element('UNIQUEIDTYPE', text='CUSIP')]),
+            Element('SECNAME', text='Security {0}'.format(n)), Element('TICKER', text='T{0}'.format(n))])])
+
+    OFXGlobals.KnownLists = ['SECLIST', 'INVPOSLIST', 'INVTRANLIST', 'BANKTRANLIST', 'BANKTRANLISTP', 'LOANTRANLIST',
+                             'AMRTTRANLIST', 'CLOSING']
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    poslist = Element('INVPOSLIST', [Position(n) for n in range(size)])
+    seclist = Element('SECLIST', [Security(n) for n in range(size)])
+    wide = Element('MEMO', [Element('LINE', text=str(n)) for n in range(size)])   # One entry with thousands of children
+    context = Element('INVSTMTRS', [Element('DTASOF', text='20240102'), Element('CURDEF', text='USD'),
+                                    Element('INVACCTFROM', [Element('BROKERID', text='b.com'),
+                                                            Element('ACCTID', text='123')]),
+                                    Element('INVTRANLIST', [Element('DTSTART', text='20240101'),
+                                                            Element('DTEND', text='20240102')]),
+                                    poslist] + [Element('MKTGINFO', text=str(n)) for n in range(size)])
+    globalvars = [OFXtoDB.XMLPairs('FID', '1234', 'FI/FID'), OFXtoDB.XMLPairs('ORG', 'Broker', 'FI/ORG')]
+
+    def LegacyWalk(entries):
+        return [(current.tag, current.text, "{0}{1}".format(parent.tag + "/" if parent is not None else "", current.tag))
+                for entry in entries for current, parent in LegacyElandParent(entry)]
+
+    def NewWalk(entries):
+        return [(current.tag, current.text, path) for entry in entries for current, parent, path in Walk(entry)]
+
+    for entries in (poslist, seclist, [wide]):
+        if LegacyWalk(entries) != NewWalk(entries):
+            sys.exit("Walk differs from the legacy walker")
+    if LegacyAddData(context, globalvars, 'INVTRANLIST') != OFXtoDB.AddData(context, globalvars, 'INVTRANLIST'):
+        sys.exit("AddData differs from the legacy AddData")
+    print("{0:44}{1:>12}{2:>12}".format('milliseconds ({0} entries or children)'.format(size), 'legacy', 'Walk'))
+    for name, legacy, new in (
+            ('INVPOSLIST, entry by entry', lambda: LegacyWalk(poslist), lambda: NewWalk(poslist)),
+            ('SECLIST, entry by entry', lambda: LegacyWalk(seclist), lambda: NewWalk(seclist)),
+            ('one entry with {0} children'.format(size), lambda: LegacyWalk([wide]), lambda: NewWalk([wide])),
+            ('AddData, context with {0} siblings'.format(size),
+             lambda: LegacyAddData(context, globalvars, 'INVTRANLIST'),
+             lambda: OFXtoDB.AddData(context, globalvars, 'INVTRANLIST'))):
+        print("{0:44}{1:>12.2f}{2:>12.2f}".format(name, min(timeit.repeat(legacy, number=1, repeat=5)) * 1e3,
+                                                  min(timeit.repeat(new, number=1, repeat=5)) * 1e3))